@@ -1,48 +1,68 @@
-import difflib
+import functools
 import logging
 import sys
-import tempfile
-import uuid
-from typing import List, Optional
+import threading
+import time
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 import click
-import packaging.version
-import requests
-import rich
-from beaker import (
-    Beaker,
-    ConfigurationError,
-    ExperimentConflict,
-    ExperimentNotFound,
-    ImageNotFound,
-)
-from click.parser import split_arg_string
 from click_help_colors import HelpColorsCommand, HelpColorsGroup
-from requests.exceptions import HTTPError
-from rich import print
-from rich.highlighter import NullHighlighter
-from rich.logging import RichHandler
-from rich.padding import Padding
-from rich.prompt import Prompt
-from rich.syntax import Syntax
 
+from . import cache
+from .api import (
+    ACTUAL_LOGS_FILE,
+    DEFAULT_WORKERS,
+    JOB_POLICIES,
+    LATEST_JOB,
+    Session,
+    check_beaker_permissions,
+    get_beaker_client,
+    insert_link,
+    read_expected_output,
+    validate_max_memory,
+    validate_run_name,
+    validate_run_names,
+)
+from .exceptions import NaaclUtilsError
+from .logs import FragmentMatcher, LogRecorder
+from .manifest import load_manifest
+from .profiling import profiler
+from .spec import DEFAULT_RESOURCES, TaskSpec, load_task_specs, parse_size
+from .status import CANCELED, FAILED, PENDING, RUNNING, SUCCEEDED, run_status
 from .version import VERSION
 
-BEAKER_ORG = "NAACL"
-BEAKER_CLUSTER = "NAACL/server"
-BEAKER_ADDRESS = "https://beaker.org"
-BUG_REPORT_URL = "https://github.com/naacl2022-reproducibility-track/naacl-utils/issues/new?assignees=&labels=bug&template=bug_report.md&title="
-TUTORIAL_URL = "https://naacl2022-reproducibility-track.github.io/tutorial/submitting"
+# Heavy dependencies like 'beaker', 'requests', and 'rich' are imported within the functions
+# that need them so that the CLI starts up quickly.
+if TYPE_CHECKING:
+    from rich.syntax import Syntax
+    from rich.table import Table
 
+    from .api import JobResult, VerifyResult
+    from .client import NaaclBeaker
 
-logger = logging.getLogger("naacl_utils")
-rich.get_console().highlighter = NullHighlighter()
+LATEST_RELEASE_CACHE = "latest-release.json"
+UPDATE_CHECK_TTL = 24 * 60 * 60  # seconds
+NO_UPDATE_CHECK_ENV_VAR = "NAACL_UTILS_NO_UPDATE_CHECK"
+STATE_COLORS = {
+    PENDING: "yellow",
+    RUNNING: "blue",
+    SUCCEEDED: "green",
+    FAILED: "red",
+    CANCELED: "dim",
+}
 
 
-class NaaclUtilsError(Exception):
-    """
-    Custom error we raise when we don't want to print a stacktrace.
-    """
+logger = logging.getLogger("naacl_utils")
 
 
 def excepthook(exctype, value, traceback):
@@ -70,53 +90,174 @@ def excepthook(exctype, value, traceback):
 sys.excepthook = excepthook
 
 
-def get_beaker_client(token: Optional[str] = None) -> Beaker:
-    logger.debug("Initializing beaker client")
-    if token is not None:
-        beaker = Beaker.from_env(user_token=token)
-    else:
-        beaker = Beaker.from_env()
-    beaker.config.agent_address = BEAKER_ADDRESS
-    beaker.config.default_org = BEAKER_ORG
-    beaker.config.default_workspace = f"{BEAKER_ORG}/{beaker.user}"
-    return beaker
+def refresh_latest_release():
+    """
+    Fetch the latest release from GitHub and cache it. This is meant to run in a background thread.
+    """
+    import requests
 
+    from .session import get_session
 
-def insert_link(link: str) -> str:
-    return f"[underline blue][link={link}]{link}[/][/]"
+    try:
+        response = get_session().get(
+            "https://api.github.com/repos/naacl2022-reproducibility-track/naacl-utils/releases/latest",
+            timeout=1,
+        )
+        response.raise_for_status()
+        latest_version = response.json()["tag_name"]
+    except (requests.RequestException, ValueError, KeyError):
+        logger.debug("Request to GitHub API failed", exc_info=sys.exc_info())
+        return
+    cache.write_json(
+        LATEST_RELEASE_CACHE, {"latest_version": latest_version, "checked_at": time.time()}
+    )
 
 
-def check_beaker_permissions(beaker: Beaker):
-    logger.debug("Checking beaker permissions")
-    assert beaker.config.default_workspace is not None
+def check_for_updates():
+    """
+    Warn if there's a newer version of naacl-utils according to the cached latest release.
+    The cache is refreshed in the background when it's stale, so this never blocks.
+    """
+    import packaging.version
+
+    logger.debug("Checking that naacl-utils is up-to-date")
+    latest_release = cache.read_json(LATEST_RELEASE_CACHE)
+    if (
+        not isinstance(latest_release, dict)
+        or time.time() - latest_release.get("checked_at", 0) > UPDATE_CHECK_TTL
+    ):
+        # The background thread is killed as soon as a quick command exits, so the time of
+        # the check is saved first. Otherwise every run would start another request, and
+        # failures while offline would be retried every time too.
+        previous_version = (
+            latest_release.get("latest_version") if isinstance(latest_release, dict) else None
+        )
+        cache.remove_leftover_temp_files(LATEST_RELEASE_CACHE)
+        cache.write_json(
+            LATEST_RELEASE_CACHE, {"latest_version": previous_version, "checked_at": time.time()}
+        )
+        logger.debug("Refreshing latest release in the background")
+        threading.Thread(target=refresh_latest_release, daemon=True).start()
+    if not isinstance(latest_release, dict) or latest_release.get("latest_version") is None:
+        return
     try:
-        # This will fail with a 403 if user doesn't have access to the NAACL organization.
-        beaker.ensure_workspace(beaker.config.default_workspace)
-    except HTTPError as exc:
-        if exc.response.status_code == 403:
-            raise NaaclUtilsError(
-                "Unable to access NAACL organization on Beaker. Did you complete all of the steps?\n\n"
-                f"  {insert_link(TUTORIAL_URL)}\n\n"
-                "If so, and you're still seeing this error, please submit a bug report here:\n\n"
-                f"  {insert_link(BUG_REPORT_URL)}"
+        latest_version = packaging.version.parse(latest_release["latest_version"])
+    except packaging.version.InvalidVersion:
+        logger.debug("Unable to parse latest release version", exc_info=sys.exc_info())
+        return
+    if latest_version > packaging.version.parse(VERSION):
+        logger.warning(
+            f"[yellow]You're using naacl-utils version {VERSION}, but there is a "
+            f"newer version available ({latest_version}).\n"
+            "Please upgrade with: 'pip install --upgrade naacl-utils'[/]",
+            extra={"markup": True},
+        )
+    else:
+        logger.debug("naacl-utils is up-to-date")
+
+
+def format_diff(
+    actual_lines: List[str], expected_lines: List[str], fromfile: str = "Actual"
+) -> "Syntax":
+    """
+    Format a unified diff between the actual and expected lines for printing.
+    """
+    import difflib
+
+    from rich.syntax import Syntax
+
+    return Syntax(
+        "\n".join(
+            difflib.unified_diff(
+                actual_lines, expected_lines, fromfile=fromfile, tofile="Expected", lineterm=""
             )
+        ),
+        "diff",
+    )
 
 
-def validate_run_name(run_name: str):
-    if not run_name.replace("-", "").isalnum():
-        raise NaaclUtilsError(
-            f"Invalid run name '{run_name}'. Names can only contain letters, digits, and dashes."
+def format_fragments(names: List[str], matcher: FragmentMatcher) -> "Table":
+    """
+    Format whether each fragment of expected output was found for printing.
+    """
+    from rich.table import Table
+
+    table = Table("Expected output", "Result")
+    missing = matcher.missing
+    for k, (name, start) in enumerate(zip(names, matcher.found)):
+        if start is not None:
+            result = f"[green]\N{check mark} Found at line {start + 1}[/]"
+        elif matcher.ordered and k > missing[0]:
+            result = "[yellow]Not checked[/]"
+        elif matcher.ordered and k > 0:
+            result = f"[red]\N{ballot x} Not found after '{names[k - 1]}'[/]"
+        else:
+            result = "[red]\N{ballot x} Not found[/]"
+        table.add_row(name, result)
+    return table
+
+
+def format_jobs(result: "VerifyResult") -> "Table":
+    """
+    Format whether each job of a run was verified for printing.
+    """
+    from rich.table import Table
+
+    table = Table("Job", "Result")
+    for job_result in result.jobs:
+        missing = job_result.missing
+        if not missing:
+            outcome = "[green]\N{check mark} Verified[/]"
+        elif len(result.fragments) > 1:
+            outcome = (
+                f"[red]\N{ballot x} {len(missing)} of {len(result.fragments)} expected output "
+                "fragments not found[/]"
+            )
+        else:
+            outcome = "[red]\N{ballot x} Expected output not found[/]"
+        table.add_row(job_result.job_id, outcome)
+    return table
+
+
+def format_error(exc: BaseException) -> str:
+    """
+    Format an error for a summary table.
+    """
+    if isinstance(exc, NaaclUtilsError):
+        return str(exc)
+    return f"{exc.__class__.__name__}: {exc}"
+
+
+def format_profile() -> "Table":
+    """
+    Format the timing of each phase of the command for printing.
+    """
+    from rich.filesize import decimal
+    from rich.table import Table
+
+    table = Table("Phase", "Calls", "Time", "Bytes", "Throughput", title="Profile")
+    for span, count in profiler.summary():
+        table.add_row(
+            "  " * span.depth + span.name,
+            str(count),
+            f"{span.duration:.3f}s",
+            "" if span.bytes is None else decimal(span.bytes),
+            "" if span.throughput is None else f"{decimal(int(span.throughput))}/s",
         )
-    if len(run_name) > 100:
-        raise NaaclUtilsError("Run name is too long!")
+    table.add_row("total", "", f"{profiler.elapsed:.3f}s", "", "", style="bold")
+    return table
 
 
-def validate_expected_output(expected_output_lines: List[str]):
-    for line in expected_output_lines:
-        if line:
-            break
-    else:
-        raise NaaclUtilsError("Expected output file has no content")
+def report_profile(output_path: Optional[str] = None):
+    """
+    Print the timing of each phase of the command, and write every span to ``output_path``
+    as JSON lines if given.
+    """
+    from rich.console import Console
+
+    Console(stderr=True).print(format_profile())
+    if output_path is not None:
+        profiler.write_jsonl(output_path)
 
 
 @click.group(
@@ -133,10 +274,36 @@ def validate_expected_output(expected_output_lines: List[str]):
     default="warning",
     show_choices=True,
 )
-def main(log_level: str = "warning"):
+@click.option(
+    "--no-update-check",
+    is_flag=True,
+    envvar=NO_UPDATE_CHECK_ENV_VAR,
+    help="Don't check whether a newer version of naacl-utils is available.",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Print how long each phase of the command took.",
+)
+@click.option(
+    "--profile-output",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Also write the timing of each phase to this file as JSON lines. Implies '--profile'.",
+)
+def main(
+    log_level: str = "warning",
+    no_update_check: bool = False,
+    profile: bool = False,
+    profile_output: Optional[str] = None,
+):
     """
     A command-line interface to help authors submit to the NAACL Reproducibility Track.
     """
+    import rich
+    from rich.highlighter import NullHighlighter
+    from rich.logging import RichHandler
+
+    rich.get_console().highlighter = NullHighlighter()
     logging.basicConfig(
         level=getattr(logging, log_level.upper()),
         format="%(message)s",
@@ -144,26 +311,16 @@ def main(log_level: str = "warning"):
         handlers=[RichHandler(tracebacks_suppress=[click], show_time=False)],
     )
 
+    profiler.reset(enabled=profile or profile_output is not None)
+    if profiler.enabled:
+        # This runs after the command, even if it fails.
+        click.get_current_context().call_on_close(functools.partial(report_profile, profile_output))
+
     # Ensure that we're running the latest version.
-    try:
-        logger.debug("Checking that naacl-utils is up-to-date")
-        response = requests.get(
-            "https://api.github.com/repos/naacl2022-reproducibility-track/naacl-utils/releases/latest",
-            timeout=1,
-        )
-        response.raise_for_status()
-        latest_version = packaging.version.parse(response.json()["tag_name"])
-        if latest_version > packaging.version.parse(VERSION):
-            logger.warning(
-                f"[yellow]You're using naacl-utils version {VERSION}, but there is a "
-                f"newer version available ({latest_version}).\n"
-                "Please upgrade with: 'pip install --upgrade naacl-utils'[/]",
-                extra={"markup": True},
-            )
-        else:
-            logger.debug("naacl-utils is up-to-date")
-    except HTTPError:
-        logger.debug("Request to GitHub API failed", exc_info=sys.exc_info())
+    if no_update_check:
+        logger.debug("Skipping update check")
+    else:
+        check_for_updates()
 
 
 @main.command(
@@ -182,8 +339,11 @@ def setup(force: bool = False):
     """
     One-time setup.
     """
+    from beaker import ConfigurationError
+    from rich import print
+    from rich.prompt import Prompt
 
-    def setup_beaker() -> Beaker:
+    def setup_beaker() -> "NaaclBeaker":
         # Tell user to create Beaker account and get user token.
         print(
             f"Please go to {insert_link('https://beaker.org')} and create an account.\n"
@@ -197,7 +357,7 @@ def setup(force: bool = False):
 
         return beaker
 
-    beaker: Beaker
+    beaker: "NaaclBeaker"
     if force:
         beaker = setup_beaker()
     else:
@@ -206,13 +366,125 @@ def setup(force: bool = False):
         except ConfigurationError:
             beaker = setup_beaker()
 
-    check_beaker_permissions(beaker)
+    check_beaker_permissions(beaker, use_cache=False)
 
     print(
         f"[green]\N{check mark} Setup complete, you are authenticated as [bold]'{beaker.user}'[/][/]"
     )
 
 
+@main.command(
+    cls=HelpColorsCommand,
+    help_options_color="green",
+    help_headers_color="yellow",
+    context_settings={"max_content_width": 115},
+)
+@click.argument("image", type=str)
+@click.option(
+    "--entrypoint",
+    type=str,
+    help="Override the ENTRYPOINT of the Docker image.",
+)
+@click.option(
+    "--cmd",
+    type=str,
+    help="Override the CMD of the Docker image.",
+)
+@click.option(
+    "--spec",
+    type=click.Path(exists=True, dir_okay=False),
+    help="A spec file like the one for 'submit', to run one of its tasks.",
+)
+@click.option(
+    "--task",
+    "task_name",
+    type=str,
+    help="The name of the task to run from '--spec', if it has more than one.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    help="Write the output to this file, to use as the expected output for 'verify'.",
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Run the image even if its output is cached from an earlier run.",
+)
+@click.option(
+    "--max-memory",
+    type=str,
+    default="256MiB",
+    show_default=True,
+    help="The most memory to use for processing the output, like for 'verify'.",
+)
+def preflight(
+    image: str,
+    entrypoint: Optional[str] = None,
+    cmd: Optional[str] = None,
+    spec: Optional[str] = None,
+    task_name: Optional[str] = None,
+    output: Optional[IO[str]] = None,
+    no_cache: bool = False,
+    max_memory: str = "256MiB",
+):
+    """
+    Run a Docker image locally to see what it prints before submitting it.
+
+    The image runs with the same ENTRYPOINT and CMD as it would with 'submit', and its output
+    is normalized the same way as the logs that 'verify' checks, so it can be saved as
+    the expected output. The output is cached for each image and command.
+
+    E.g.
+
+        naacl-utils preflight hello-world -o expected-output.txt
+
+    """
+    from rich import print
+    from rich.padding import Padding
+    from rich.text import Text
+
+    from . import preflight as preflight_module
+
+    max_memory_bytes = parse_size(max_memory)
+    validate_max_memory(max_memory_bytes)
+    task = TaskSpec(entrypoint=entrypoint, cmd=cmd)
+    if spec is not None:
+        tasks = {spec_task.name: spec_task for spec_task in load_task_specs(spec, task)}
+        if task_name is None:
+            if len(tasks) > 1:
+                raise NaaclUtilsError(
+                    f"Spec '{spec}' has several tasks, choose one with '--task' "
+                    f"({', '.join(tasks)})"
+                )
+            task_name = next(iter(tasks))
+        if task_name not in tasks:
+            raise NaaclUtilsError(f"Spec '{spec}' has no task named '{task_name}'")
+        task = tasks[task_name]
+    elif task_name is not None:
+        raise NaaclUtilsError("'--task' can only be used with '--spec'")
+
+    result = preflight_module.preflight(
+        image, task, use_cache=not no_cache, max_memory=max_memory_bytes
+    )
+    try:
+        output_lines = result.output
+        if result.cached:
+            print(f"Using the cached output of '{image}' ({result.digest[:19]})")
+        start = max(output_lines.num_lines - preflight_module.TAIL_LINES, 0)
+        if start > 0:
+            print(f"[dim]... {start} more lines[/]")
+        print(Padding(Text("\n".join(output_lines.iter_lines(start))), (0, 0, 1, 2), style="dim"))
+        if output is not None:
+            with output:
+                result.write_expected_output(output)
+            print(f"[green]\N{check mark} Wrote the output to '{output.name}'[/]")
+        print("[green]\N{check mark} Done![/]")
+    finally:
+        result.output.discard()
+
+
 @main.command(
     cls=HelpColorsCommand,
     help_options_color="green",
@@ -231,7 +503,50 @@ def setup(force: bool = False):
     type=str,
     help="Override the CMD of the Docker image.",
 )
-def submit(image: str, run_name: str, entrypoint: Optional[str] = None, cmd: Optional[str] = None):
+@click.option(
+    "--spec",
+    type=click.Path(exists=True, dir_okay=False),
+    help="""A YAML or JSON file with the tasks to run, for running several tasks in one experiment.
+    The other options are the defaults for every task in it.""",
+)
+@click.option(
+    "--gpus",
+    type=click.IntRange(min=0),
+    help=f"The number of GPUs for each task.  [default: {DEFAULT_RESOURCES.gpu_count}]",
+)
+@click.option(
+    "--cpus",
+    type=click.FloatRange(min=0, min_open=True),
+    help="The number of CPUs for each task.",
+)
+@click.option(
+    "--memory",
+    type=str,
+    help="The amount of memory for each task, e.g. '32GiB'.",
+)
+@click.option(
+    "--shared-memory",
+    type=str,
+    help=f"""The size of /dev/shm for each task, e.g. '8GiB'. Increase this if your data loaders
+    run out of shared memory.  [default: {DEFAULT_RESOURCES.shared_memory}]""",
+)
+@click.option(
+    "--force-upload",
+    is_flag=True,
+    help="Upload the image even if the exact same image has been uploaded before.",
+)
+def submit(
+    image: str,
+    run_name: str,
+    entrypoint: Optional[str] = None,
+    cmd: Optional[str] = None,
+    spec: Optional[str] = None,
+    gpus: Optional[int] = None,
+    cpus: Optional[float] = None,
+    memory: Optional[str] = None,
+    shared_memory: Optional[str] = None,
+    force_upload: bool = False,
+):
     """
     Submit a Docker image for your experiment to https://beaker.org.
 
@@ -239,66 +554,30 @@ def submit(image: str, run_name: str, entrypoint: Optional[str] = None, cmd: Opt
 
         naacl-utils submit hello-world run-1
 
+    Several tasks can run in one experiment, e.g. to run independent evaluations in parallel,
+    by describing them in a spec file:
+
+    \b
+        tasks:
+          - name: dev
+            cmd: python evaluate.py --split dev
+          - name: test
+            cmd: python evaluate.py --split test
+            shared_memory: 8GiB
+
     """
-    try:
-        beaker = get_beaker_client()
-    except ConfigurationError:
-        raise NaaclUtilsError(
-            "Beaker client not properly configured, did you forget to run the 'naacl-utils setup' command?",
-        )
+    from rich import print
 
     validate_run_name(run_name)
-    check_beaker_permissions(beaker)
-
-    beaker_image = image.replace(":", "-").replace("/", "-") + "-" + str(uuid.uuid4())[:4]
-    try:
-        logger.debug("Checking if image already exists")
-        # Make sure an image with this name doesn't exist on Beaker.
-        # It's unlikely because we add a random sequence of characters to the end of the name,
-        # but possible.
-        image_data = beaker.get_image(f"{beaker.user}/{beaker_image}")
-        # If it does exist, we'll delete it.
-        logger.debug("Removing existing image")
-        beaker.delete_image(image_data["id"])
-    except ImageNotFound:
-        pass
-
-    # (Re-)create image.
-    logger.debug("Creating image")
-    image_data = beaker.create_image(
-        name=beaker_image,
-        image_tag=image,
+    defaults = TaskSpec(
+        entrypoint=entrypoint,
+        cmd=cmd,
+        resources=DEFAULT_RESOURCES.override(
+            gpu_count=gpus, cpu_count=cpus, memory=memory, shared_memory=shared_memory
+        ),
     )
-
-    # Submit experiment.
-    try:
-        logger.debug("Submitting experiment")
-        experiment_data = beaker.create_experiment(
-            run_name,
-            {
-                "version": "v2-alpha",
-                "tasks": [
-                    {
-                        "name": "main",
-                        "image": {"beaker": image_data["id"]},
-                        "context": {"cluster": BEAKER_CLUSTER},
-                        "result": {
-                            "path": "/unused"
-                        },  # required even if the task produces no output.
-                        "command": None if entrypoint is None else split_arg_string(entrypoint),
-                        "arguments": None if cmd is None else split_arg_string(cmd),
-                        "resources": {
-                            "gpuCount": 1,
-                            "sharedMemory": "1GiB",
-                        },
-                    },
-                ],
-            },
-        )
-    except ExperimentConflict:
-        raise NaaclUtilsError(
-            f"A run with the name '{run_name}' already exists, try using a different name.",
-        )
+    tasks = [defaults] if spec is None else load_task_specs(spec, defaults)
+    experiment_data = Session().submit(image, run_name, tasks, force_upload=force_upload)
     experiment_id = experiment_data["id"]
     print(
         f"Experiment [blue]{experiment_id}[/] submitted.\n"
@@ -306,6 +585,72 @@ def submit(image: str, run_name: str, entrypoint: Optional[str] = None, cmd: Opt
     )
 
 
+@main.command(
+    "submit-batch",
+    cls=HelpColorsCommand,
+    help_options_color="green",
+    help_headers_color="yellow",
+    context_settings={"max_content_width": 115},
+)
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=DEFAULT_WORKERS,
+    show_default=True,
+    help="The maximum number of uploads and submissions to run at once.",
+)
+@click.option(
+    "--force-upload",
+    is_flag=True,
+    help="Upload the images even if the exact same images have been uploaded before.",
+)
+def submit_batch(manifest: str, workers: int = DEFAULT_WORKERS, force_upload: bool = False):
+    """
+    Submit many runs at once from a manifest file.
+
+    The manifest is either a YAML file with a list of runs or a JSON Lines file
+    with one run per line. Each run needs an 'image' and a 'run_name', and can optionally
+    override the 'entrypoint' and 'cmd', just like the 'submit' command.
+
+    E.g.
+
+        naacl-utils submit-batch runs.yml
+
+    """
+    from rich import print
+    from rich.table import Table
+
+    rows = load_manifest(manifest, ["image", "run_name"], ["entrypoint", "cmd"])
+
+    # Validate everything up front so we don't submit half of a bad manifest.
+    validate_run_names(row["run_name"] for row in rows)
+
+    runs = [
+        (row["image"], row["run_name"], [TaskSpec(entrypoint=row["entrypoint"], cmd=row["cmd"])])
+        for row in rows
+    ]
+    results = Session(workers=workers).submit_many(runs, force_upload=force_upload)
+
+    table = Table("Run", "Image", "Result")
+    failures = 0
+    for row, outcome in zip(rows, results):
+        if not isinstance(outcome, BaseException):
+            experiment_id = outcome["id"]
+            result = (
+                f"[green]\N{check mark}[/] {insert_link('https://beaker.org/ex/' + experiment_id)}"
+            )
+        else:
+            failures += 1
+            result = f"[red]\N{ballot x} {format_error(outcome)}[/]"
+        table.add_row(row["run_name"], row["image"], result)
+    print(table)
+
+    if failures:
+        raise NaaclUtilsError(f"{failures} of {len(rows)} run(s) failed to submit.")
+
+
 @main.command(
     cls=HelpColorsCommand,
     help_options_color="green",
@@ -313,83 +658,547 @@ def submit(image: str, run_name: str, entrypoint: Optional[str] = None, cmd: Opt
     context_settings={"max_content_width": 115},
 )
 @click.argument("run_name", type=str)
-@click.argument("expected_output_file", type=click.File("r"), default=sys.stdin)
-def verify(run_name: str, expected_output_file):
+@click.argument("expected_output_files", type=click.File("r"), nargs=-1)
+@click.option(
+    "--ordered",
+    is_flag=True,
+    help="Require the expected output files to appear in the logs in the order they're given.",
+)
+@click.option(
+    "--wait",
+    is_flag=True,
+    help="Wait for the run to finish before verifying it.",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0),
+    help="The maximum number of seconds to wait for with '--wait'.",
+)
+@click.option(
+    "--upload-logs",
+    is_flag=True,
+    help=f"Also upload the logs of the run alongside the results, gzipped as '{ACTUAL_LOGS_FILE}'.",
+)
+@click.option(
+    "--max-memory",
+    type=str,
+    default="256MiB",
+    show_default=True,
+    help="The most memory to use for processing the logs. Beyond that, they're kept "
+    "in a compressed temporary file, and lines longer than an eighth of it are truncated.",
+)
+@click.option(
+    "--jobs",
+    type=click.Choice(JOB_POLICIES),
+    default=LATEST_JOB,
+    show_default=True,
+    help="Which jobs of the run to verify: the latest one of each task, e.g. the retry of "
+    "a task that failed, or every one that succeeded, including earlier runs of a task. "
+    "The logs of several jobs are checked concurrently.",
+)
+@click.option(
+    "--task",
+    type=str,
+    help="Only verify the jobs of the task with this name, for runs with several tasks.",
+)
+@click.option(
+    "--any-job",
+    is_flag=True,
+    help="Each expected output file only has to appear in the logs of one of the jobs, "
+    "e.g. for tasks that print different results.",
+)
+def verify(
+    run_name: str,
+    expected_output_files: Tuple[IO[str], ...] = (),
+    ordered: bool = False,
+    wait: bool = False,
+    timeout: Optional[float] = None,
+    upload_logs: bool = False,
+    max_memory: str = "256MiB",
+    jobs: str = LATEST_JOB,
+    task: Optional[str] = None,
+    any_job: bool = False,
+):
     """
     Verify the results of a run against the expected output.
+
+    The expected output is read from stdin if no files are given. With several files, each one
+    is a separate fragment of expected output that has to appear somewhere in the logs. They're
+    all matched in one pass over the logs.
+
+    Logs are never loaded into memory all at once, so runs that log many gigabytes can be
+    verified within the '--max-memory' budget.
     """
-    try:
-        beaker = get_beaker_client()
-    except ConfigurationError:
-        raise NaaclUtilsError(
-            "Beaker client not properly configured, did you forget to run the 'naacl-utils setup' command?",
-        )
+    from rich import print
+
+    if not expected_output_files:
+        expected_output_files = (sys.stdin,)
+    names = [expected_output_file.name for expected_output_file in expected_output_files]
+    fragments = []
+    for expected_output_file in expected_output_files:
+        with expected_output_file:
+            fragments.append(read_expected_output(expected_output_file))
 
     validate_run_name(run_name)
-    check_beaker_permissions(beaker)
+    max_memory_bytes = parse_size(max_memory)
+    validate_max_memory(max_memory_bytes, fragments)
+    session = Session()
+    experiment: Optional[Dict[str, Any]] = None
+    if wait:
+        for _, experiment in session.wait([run_name], timeout=timeout):
+            pass
+    result = session.verify(
+        run_name,
+        fragments,
+        ordered=ordered,
+        upload_logs=upload_logs,
+        experiment=experiment,
+        max_memory=max_memory_bytes,
+        jobs=jobs,
+        task=task,
+        any_job=any_job,
+    )
+    several_jobs = len(result.jobs) > 1
+    if several_jobs:
+        print(format_jobs(result))
+    elif len(fragments) > 1:
+        print(format_fragments(names, result.jobs[0].matcher))
 
-    # Find the right experiment.
-    try:
-        experiment = beaker.get_experiment(f"{beaker.user}/{run_name}")
-    except ExperimentNotFound:
-        raise NaaclUtilsError(
-            f"Could not find a run with the name '{run_name}'. Are you sure that's the correct name?"
+    if result.verified:
+        # All good! The expected output has been uploaded to Beaker datasets.
+        print("[green]\N{check mark} Results successfully verified[/]")
+        print("[green]\N{check mark} Done![/]")
+        return
+
+    kept_logs = []
+    for job_result in result.failed_jobs:
+        if several_jobs:
+            print(f"[red]Job {job_result.job_id}:[/]")
+            if len(fragments) > 1:
+                print(format_fragments(names, job_result.matcher))
+        kept_log = report_mismatch(session, result, job_result, names, ordered)
+        if kept_log is not None:
+            kept_logs.append(kept_log)
+
+    failed_job = result.failed_jobs[0]
+    message = "Expected output not found in logs."
+    if several_jobs:
+        message = (
+            f"Expected output not found in the logs of {len(result.failed_jobs)} "
+            f"of {len(result.jobs)} jobs."
+        )
+    elif len(fragments) > 1:
+        message = (
+            f"{len(failed_job.missing)} of {len(fragments)} expected output fragments "
+            "not found in logs."
         )
+    if kept_logs:
+        message += "\nYou can view the full logs (gzipped) here:\n" + "\n".join(
+            f"[yellow]{path}[/]" for path in kept_logs
+        )
+    raise NaaclUtilsError(message)
 
-    # Make sure the experiment finished successfully.
-    if not experiment.get("jobs") or experiment["jobs"][0]["status"].get("exitCode") != 0:
-        raise NaaclUtilsError("Can only verify submissions that have completed successfully.")
 
-    exp_id: str = experiment["id"]
+def report_mismatch(
+    session: Session,
+    result: "VerifyResult",
+    job_result: "JobResult",
+    names: List[str],
+    ordered: bool = False,
+) -> Optional[str]:
+    """
+    Print diffs between the logs of a job and the expected output that wasn't found in them.
+    If the logs are too long to diff all of them, they're kept in a gzipped temporary file,
+    whose path is returned.
+    """
+    from rich import print
+    from rich.padding import Padding
 
-    # Download the logs.
-    logs = "".join(
-        (chunk.decode(errors="ignore") for chunk in beaker.get_logs_for_experiment(exp_id))
+    fragments = result.fragments
+    # Go over the logs again, which are in the log cache or a copy by now, to find out what
+    # went wrong.
+    # In order, the fragments after the first missing one weren't looked for.
+    missing = job_result.missing[:1] if ordered else job_result.missing
+    # A quarter of the budget is for the lines that are kept in memory for a full diff,
+    # which leaves enough for the line being processed.
+    recorder = LogRecorder(
+        *(fragments[k] for k in missing),
+        max_lines_in_memory=500,
+        max_memory=result.max_memory // 4,
     )
+    session.record_logs(result, recorder, job_id=job_result.job_id)
+    keep_logs = False
+    with profiler.span("diff"):
+        for i, k in enumerate(missing):
+            expected_output_lines = fragments[k]
+            if len(fragments) > 1:
+                print(f"[red]Expected output from '{names[k]}' not found:[/]")
+            if recorder.in_memory and len(expected_output_lines) < 500:
+                # The logs are short, so we can diff all of them.
+                print(Padding(format_diff(recorder.lines, expected_output_lines), 1))
+            else:
+                # Otherwise only diff the part of the logs that most resembles the expected
+                # output, and point the user to the file with the full logs so they can inspect
+                # them further.
+                start, actual_lines = recorder.mismatch_window(fragment=i)
+                print(
+                    Padding(
+                        format_diff(
+                            actual_lines,
+                            expected_output_lines,
+                            fromfile=f"Actual (lines {start + 1}-{start + len(actual_lines)})",
+                        ),
+                        1,
+                    )
+                )
+                keep_logs = True
+    if keep_logs:
+        return recorder.keep()
+    recorder.discard()
+    return None
 
-    # Beaker adds the date and time to log lines, so we remove those first.
-    log_lines = [line[line.find(" ") + 1 :].rstrip() for line in logs.split("\n")]
-    logs = "\n".join(log_lines)
 
-    with expected_output_file:
-        expected_output_lines = [line.rstrip() for line in expected_output_file.readlines()]
-        expected_output = "\n".join(expected_output_lines)
+@main.command(
+    "verify-batch",
+    cls=HelpColorsCommand,
+    help_options_color="green",
+    help_headers_color="yellow",
+    context_settings={"max_content_width": 115},
+)
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=DEFAULT_WORKERS,
+    show_default=True,
+    help="The maximum number of logs to process at once, across all of the runs.",
+)
+@click.option(
+    "--wait",
+    is_flag=True,
+    help="Wait for the runs to finish, verifying each one as soon as it does.",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0),
+    help="The maximum number of seconds to wait for with '--wait'.",
+)
+@click.option(
+    "--upload-logs",
+    is_flag=True,
+    help=f"Also upload the logs of each run alongside its results, gzipped as '{ACTUAL_LOGS_FILE}'.",
+)
+@click.option(
+    "--max-memory",
+    type=str,
+    default="1GiB",
+    show_default=True,
+    help="The most memory to use for processing logs, split evenly between the logs that are "
+    "processed at once.",
+)
+@click.option(
+    "--jobs",
+    type=click.Choice(JOB_POLICIES),
+    default=LATEST_JOB,
+    show_default=True,
+    help="Which jobs of each run to verify, like for 'verify'.",
+)
+@click.option(
+    "--task",
+    type=str,
+    help="Only verify the jobs of the task with this name in each run, like for 'verify'.",
+)
+@click.option(
+    "--any-job",
+    is_flag=True,
+    help="Each expected output file only has to appear in the logs of one of the jobs "
+    "of a run, like for 'verify'.",
+)
+def verify_batch(
+    manifest: str,
+    workers: int = DEFAULT_WORKERS,
+    wait: bool = False,
+    timeout: Optional[float] = None,
+    upload_logs: bool = False,
+    max_memory: str = "1GiB",
+    jobs: str = LATEST_JOB,
+    task: Optional[str] = None,
+    any_job: bool = False,
+):
+    """
+    Verify the results of many runs at once from a manifest file.
 
-    # Make sure the expected output isn't empty or something.
-    validate_expected_output(expected_output_lines)
+    The manifest is either a YAML file with a list of runs or a JSON Lines file
+    with one run per line. Each run needs a 'run_name' and an 'expected_output' path,
+    which is relative to the directory of the manifest. The 'expected_output' can also be
+    a list of paths to fragments of expected output, which have to appear in the logs in
+    that order if 'ordered' is true.
 
-    if expected_output in logs:
-        # All good! Upload the expected output to Beaker datasets.
-        print("[green]\N{check mark} Results successfully verified[/]")
-        print("Uploading results...")
-        with tempfile.NamedTemporaryFile(mode="w+t", suffix=".log") as tmpfile:
-            tmpfile.write(expected_output)
-            tmpfile.seek(0)
-            beaker.create_dataset(run_name, tmpfile.name, target="out.log", force=True)
-        print("[green]\N{check mark} Done![/]")
-    else:
-        # Print a diff if the logs aren't too long.
-        if max(len(log_lines), len(expected_output_lines)) < 500:
-            diff = Syntax(
-                "\n".join(
-                    list(
-                        difflib.unified_diff(
-                            log_lines, expected_output_lines, fromfile="Actual", tofile="Expected"
-                        )
-                    )
-                ),
-                "diff",
+    E.g.
+
+        naacl-utils verify-batch runs.yml
+
+    """
+    from pathlib import Path
+
+    from rich import print
+    from rich.table import Table
+
+    rows = load_manifest(
+        manifest,
+        ["run_name", "expected_output"],
+        list_fields=["expected_output"],
+        flag_fields=["ordered"],
+    )
+    validate_run_names(row["run_name"] for row in rows)
+    max_memory_bytes = parse_size(max_memory)
+    validate_max_memory(max_memory_bytes // workers)
+
+    errors: Dict[str, BaseException] = {}
+    fragments: Dict[str, List[List[str]]] = {}
+    for row in rows:
+        try:
+            fragments[row["run_name"]] = []
+            for name in row["expected_output"]:
+                with open(Path(manifest).parent / name) as expected_output_file:
+                    fragments[row["run_name"]].append(read_expected_output(expected_output_file))
+        except (OSError, NaaclUtilsError) as error:
+            errors[row["run_name"]] = error
+
+    session = Session(workers=workers)
+    session.check_permissions()
+    rows_by_name = {row["run_name"]: row for row in rows}
+    run_names = [run_name for run_name in rows_by_name if run_name not in errors]
+    verifying: List[str] = []
+
+    def runs() -> Iterator[Tuple[str, List[List[str]], bool, Optional[Dict[str, Any]]]]:
+        finished: Iterable[Tuple[str, Any]] = ((run_name, None) for run_name in run_names)
+        if wait:
+            # Verify each run as soon as it finishes.
+            finished = session.wait(run_names, timeout=timeout, return_exceptions=True)
+        try:
+            for run_name, experiment in finished:
+                if isinstance(experiment, BaseException):
+                    errors[run_name] = experiment
+                    continue
+                verifying.append(run_name)
+                yield run_name, fragments[run_name], rows_by_name[run_name]["ordered"], experiment
+        except NaaclUtilsError:
+            for run_name in run_names:
+                if run_name not in verifying and run_name not in errors:
+                    errors[run_name] = NaaclUtilsError("Timed out waiting for the run to finish")
+
+    results = session.verify_many(
+        runs(),
+        upload_logs=upload_logs,
+        max_memory=max_memory_bytes,
+        jobs=jobs,
+        task=task,
+        any_job=any_job,
+    )
+    for run_name, outcome in zip(verifying, results):
+        if isinstance(outcome, BaseException):
+            errors[run_name] = outcome
+        elif not outcome.verified:
+            errors[run_name] = mismatch_error(
+                rows_by_name[run_name], outcome, jobs, task=task, any_job=any_job
             )
-            print(Padding(diff, 1))
-            raise NaaclUtilsError("Expected output not found in logs.")
+
+    table = Table("Run", "Expected output", "Result")
+    failures = 0
+    for row in rows:
+        exc = errors.get(row["run_name"])
+        if exc is None:
+            result = "[green]\N{check mark} Verified and uploaded[/]"
         else:
-            # Otherwise just write the actual logs to a file so the user can inspect them further.
-            log_file = tempfile.NamedTemporaryFile(mode="w+t", suffix=".log", delete=False)
-            log_file.write(logs)
-            raise NaaclUtilsError(
-                f"Expected output not found in logs.\n"
-                f"You can view the full logs here:\n[yellow]{log_file.name}[/]"
+            failures += 1
+            result = f"[red]\N{ballot x} {format_error(exc)}[/]"
+        table.add_row(row["run_name"], ", ".join(row["expected_output"]), result)
+    print(table)
+
+    if failures:
+        raise NaaclUtilsError(f"{failures} of {len(rows)} run(s) failed verification.")
+
+
+def mismatch_error(
+    row: Dict[str, Any],
+    result: "VerifyResult",
+    jobs: str,
+    task: Optional[str] = None,
+    any_job: bool = False,
+) -> NaaclUtilsError:
+    """
+    Describe why a run of a 'verify-batch' manifest failed verification.
+    """
+    not_found = ""
+    if len(result.fragments) > 1:
+        missing = sorted({k for job in result.failed_jobs for k in job.missing})
+        not_found = f" ({', '.join(row['expected_output'][k] for k in missing)})"
+    in_jobs = ""
+    if len(result.jobs) > 1:
+        in_jobs = f" of job(s) {', '.join(job.job_id for job in result.failed_jobs)}"
+    command = f"naacl-utils verify {result.run_name}"
+    if jobs != LATEST_JOB:
+        command += f" --jobs {jobs}"
+    if task is not None:
+        command += f" --task {task}"
+    if any_job:
+        command += " --any-job"
+    return NaaclUtilsError(
+        f"Expected output{not_found} not found in logs{in_jobs}. Run '{command}' for details."
+    )
+
+
+@main.command(
+    cls=HelpColorsCommand,
+    help_options_color="green",
+    help_headers_color="yellow",
+    context_settings={"max_content_width": 115},
+)
+@click.argument("run_names", nargs=-1, required=True)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0),
+    help="The maximum number of seconds to wait for.",
+)
+def wait(run_names: Tuple[str, ...], timeout: Optional[float] = None):
+    """
+    Wait for one or more runs to finish.
+
+    E.g.
+
+        naacl-utils wait run-1 run-2
+
+    """
+    from rich import print
+
+    failures = 0
+    for run_name, experiment in Session().wait(run_names, timeout=timeout):
+        # A run with several tasks only succeeded if the latest job of each one did.
+        summary = run_status(experiment)
+        if summary["state"] == SUCCEEDED:
+            print(f"[green]\N{check mark} Run '{run_name}' completed successfully[/]")
+        else:
+            failures += 1
+            message = f"Run '{run_name}' {summary['state']}"
+            if summary["exit_code"] is not None:
+                message += f" (exit code {summary['exit_code']})"
+            print(f"[red]\N{ballot x} {message}[/]")
+
+    if failures:
+        raise NaaclUtilsError(f"{failures} of {len(set(run_names))} run(s) failed.")
+
+
+@main.command(
+    cls=HelpColorsCommand,
+    help_options_color="green",
+    help_headers_color="yellow",
+    context_settings={"max_content_width": 115},
+)
+@click.option(
+    "-j",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=DEFAULT_WORKERS,
+    show_default=True,
+    help="The maximum number of runs to look up at once.",
+)
+def status(workers: int = DEFAULT_WORKERS):
+    """
+    Show the status of all of your runs.
+
+    Runs that succeeded or were canceled are remembered locally, so they're never looked up
+    again. Failed runs are, in case they've been retried.
+    """
+    from collections import Counter
+
+    from rich import print
+    from rich.table import Table
+
+    statuses = Session(workers=workers).status()
+    if not statuses:
+        print("You haven't submitted any runs yet.")
+        return
+
+    table = Table("Run", "Status")
+    for summary in statuses:
+        state = summary["state"]
+        if state == FAILED and summary["exit_code"] is not None:
+            state = f"{state} (exit code {summary['exit_code']})"
+        table.add_row(summary["run_name"], f"[{STATE_COLORS[summary['state']]}]{state}[/]")
+    print(table)
+    counts = Counter(summary["state"] for summary in statuses)
+    print(", ".join(f"{counts[state]} {state}" for state in STATE_COLORS if counts[state]))
+
+
+@main.group(
+    "cache",
+    cls=HelpColorsGroup,
+    help_options_color="green",
+    help_headers_color="yellow",
+    context_settings={"max_content_width": 115},
+)
+def cache_group():
+    """
+    Inspect or clear the local cache.
+    """
+
+
+@cache_group.command(
+    "info",
+    cls=HelpColorsCommand,
+    help_options_color="green",
+    help_headers_color="yellow",
+    context_settings={"max_content_width": 115},
+)
+def cache_info():
+    """
+    Show what's in the local cache.
+
+    Cached logs are keyed by the ID of their job, or by a 'preflight-' key for the output
+    of the 'preflight' command.
+    """
+    from datetime import datetime
+
+    from rich import print
+    from rich.filesize import decimal
+    from rich.table import Table
+
+    log_cache = cache.LogCache()
+    entries = log_cache.entries()
+    total_size = sum(entry["size"] for entry in entries)
+    print(f"Cache directory: [yellow]{cache.get_cache_dir()}[/]")
+    print(
+        f"Cached logs: {len(entries)} ({decimal(total_size)} of {decimal(log_cache.max_size)} max)"
+    )
+    if entries:
+        table = Table("Key", "Size", "Last used")
+        for entry in entries:
+            table.add_row(
+                entry["key"] + (" (partial)" if entry["partial"] else ""),
+                decimal(entry["size"]),
+                datetime.fromtimestamp(entry["last_used"]).strftime("%Y-%m-%d %H:%M:%S"),
             )
+        print(table)
+
+
+@cache_group.command(
+    "clear",
+    cls=HelpColorsCommand,
+    help_options_color="green",
+    help_headers_color="yellow",
+    context_settings={"max_content_width": 115},
+)
+@click.option("--logs-only", is_flag=True, help="Only clear cached logs.")
+def cache_clear(logs_only: bool = False):
+    """
+    Clear the local cache.
+    """
+    from rich import print
+
+    cache.clear(logs_only=logs_only)
+    print("[green]\N{check mark} Cache cleared[/]")
 
 
 if __name__ == "__main__":
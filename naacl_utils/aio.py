@@ -0,0 +1,87 @@
+"""
+An asyncio layer over the Beaker client, so that requests that don't depend on each other
+can run concurrently.
+
+The client is blocking, so every call runs on a thread pool with
+:meth:`asyncio.loop.run_in_executor()`. The client's pooled session is safe to share
+between threads, so all of the calls reuse the same connections.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional, TypeVar
+
+if TYPE_CHECKING:
+    from .client import NaaclBeaker
+
+T = TypeVar("T")
+
+DEFAULT_WORKERS = 8
+
+
+class AsyncBeaker:
+    """
+    Awaitable versions of the methods of a :class:`~naacl_utils.client.NaaclBeaker` client,
+    e.g. ``await aio.get_experiment(exp_id)``. Other blocking functions, like the helpers that
+    the commands share, can be awaited with :meth:`call()`.
+
+    At most ``workers`` calls run at once.
+    """
+
+    def __init__(self, beaker: "NaaclBeaker", workers: int = DEFAULT_WORKERS):
+        self.beaker = beaker
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self) -> "AsyncBeaker":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def call(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Call a blocking function on the thread pool.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name: str) -> Callable[..., Awaitable[Any]]:
+        method = getattr(self.beaker, name)
+        if not callable(method):
+            raise AttributeError(name)
+
+        @functools.wraps(method)
+        async def call_method(*args, **kwargs) -> Any:
+            return await self.call(method, *args, **kwargs)
+
+        return call_method
+
+
+def run(
+    beaker: "NaaclBeaker",
+    func: Callable[[AsyncBeaker], Awaitable[T]],
+    workers: Optional[int] = None,
+) -> T:
+    """
+    Run an async function that takes an :class:`AsyncBeaker` to completion from synchronous code,
+    like the commands.
+
+    This can also be called from code that's already running in an event loop, e.g. in a Jupyter
+    notebook, in which case it runs on a new event loop in another thread, blocking the caller.
+    """
+
+    async def main() -> T:
+        with AsyncBeaker(beaker, workers=workers or DEFAULT_WORKERS) as aio:
+            return await func(aio)
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(main())
+    # asyncio.run() can't be nested within a running event loop.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, main()).result()
@@ -0,0 +1,1097 @@
+"""
+A Python API for submitting, waiting for, and verifying runs, which the CLI is built on.
+
+Scripts that drive many runs should use one :class:`Session`, so that the Beaker configuration
+is only loaded and the permissions only checked once, instead of spawning a ``naacl-utils``
+process for every run. E.g.
+
+.. code-block:: python
+
+    from naacl_utils.api import Session
+
+    session = Session()
+    session.submit("hello-world", "run-1")
+    for run_name, experiment in session.wait(["run-1"]):
+        pass
+    result = session.verify("run-1", [["Hello from Docker!"]])
+    assert result.verified
+
+Like the CLI, this module only imports heavy dependencies like 'beaker' when they're needed.
+"""
+
+import functools
+import logging
+import sys
+import tempfile
+import threading
+import uuid
+from dataclasses import dataclass
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
+
+from . import cache
+from .exceptions import NaaclUtilsError
+from .logs import (
+    DEFAULT_MAX_MEMORY,
+    MIN_MAX_MEMORY,
+    FragmentMatcher,
+    LogRecorder,
+    compress_lines,
+    iter_log_buffers,
+    iter_log_lines,
+    max_line_size,
+)
+from .polling import wait_for_experiments
+from .profiling import profiler
+from .spec import TaskSpec, make_experiment_spec, validate_tasks
+from .status import get_run_statuses, job_task_name, latest_jobs, sorted_jobs
+
+if TYPE_CHECKING:
+    from .aio import AsyncBeaker
+    from .client import NaaclBeaker
+
+T = TypeVar("T")
+
+BEAKER_ORG = "NAACL"
+BEAKER_CLUSTER = "NAACL/server"
+BEAKER_ADDRESS = "https://beaker.org"
+BUG_REPORT_URL = (
+    "https://github.com/naacl2022-reproducibility-track/naacl-utils/issues/new"
+    "?assignees=&labels=bug&template=bug_report.md&title="
+)
+TUTORIAL_URL = "https://naacl2022-reproducibility-track.github.io/tutorial/submitting"
+DEFAULT_WORKERS = 8
+EXPECTED_OUTPUT_FILE = "out.log"
+# When there are several fragments of expected output, they're uploaded as 'out-1.log', etc.
+EXPECTED_OUTPUT_FRAGMENT_FILE = "out-{}.log"
+ACTUAL_LOGS_FILE = "actual.log.gz"
+# When the logs of several jobs are uploaded, they're named after each job instead.
+ACTUAL_JOB_LOGS_FILE = "actual-{}.log.gz"
+LATEST_JOB = "latest"
+ALL_JOBS = "all"
+JOB_POLICIES = (LATEST_JOB, ALL_JOBS)
+
+
+logger = logging.getLogger("naacl_utils")
+
+
+def get_beaker_client(token: Optional[str] = None) -> "NaaclBeaker":
+    from .client import NaaclBeaker
+
+    logger.debug("Initializing beaker client")
+    with profiler.span("client init"):
+        if token is not None:
+            beaker = NaaclBeaker.from_env(user_token=token)
+        else:
+            beaker = NaaclBeaker.from_env()
+        beaker.config.agent_address = BEAKER_ADDRESS
+        beaker.config.default_org = BEAKER_ORG
+        beaker.config.default_workspace = f"{BEAKER_ORG}/{beaker.user}"
+    return beaker
+
+
+def get_configured_beaker_client(token: Optional[str] = None) -> "NaaclBeaker":
+    from beaker import ConfigurationError
+
+    try:
+        return get_beaker_client(token)
+    except ConfigurationError:
+        raise NaaclUtilsError(
+            "Beaker client not properly configured, did you forget to run the 'naacl-utils setup' command?",
+        )
+
+
+def insert_link(link: str) -> str:
+    return f"[underline blue][link={link}]{link}[/][/]"
+
+
+def check_beaker_permissions(beaker: "NaaclBeaker", use_cache: bool = True):
+    from beaker import HTTPError
+
+    workspace = beaker.config.default_workspace
+    assert workspace is not None
+    if use_cache and beaker.has_cached_permissions(workspace):
+        logger.debug("Using cached beaker permissions")
+        return
+
+    logger.debug("Checking beaker permissions")
+    try:
+        # This will fail with a 403 if user doesn't have access to the NAACL organization.
+        with profiler.span("permission check"):
+            beaker.ensure_workspace(workspace)
+    except HTTPError as exc:
+        if exc.response.status_code == 403:
+            raise NaaclUtilsError(
+                "Unable to access NAACL organization on Beaker. Did you complete all of the steps?\n\n"
+                f"  {insert_link(TUTORIAL_URL)}\n\n"
+                "If so, and you're still seeing this error, please submit a bug report here:\n\n"
+                f"  {insert_link(BUG_REPORT_URL)}"
+            )
+        # Other errors don't tell us anything about the permissions, so we don't cache anything.
+        logger.debug("Unable to check beaker permissions", exc_info=sys.exc_info())
+        return
+    beaker.cache_permissions(workspace)
+
+
+async def check_beaker_permissions_during(aio: "AsyncBeaker", awaitable: Awaitable[T]) -> T:
+    """
+    Check the permissions of the user while ``awaitable`` runs, since they're independent
+    requests. If the check fails, its error is raised instead of any error from ``awaitable``,
+    which would most likely just be a less helpful symptom of the same problem.
+    """
+    import asyncio
+
+    check, result = await asyncio.gather(
+        aio.call(check_beaker_permissions, aio.beaker), awaitable, return_exceptions=True
+    )
+    for outcome in (check, result):
+        if isinstance(outcome, BaseException):
+            raise outcome
+    return cast(T, result)
+
+
+def validate_run_name(run_name: str):
+    if not run_name.replace("-", "").isalnum():
+        raise NaaclUtilsError(
+            f"Invalid run name '{run_name}'. Names can only contain letters, digits, and dashes."
+        )
+    if len(run_name) > 100:
+        raise NaaclUtilsError("Run name is too long!")
+
+
+def validate_run_names(run_names: Iterable[str]):
+    """
+    Validate the names of many runs, which also have to be distinct.
+    """
+    seen_run_names = set()
+    for run_name in run_names:
+        validate_run_name(run_name)
+        if run_name in seen_run_names:
+            raise NaaclUtilsError(f"Run name '{run_name}' appears more than once")
+        seen_run_names.add(run_name)
+
+
+def validate_expected_output(expected_output_lines: List[str]):
+    for line in expected_output_lines:
+        if line:
+            break
+    else:
+        raise NaaclUtilsError("Expected output file has no content")
+
+
+def validate_max_memory(max_memory: int, fragments: Sequence[Sequence[str]] = ()):
+    """
+    Check that a memory budget for processing logs is big enough, both in general and for
+    matching the longest line of the ``fragments`` of expected output, which has to fit
+    within the part of long log lines that's kept.
+    """
+    if max_memory < MIN_MAX_MEMORY:
+        raise NaaclUtilsError(
+            f"The memory budget of {max_memory} bytes is too small, "
+            f"it needs to be at least {MIN_MAX_MEMORY} bytes"
+        )
+    longest = max((len(line.encode()) for fragment in fragments for line in fragment), default=0)
+    if longest > max_line_size(max_memory) // 4:
+        raise NaaclUtilsError(
+            f"The expected output has a line of {longest} bytes, which needs a memory budget "
+            f"of at least {longest * 4 * 8} bytes"
+        )
+
+
+def upload_image(
+    beaker: "NaaclBeaker",
+    image: str,
+    reuse: bool = True,
+    before_upload: Optional[Callable[[], Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Upload a local Docker image to Beaker under a new name, unless the exact same image
+    has already been uploaded and ``reuse`` is ``True``.
+
+    If the image does have to be uploaded, ``before_upload`` is called first, and it can raise
+    an error to stop the upload.
+    """
+    from beaker import ImageNotFound
+
+    with profiler.span("get image digest"):
+        digest = beaker.get_image_digest(image)
+    if reuse:
+        logger.debug("Checking if image has already been uploaded")
+        with profiler.span("find uploaded image"):
+            uploaded_image = beaker.find_uploaded_image(digest)
+        if uploaded_image is not None:
+            logger.info("Reusing previously uploaded image %s", uploaded_image["id"])
+            return uploaded_image
+
+    if before_upload is not None:
+        before_upload()
+
+    beaker_image = image.replace(":", "-").replace("/", "-") + "-" + str(uuid.uuid4())[:4]
+    try:
+        logger.debug("Checking if image already exists")
+        # Make sure an image with this name doesn't exist on Beaker.
+        # It's unlikely because we add a random sequence of characters to the end of the name,
+        # but possible.
+        with profiler.span("get image"):
+            image_data = beaker.get_image(f"{beaker.user}/{beaker_image}")
+        # If it does exist, we'll delete it.
+        logger.debug("Removing existing image")
+        with profiler.span("delete image"):
+            beaker.delete_image(image_data["id"])
+    except ImageNotFound:
+        pass
+
+    # (Re-)create image.
+    logger.debug("Creating image")
+    with profiler.span("upload image") as span:
+        image_data = beaker.create_image(
+            name=beaker_image,
+            image_tag=image,
+        )
+        if profiler.enabled:
+            image_size = beaker.get_image_size(image)
+            if image_size is not None:
+                span.add_bytes(image_size)
+    beaker.record_uploaded_image(digest, image_data["id"])
+    return image_data
+
+
+def create_experiment(
+    beaker: "NaaclBeaker", image_id: str, run_name: str, tasks: Sequence[TaskSpec]
+) -> Dict[str, Any]:
+    """
+    Submit an experiment for a Beaker image that has already been uploaded.
+    """
+    from beaker import ExperimentConflict
+
+    try:
+        logger.debug("Submitting experiment")
+        with profiler.span("create experiment"):
+            experiment = beaker.create_experiment(
+                run_name, make_experiment_spec(image_id, tasks, BEAKER_CLUSTER)
+            )
+    except ExperimentConflict:
+        raise NaaclUtilsError(
+            f"A run with the name '{run_name}' already exists, try using a different name.",
+        )
+    return experiment
+
+
+def check_run_name_available(beaker: "NaaclBeaker", run_name: str):
+    """
+    Make sure that the user doesn't have a run called ``run_name`` yet, so that nothing
+    is uploaded for a run that can't be submitted.
+    """
+    from beaker import ExperimentNotFound
+
+    try:
+        with profiler.span("check run name"):
+            find_experiment(beaker, run_name, must_exist=False)
+    except ExperimentNotFound:
+        return
+    raise NaaclUtilsError(
+        f"A run with the name '{run_name}' already exists, try using a different name.",
+    )
+
+
+def read_expected_output(expected_output_file: IO[str]) -> List[str]:
+    """
+    Read and validate the lines of an expected output file.
+    """
+    expected_output_lines = [line.rstrip() for line in expected_output_file.readlines()]
+    # Make sure the expected output isn't empty or something.
+    validate_expected_output(expected_output_lines)
+    return expected_output_lines
+
+
+def find_experiment(
+    beaker: "NaaclBeaker", run_name: str, must_exist: bool = True
+) -> Dict[str, Any]:
+    """
+    Find the experiment for a run.
+
+    If there's no such run, a :class:`~naacl_utils.exceptions.NaaclUtilsError` is raised, or
+    the :class:`~beaker.ExperimentNotFound` error if ``must_exist`` is ``False``.
+    """
+    from beaker import ExperimentNotFound
+
+    try:
+        with profiler.span("find experiment"):
+            experiment = beaker.get_experiment(f"{beaker.user}/{run_name}")
+    except ExperimentNotFound:
+        if not must_exist:
+            raise
+        raise NaaclUtilsError(
+            f"Could not find a run with the name '{run_name}'. Are you sure that's the correct name?"
+        )
+    return experiment
+
+
+def select_jobs(
+    experiment: Dict[str, Any],
+    run_name: str,
+    policy: str = LATEST_JOB,
+    task: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Choose the jobs of a run's experiment to verify. Every task of the experiment has a job,
+    and a task that failed can be retried, which adds another job for it. With a ``task``
+    name, only the jobs of that task are considered, e.g. when the tasks of a run print
+    different results.
+
+    The latest job of every task has to have completed successfully. With the ``"latest"``
+    policy, those are the jobs to verify, one for each task. With ``"all"``, every job that
+    completed successfully is verified, oldest first, including earlier runs of a task that
+    was run more than once.
+    """
+    if policy not in JOB_POLICIES:
+        raise NaaclUtilsError(
+            f"Invalid job policy '{policy}', expected one of: {', '.join(JOB_POLICIES)}"
+        )
+    if task is not None:
+        task_names = list(dict.fromkeys(job_task_name(job) for job in sorted_jobs(experiment)))
+        if task not in task_names:
+            raise NaaclUtilsError(
+                f"Run '{run_name}' has no task named '{task}', its tasks are: "
+                + ", ".join(f"'{name}'" for name in task_names if name is not None)
+            )
+        experiment = {
+            **experiment,
+            "jobs": [job for job in sorted_jobs(experiment) if job_task_name(job) == task],
+        }
+    latest = latest_jobs(experiment)
+    failed = [job for job in latest if job.get("status", {}).get("exitCode") != 0]
+    if not latest or failed:
+        if len(latest) > 1:
+            raise NaaclUtilsError(
+                f"Can only verify submissions that have completed successfully, but "
+                f"{len(failed)} of the {len(latest)} tasks of run '{run_name}' didn't."
+            )
+        raise NaaclUtilsError("Can only verify submissions that have completed successfully.")
+    if policy == LATEST_JOB:
+        return latest
+    return [job for job in sorted_jobs(experiment) if job.get("status", {}).get("exitCode") == 0]
+
+
+def get_completed_experiment(
+    beaker: "NaaclBeaker",
+    run_name: str,
+    experiment: Optional[Dict[str, Any]] = None,
+    jobs: str = LATEST_JOB,
+    task: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Find the experiment for a run, unless it's already given, and make sure that the ``jobs``
+    to verify finished successfully, see :func:`select_jobs()`.
+    """
+    if experiment is None:
+        experiment = find_experiment(beaker, run_name)
+    select_jobs(experiment, run_name, jobs, task=task)
+    return experiment
+
+
+def read_logs(
+    beaker: "NaaclBeaker",
+    exp_id: str,
+    job_id: Optional[str] = None,
+    copy_to: Optional[IO[bytes]] = None,
+) -> Generator[bytes, None, None]:
+    """
+    Stream the raw logs of a job of an experiment. The ``job_id`` is needed if the experiment has
+    more than one job, and otherwise saves looking up the experiment to find it.
+
+    The logs of completed jobs never change, so they're read from the log cache when possible,
+    keyed by the job ID if it's given. Logs are only added to the cache when they've been
+    downloaded in full, but the progress of an interrupted download is kept so that it can be
+    resumed.
+
+    Logs that are downloaded are also written to ``copy_to``, gzipped, as they're read.
+    That's for reading them again with :func:`read_log_copy()` when the log cache is disabled
+    or too small to keep them.
+    """
+    log_cache = cache.LogCache()
+    key = job_id or exp_id
+    chunks = log_cache.read(key)
+    if chunks is not None:
+        return profiler.iter_chunks("read cached logs", chunks)
+    chunks = log_cache.download(
+        key,
+        lambda offset: profiler.iter_chunks(
+            "download logs", beaker.get_logs_for_experiment(exp_id, job_id, offset=offset)
+        ),
+    )
+    if copy_to is None:
+        return chunks
+    return _copy_chunks(chunks, copy_to)
+
+
+def _copy_chunks(
+    chunks: Generator[bytes, None, None], copy_to: IO[bytes]
+) -> Generator[bytes, None, None]:
+    import gzip
+
+    try:
+        # It's only a temporary copy, so speed matters more than size.
+        with gzip.GzipFile(fileobj=copy_to, mode="wb", compresslevel=1) as copy_file:
+            for chunk in chunks:
+                copy_file.write(chunk)
+                yield chunk
+    finally:
+        chunks.close()
+
+
+def read_log_copy(log_copy: IO[bytes]) -> Generator[bytes, None, None]:
+    """
+    Stream the raw logs from a gzipped copy that was written by :func:`read_logs()`.
+    """
+    import gzip
+
+    log_copy.seek(0)
+    with gzip.GzipFile(fileobj=log_copy, mode="rb") as copy_file:
+        while True:
+            chunk = copy_file.read(cache.LogCache.CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def match_logs(
+    beaker: "NaaclBeaker",
+    exp_id: str,
+    fragments: List[List[str]],
+    ordered: bool = False,
+    read_all: bool = False,
+    job_id: Optional[str] = None,
+    max_memory: int = DEFAULT_MAX_MEMORY,
+    copy_to: Optional[IO[bytes]] = None,
+) -> FragmentMatcher:
+    """
+    Stream the logs of an experiment through a matcher, stopping the download as soon as we
+    find every fragment of expected output. The logs are fed to the matcher a buffer at a time,
+    so most lines are never decoded, and lines that are too long for ``max_memory`` are
+    truncated.
+
+    If ``read_all`` is ``True``, the rest of the logs are still read after a match so that
+    they end up in the log cache, or in ``copy_to``, see :func:`read_logs()`.
+    """
+    matcher = FragmentMatcher(fragments, ordered=ordered)
+    with profiler.span("match logs"):
+        chunks = read_logs(beaker, exp_id, job_id, copy_to=copy_to)
+        try:
+            for buffer in iter_log_buffers(chunks, max_line_size=max_line_size(max_memory)):
+                if matcher.feed_buffer(buffer):
+                    break
+            if read_all:
+                for _ in chunks:
+                    pass
+        finally:
+            chunks.close()
+    return matcher
+
+
+def record_logs(
+    beaker: "NaaclBeaker",
+    exp_id: str,
+    recorder: LogRecorder,
+    job_id: Optional[str] = None,
+    max_memory: int = DEFAULT_MAX_MEMORY,
+    log_copy: Optional[IO[bytes]] = None,
+):
+    """
+    Pass every line of the logs of an experiment to the ``recorder``, with lines that are
+    too long for ``max_memory`` truncated. The logs are read from ``log_copy`` if it's given,
+    see :func:`read_logs()`.
+    """
+    with profiler.span("record logs"):
+        chunks = (
+            read_log_copy(log_copy) if log_copy is not None else read_logs(beaker, exp_id, job_id)
+        )
+        try:
+            for line in iter_log_lines(chunks, max_line_size=max_line_size(max_memory)):
+                recorder.add(line)
+        finally:
+            chunks.close()
+
+
+def upload_results(
+    beaker: "NaaclBeaker",
+    run_name: str,
+    fragments: List[List[str]],
+    job_logs: Optional[Dict[str, Iterable[bytes]]] = None,
+    max_memory: int = DEFAULT_MAX_MEMORY,
+):
+    """
+    Upload the verified fragments of expected output to a Beaker dataset named after the run.
+    If the raw logs of its jobs are given in ``job_logs``, by job ID, they're uploaded to
+    the same dataset too, gzipped and without timestamps, with lines that are too long for
+    ``max_memory`` truncated.
+    """
+    with profiler.span("upload results") as span:
+        files: Dict[str, Union[bytes, Iterable[bytes]]] = {}
+        for i, expected_output_lines in enumerate(fragments, start=1):
+            expected_output = "\n".join(expected_output_lines).encode()
+            span.add_bytes(len(expected_output))
+            name = (
+                EXPECTED_OUTPUT_FILE
+                if len(fragments) == 1
+                else EXPECTED_OUTPUT_FRAGMENT_FILE.format(i)
+            )
+            files[name] = expected_output
+        job_logs = job_logs or {}
+        for job_id, log_chunks in job_logs.items():
+            name = ACTUAL_LOGS_FILE if len(job_logs) == 1 else ACTUAL_JOB_LOGS_FILE.format(job_id)
+            files[name] = profiler.iter_chunks(
+                "compress logs",
+                compress_lines(iter_log_lines(log_chunks, max_line_size=max_line_size(max_memory))),
+            )
+        beaker.upload_dataset(run_name, files, force=True)
+
+
+@dataclass
+class JobResult:
+    """
+    The outcome of verifying the logs of one job of a run.
+    """
+
+    job: Dict[str, Any]
+    matcher: FragmentMatcher
+    """
+    Where each fragment was found in the logs of the job, if it was.
+    """
+
+    found_in_any_job: FrozenSet[int] = frozenset()
+    """
+    When it's enough for each fragment to be in the logs of any of the jobs, the ones that
+    were found in some job. They don't have to be in the logs of this one.
+    """
+    log_copy: Optional[IO[bytes]] = None
+    """
+    A gzipped copy of the logs of the job, kept when they'll have to be read again but
+    couldn't be kept in the log cache, see :func:`read_logs()`.
+    """
+
+    @property
+    def job_id(self) -> str:
+        return self.job["id"]
+
+    @property
+    def missing(self) -> List[int]:
+        """
+        The indices of the fragments that should have been found in the logs of the job but weren't.
+        """
+        return [k for k in self.matcher.missing if k not in self.found_in_any_job]
+
+    @property
+    def verified(self) -> bool:
+        return self.matcher.matched or not self.missing
+
+
+@dataclass
+class VerifyResult:
+    """
+    The outcome of verifying a run with :meth:`Session.verify()`.
+    """
+
+    run_name: str
+    experiment: Dict[str, Any]
+    fragments: List[List[str]]
+    """
+    The lines of each fragment of expected output.
+    """
+    jobs: List[JobResult]
+    """
+    The result for each job that was verified, see :func:`select_jobs()`.
+    """
+    max_memory: int = DEFAULT_MAX_MEMORY
+    """
+    The memory budget that the logs of each job were processed with.
+    """
+
+    @property
+    def verified(self) -> bool:
+        """
+        Whether every fragment was found in the logs of every job, or of any job if that's all
+        that was asked for, in which case the results have been uploaded.
+        """
+        return all(job.verified for job in self.jobs)
+
+    @property
+    def failed_jobs(self) -> List[JobResult]:
+        return [job for job in self.jobs if not job.verified]
+
+
+class Session:
+    """
+    An authenticated Beaker client along with everything learned while using it, so that
+    driving many runs from one process only costs the requests that each run needs.
+
+    The client is created the first time it's needed, from the configuration saved
+    by ``naacl-utils setup`` unless a user ``token`` is given, and the permissions of the user
+    are checked at most once. At most ``workers`` requests run at once.
+
+    A session can be used from several threads at once, and from async code, e.g. in a Jupyter
+    notebook, although its methods block until they're done.
+    """
+
+    def __init__(self, token: Optional[str] = None, workers: int = DEFAULT_WORKERS):
+        self.token = token
+        self.workers = workers
+        self._beaker: Optional["NaaclBeaker"] = None
+        self._beaker_lock = threading.Lock()
+        self._permissions_checked = False
+
+    @property
+    def beaker(self) -> "NaaclBeaker":
+        with self._beaker_lock:
+            if self._beaker is None:
+                self._beaker = get_configured_beaker_client(self.token)
+            return self._beaker
+
+    def check_permissions(self):
+        """
+        Make sure the user has access to the NAACL organization on Beaker.
+        """
+        if not self._permissions_checked:
+            check_beaker_permissions(self.beaker)
+            self._permissions_checked = True
+
+    def submit(
+        self,
+        image: str,
+        run_name: str,
+        tasks: Optional[Sequence[TaskSpec]] = None,
+        force_upload: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Upload a local Docker image, unless the exact same image has been uploaded before
+        and ``force_upload`` is ``False``, and submit an experiment that runs it as ``tasks``.
+        By default, there's one task that runs the image as is.
+
+        Returns the new Beaker experiment.
+        """
+        validate_run_name(run_name)
+        tasks = list(tasks) if tasks is not None else [TaskSpec()]
+        # Check the tasks before uploading anything.
+        validate_tasks(tasks)
+        beaker = self.beaker
+        # Creating the image fails before anything is pushed if the user doesn't have access,
+        # so the upload doesn't need to wait for the permission check. If the run already exists,
+        # that's caught before the upload too.
+        image_data = self._run(
+            lambda async_beaker: self._check_permissions_during(
+                async_beaker,
+                async_beaker.call(
+                    upload_image,
+                    beaker,
+                    image,
+                    reuse=not force_upload,
+                    before_upload=functools.partial(check_run_name_available, beaker, run_name),
+                ),
+            )
+        )
+        return create_experiment(beaker, image_data["id"], run_name, tasks)
+
+    def submit_many(
+        self, runs: Sequence[Tuple[str, str, Sequence[TaskSpec]]], force_upload: bool = False
+    ) -> List[Union[Dict[str, Any], BaseException]]:
+        """
+        Submit many runs at once, each given as an ``(image, run_name, tasks)`` tuple.
+        Each distinct image is only uploaded once, even if it's used by many runs.
+
+        Returns either the new Beaker experiment or the error for each run, in order.
+        """
+        for _, run_name, tasks in runs:
+            validate_run_name(run_name)
+            validate_tasks(tasks)
+        beaker = self.beaker
+        taken_run_names: Dict[str, NaaclUtilsError] = {}
+
+        def check_run_names(image: str):
+            run_names = [run_name for run_image, run_name, _ in runs if run_image == image]
+            for run_name in run_names:
+                try:
+                    check_run_name_available(beaker, run_name)
+                except NaaclUtilsError as exc:
+                    taken_run_names[run_name] = exc
+            if all(run_name in taken_run_names for run_name in run_names):
+                raise NaaclUtilsError(f"Every run for image '{image}' already exists")
+
+        async def submit_all(
+            async_beaker: "AsyncBeaker",
+        ) -> List[Union[Dict[str, Any], BaseException]]:
+            import asyncio
+
+            images = sorted({image for image, _, _ in runs})
+            logger.debug("Uploading %d image(s)", len(images))
+            # Errors are collected rather than raised, so that every upload is waited for and
+            # a failed upload only fails the runs that need its image.
+            uploads = await self._check_permissions_during(
+                async_beaker,
+                asyncio.gather(
+                    *(
+                        async_beaker.call(
+                            upload_image,
+                            beaker,
+                            image,
+                            not force_upload,
+                            before_upload=functools.partial(check_run_names, image),
+                        )
+                        for image in images
+                    ),
+                    return_exceptions=True,
+                ),
+            )
+            image_uploads = dict(zip(images, uploads))
+
+            async def submit_run(run: Tuple[str, str, Sequence[TaskSpec]]) -> Dict[str, Any]:
+                image, run_name, tasks = run
+                if run_name in taken_run_names:
+                    raise taken_run_names[run_name]
+                image_data = image_uploads[image]
+                if isinstance(image_data, BaseException):
+                    raise image_data
+                return await async_beaker.call(
+                    create_experiment, beaker, image_data["id"], run_name, tasks
+                )
+
+            logger.debug("Submitting %d experiment(s)", len(runs))
+            return await asyncio.gather(*map(submit_run, runs), return_exceptions=True)
+
+        return self._run(submit_all)
+
+    def find(self, run_name: str) -> Dict[str, Any]:
+        """
+        Find the Beaker experiment for a run.
+        """
+        validate_run_name(run_name)
+        beaker = self.beaker
+        return self._run(
+            lambda async_beaker: self._check_permissions_during(
+                async_beaker, async_beaker.call(find_experiment, beaker, run_name)
+            )
+        )
+
+    def wait(
+        self,
+        run_names: Sequence[str],
+        timeout: Optional[float] = None,
+        return_exceptions: bool = False,
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        Wait for runs to finish, yielding the name and Beaker experiment of each one as soon as
+        it does. Raises a :class:`~naacl_utils.exceptions.NaaclUtilsError` if they haven't all
+        finished after ``timeout`` seconds.
+
+        With ``return_exceptions``, a run that can't be looked up is yielded with its error
+        instead of the error being raised.
+        """
+        for run_name in run_names:
+            validate_run_name(run_name)
+        self.check_permissions()
+        with profiler.span("wait"):
+            yield from wait_for_experiments(
+                functools.partial(find_experiment, self.beaker),
+                list(dict.fromkeys(run_names)),
+                timeout=timeout,
+                workers=self.workers,
+                return_exceptions=return_exceptions,
+            )
+
+    def verify(
+        self,
+        run_name: str,
+        fragments: Sequence[Sequence[str]],
+        ordered: bool = False,
+        upload_logs: bool = False,
+        experiment: Optional[Dict[str, Any]] = None,
+        max_memory: int = DEFAULT_MAX_MEMORY,
+        jobs: str = LATEST_JOB,
+        task: Optional[str] = None,
+        any_job: bool = False,
+    ) -> VerifyResult:
+        """
+        Look for the fragments of expected output, given as lists of lines, in the logs of
+        a run that completed successfully, in one pass over the logs. With ``ordered``,
+        they have to appear in the given order.
+
+        The ``jobs`` policy chooses which jobs of the run to verify, only among the jobs of
+        the ``task`` with that name if it's given, see :func:`select_jobs()`. The logs of
+        the jobs are downloaded and matched concurrently, and the result of each one is
+        reported separately.
+
+        If every fragment is found in the logs of every job, or of any one of them with
+        ``any_job``, e.g. for tasks that print different results, they're uploaded as
+        the results of the run, along with the logs with ``upload_logs``. The run's Beaker
+        ``experiment`` is looked up unless it's given.
+
+        The logs are streamed, so they take up at most about ``max_memory`` bytes no matter
+        how big they are, which is split between the jobs that are matched at once.
+        Log lines longer than an eighth of each share are truncated.
+        """
+        fragment_lines = self._validate_verify(
+            run_name, fragments, max_memory, ordered=ordered, any_job=any_job
+        )
+        return self._run(
+            lambda async_beaker: self._check_permissions_during(
+                async_beaker,
+                self._verify(
+                    async_beaker,
+                    run_name,
+                    fragment_lines,
+                    ordered=ordered,
+                    upload_logs=upload_logs,
+                    experiment=experiment,
+                    max_memory=max_memory,
+                    jobs=jobs,
+                    task=task,
+                    any_job=any_job,
+                ),
+            )
+        )
+
+    def verify_many(
+        self,
+        runs: Iterable[Tuple[str, Sequence[Sequence[str]], bool, Optional[Dict[str, Any]]]],
+        upload_logs: bool = False,
+        max_memory: int = DEFAULT_MAX_MEMORY,
+        jobs: str = LATEST_JOB,
+        task: Optional[str] = None,
+        any_job: bool = False,
+    ) -> List[Union[VerifyResult, BaseException]]:
+        """
+        Verify many runs at once, each given as a ``(run_name, fragments, ordered, experiment)``
+        tuple like the arguments of :meth:`verify()`. The ``runs`` can come from a generator
+        that blocks, e.g. one that yields each run as soon as it finishes, and every run is
+        verified as soon as it's produced.
+
+        All of the runs share one pool of ``workers`` threads, so at most that many logs are
+        processed at once, each within an equal share of ``max_memory``.
+
+        Returns either the result or the error for each run, in the order they were produced.
+        """
+        max_memory_per_job = max_memory // self.workers
+        validate_max_memory(max_memory_per_job)
+
+        async def verify_run(
+            async_beaker: "AsyncBeaker",
+            run: Tuple[str, Sequence[Sequence[str]], bool, Optional[Dict[str, Any]]],
+        ) -> VerifyResult:
+            run_name, fragments, ordered, experiment = run
+            fragment_lines = self._validate_verify(
+                run_name, fragments, max_memory_per_job, ordered=ordered, any_job=any_job
+            )
+            return await self._verify(
+                async_beaker,
+                run_name,
+                fragment_lines,
+                ordered=ordered,
+                upload_logs=upload_logs,
+                experiment=experiment,
+                max_memory=max_memory_per_job,
+                jobs=jobs,
+                task=task,
+                any_job=any_job,
+                max_memory_per_job=max_memory_per_job,
+            )
+
+        async def verify_all(
+            async_beaker: "AsyncBeaker",
+        ) -> List[Union[VerifyResult, BaseException]]:
+            import asyncio
+            from concurrent.futures import ThreadPoolExecutor
+
+            loop = asyncio.get_event_loop()
+            run_iterator = iter(runs)
+            verifications: List[asyncio.Future] = []
+            # The runs get a thread of their own, so that a generator that blocks doesn't hold up
+            # the verifications.
+            with ThreadPoolExecutor(max_workers=1) as producer:
+                try:
+                    while True:
+                        run: Optional[
+                            Tuple[str, Sequence[Sequence[str]], bool, Optional[Dict[str, Any]]]
+                        ] = await loop.run_in_executor(producer, next, run_iterator, None)
+                        if run is None:
+                            break
+                        verifications.append(asyncio.ensure_future(verify_run(async_beaker, run)))
+                except BaseException:
+                    for verification in verifications:
+                        verification.cancel()
+                    raise
+            return await asyncio.gather(*verifications, return_exceptions=True)
+
+        return self._run(
+            lambda async_beaker: self._check_permissions_during(
+                async_beaker, verify_all(async_beaker)
+            )
+        )
+
+    def record_logs(
+        self, result: VerifyResult, recorder: LogRecorder, job_id: Optional[str] = None
+    ):
+        """
+        Pass every line of the logs of a job of a verified run to the ``recorder``, e.g. to find
+        out why verification failed. That's the first job that failed verification, unless
+        the ``job_id`` is given. The logs are read from the log cache or the copy kept while
+        verifying when possible.
+        """
+        if job_id is None:
+            job_id = (result.failed_jobs or result.jobs)[0].job_id
+        log_copy = next((job.log_copy for job in result.jobs if job.job_id == job_id), None)
+        record_logs(
+            self.beaker,
+            result.experiment["id"],
+            recorder,
+            job_id=job_id,
+            max_memory=result.max_memory,
+            log_copy=log_copy,
+        )
+
+    def status(self) -> List[Dict[str, Any]]:
+        """
+        Get the status of every run of the user, see :func:`~naacl_utils.status.get_run_statuses()`.
+        """
+        with profiler.span("get run statuses"):
+            return self._run(
+                lambda async_beaker: self._check_permissions_during(
+                    async_beaker, get_run_statuses(async_beaker)
+                )
+            )
+
+    def _validate_verify(
+        self,
+        run_name: str,
+        fragments: Sequence[Sequence[str]],
+        max_memory: int,
+        ordered: bool = False,
+        any_job: bool = False,
+    ) -> List[List[str]]:
+        validate_run_name(run_name)
+        if ordered and any_job:
+            raise NaaclUtilsError(
+                "Fragments of expected output can't be ordered when they can be in any job"
+            )
+        fragment_lines = [[line.rstrip() for line in fragment] for fragment in fragments]
+        for expected_output_lines in fragment_lines:
+            validate_expected_output(expected_output_lines)
+        validate_max_memory(max_memory, fragment_lines)
+        return fragment_lines
+
+    async def _verify(
+        self,
+        async_beaker: "AsyncBeaker",
+        run_name: str,
+        fragment_lines: List[List[str]],
+        ordered: bool = False,
+        upload_logs: bool = False,
+        experiment: Optional[Dict[str, Any]] = None,
+        max_memory: int = DEFAULT_MAX_MEMORY,
+        jobs: str = LATEST_JOB,
+        task: Optional[str] = None,
+        any_job: bool = False,
+        max_memory_per_job: Optional[int] = None,
+    ) -> VerifyResult:
+        """
+        Verify a run, with every blocking call on the pool of ``async_beaker``. Unless it's
+        given, ``max_memory_per_job`` is an equal share of ``max_memory`` for each of the jobs
+        that are matched at once.
+        """
+        import asyncio
+
+        beaker = self.beaker
+        completed_experiment = await async_beaker.call(
+            get_completed_experiment, beaker, run_name, experiment, jobs=jobs, task=task
+        )
+        exp_id = completed_experiment["id"]
+        selected_jobs = select_jobs(completed_experiment, run_name, jobs, task=task)
+        if max_memory_per_job is None:
+            max_memory_per_job = max_memory // min(len(selected_jobs), self.workers)
+        validate_max_memory(max_memory_per_job, fragment_lines)
+
+        # The logs are read again to upload them or to report a mismatch, so copies are kept
+        # of those that might not fit in the log cache.
+        log_cache = cache.LogCache()
+        log_copies = [tempfile.TemporaryFile() for _ in selected_jobs]
+        matchers = await asyncio.gather(
+            *(
+                async_beaker.call(
+                    match_logs,
+                    beaker,
+                    exp_id,
+                    fragment_lines,
+                    ordered=ordered,
+                    read_all=upload_logs,
+                    job_id=job["id"],
+                    max_memory=max_memory_per_job,
+                    copy_to=log_copy,
+                )
+                for job, log_copy in zip(selected_jobs, log_copies)
+            )
+        )
+        found: FrozenSet[int] = frozenset()
+        if any_job:
+            found = frozenset(
+                k
+                for matcher in matchers
+                for k, start in enumerate(matcher.found)
+                if start is not None
+            )
+        job_results = []
+        for job, matcher, log_copy in zip(selected_jobs, matchers, log_copies):
+            job_result = JobResult(job, matcher, found)
+            if (matcher.matched and not upload_logs) or log_cache.contains(job["id"]):
+                log_copy.close()
+            else:
+                job_result.log_copy = log_copy
+            job_results.append(job_result)
+        result = VerifyResult(
+            run_name, completed_experiment, fragment_lines, job_results, max_memory_per_job
+        )
+        if result.verified:
+            await async_beaker.call(
+                upload_results,
+                beaker,
+                run_name,
+                fragment_lines,
+                {
+                    job.job_id: read_log_copy(job.log_copy)
+                    if job.log_copy is not None
+                    else read_logs(beaker, exp_id, job.job_id)
+                    for job in job_results
+                }
+                if upload_logs
+                else None,
+                max_memory=max_memory_per_job,
+            )
+        return result
+
+    def _run(self, func: Callable[["AsyncBeaker"], Awaitable[T]]) -> T:
+        from . import aio
+
+        return aio.run(self.beaker, func, workers=self.workers)
+
+    async def _check_permissions_during(
+        self, async_beaker: "AsyncBeaker", awaitable: Awaitable[T]
+    ) -> T:
+        if self._permissions_checked:
+            return await awaitable
+        result = await check_beaker_permissions_during(async_beaker, awaitable)
+        self._permissions_checked = True
+        return result
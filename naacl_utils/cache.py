@@ -0,0 +1,395 @@
+"""
+A local cache for things that are slow to fetch and rarely change.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+from urllib.parse import quote, unquote
+
+CACHE_DIR_ENV_VAR = "NAACL_UTILS_CACHE_DIR"
+LOG_CACHE_SIZE_ENV_VAR = "NAACL_UTILS_LOG_CACHE_SIZE"
+DEFAULT_LOG_CACHE_SIZE = 2 * 1024**3  # bytes
+
+
+logger = logging.getLogger("naacl_utils")
+
+
+def get_cache_dir() -> Path:
+    """
+    The directory where naacl-utils caches data. This can be set with
+    the ``NAACL_UTILS_CACHE_DIR`` environment variable.
+    """
+    if CACHE_DIR_ENV_VAR in os.environ:
+        return Path(os.environ[CACHE_DIR_ENV_VAR])
+    if "XDG_CACHE_HOME" in os.environ:
+        return Path(os.environ["XDG_CACHE_HOME"]) / "naacl-utils"
+    return Path.home() / ".cache" / "naacl-utils"
+
+
+def read_json(name: str) -> Optional[Any]:
+    """
+    Read a JSON cache entry, returning ``None`` if it doesn't exist or can't be read.
+    """
+    try:
+        with open(get_cache_dir() / name) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(name: str, data: Any):
+    """
+    Atomically write a JSON cache entry, so concurrent readers never see a partial file.
+    If the cache directory can't be written to, the entry is skipped, since everything
+    in the cache can be fetched again.
+    """
+    path = get_cache_dir() / name
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    except OSError as exc:
+        logger.debug("Unable to write %s to the cache: %s", name, exc)
+        return
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(data, tmp_file)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+
+def remove_leftover_temp_files(name: str, max_age: float = 60):
+    """
+    Remove the temporary files of :func:`write_json()` for a cache entry that are older
+    than ``max_age`` seconds, which are left behind when a process is killed while writing.
+    """
+    path = get_cache_dir() / name
+    now = time.time()
+    for tmp_path in path.parent.glob(f".{path.name}.*.tmp"):
+        try:
+            if now - tmp_path.stat().st_mtime > max_age:
+                os.remove(tmp_path)
+        except OSError:
+            # Removed by another process, or the cache is read-only. Either way it's harmless.
+            pass
+
+
+def remove(name: str):
+    """
+    Remove a cache entry if it exists.
+    """
+    try:
+        os.remove(get_cache_dir() / name)
+    except FileNotFoundError:
+        pass
+
+
+def clear(logs_only: bool = False):
+    """
+    Remove cached data. Only the files that naacl-utils creates are removed, so this is safe even
+    if the cache directory is shared with other things.
+    """
+    shutil.rmtree(get_cache_dir() / LogCache.DIRECTORY, ignore_errors=True)
+    if not logs_only:
+        for pattern in ("*.json", ".*.json.*.tmp"):
+            for path in get_cache_dir().glob(pattern):
+                os.remove(path)
+
+
+def get_log_cache_size() -> int:
+    """
+    The maximum total size of the log cache in bytes. This can be set with
+    the ``NAACL_UTILS_LOG_CACHE_SIZE`` environment variable, and setting it to 0 disables the cache.
+    """
+    try:
+        return int(os.environ.get(LOG_CACHE_SIZE_ENV_VAR, DEFAULT_LOG_CACHE_SIZE))
+    except ValueError:
+        logger.warning("Ignoring invalid value for %s", LOG_CACHE_SIZE_ENV_VAR)
+        return DEFAULT_LOG_CACHE_SIZE
+
+
+class LogCache:
+    """
+    A size-bounded cache of compressed logs.
+
+    Logs are stored gzipped, one file per key, and are read back as a stream of chunks so they're
+    never loaded into memory all at once. When the total size grows beyond ``max_size`` bytes the
+    least recently used entries are evicted.
+
+    Interrupted downloads are kept too, see :meth:`download()`, and count towards the size.
+    """
+
+    DIRECTORY = "logs"
+    SUFFIX = ".log.gz"
+    PARTIAL_SUFFIX = ".log.gz.partial"
+    CHUNK_SIZE = 1024 * 1024
+    CHECKPOINT_SIZE = 8 * 1024 * 1024
+
+    # Keys with a download in progress in this process, which have to be left alone.
+    _downloading: Set[str] = set()
+    _downloading_lock = threading.Lock()
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.directory = get_cache_dir() / self.DIRECTORY
+        self.max_size = max_size if max_size is not None else get_log_cache_size()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{quote(key, safe='')}{self.SUFFIX}"
+
+    def contains(self, key: str) -> bool:
+        return self.path(key).is_file()
+
+    def read(self, key: str) -> Optional[Generator[bytes, None, None]]:
+        """
+        Stream the cached logs for ``key``, or return ``None`` if they aren't cached.
+        """
+        path = self.path(key)
+        try:
+            # Mark the entry as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            # The cache directory may be unusable, or only read-only.
+            if not path.is_file():
+                return None
+        logger.debug("Reading logs for %s from cache", key)
+        return self._read_chunks(path)
+
+    def write_through(self, key: str, chunks: Iterable[bytes]) -> Generator[bytes, None, None]:
+        """
+        Pass through ``chunks`` while writing them to the cache. The entry is only added once
+        all of the chunks have been consumed, so stopping early leaves the cache untouched.
+        """
+        if self.max_size <= 0:
+            yield from chunks
+            return
+
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".partial")
+        except OSError as exc:
+            logger.debug("Unable to cache logs for %s: %s", key, exc)
+            yield from chunks
+            return
+        os.close(fd)
+        completed = False
+        try:
+            with gzip.open(tmp_name, "wb", compresslevel=6) as cache_file:
+                for chunk in chunks:
+                    cache_file.write(chunk)
+                    yield chunk
+            completed = True
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            if completed:
+                os.replace(tmp_name, self.path(key))
+                self.evict()
+            else:
+                os.remove(tmp_name)
+
+    def partial_path(self, key: str) -> Path:
+        return self.directory / f"{quote(key, safe='')}{self.PARTIAL_SUFFIX}"
+
+    def download(
+        self, key: str, fetch: Callable[[int], Iterable[bytes]]
+    ) -> Generator[bytes, None, None]:
+        """
+        Like :meth:`write_through()`, but the progress is saved as the logs are downloaded, so that
+        an interrupted download resumes where it stopped the next time.
+
+        ``fetch`` is called with the byte offset to download the logs from. The part that was
+        already downloaded is checked against the checksum saved with it, then streamed from disk
+        before the rest of the logs. If the check fails, the download starts over.
+        """
+        with self._downloading_lock:
+            busy = key in self._downloading
+            if not busy:
+                self._downloading.add(key)
+        if busy or self.max_size <= 0 or not self._writable():
+            yield from self.write_through(key, fetch(0))
+            return
+
+        try:
+            yield from self._download(key, fetch)
+        finally:
+            with self._downloading_lock:
+                self._downloading.discard(key)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """
+        Get the key, path, size, and last access time of every entry, most recently used first.
+        Interrupted downloads are included, with ``partial`` set to ``True``.
+        """
+        entries = []
+        for suffix in (self.SUFFIX, self.PARTIAL_SUFFIX):
+            for path in self.directory.glob(f"*{suffix}"):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append(
+                    {
+                        "key": unquote(path.name[: -len(suffix)]),
+                        "path": path,
+                        "size": stat.st_size,
+                        "last_used": stat.st_mtime,
+                        "partial": suffix == self.PARTIAL_SUFFIX,
+                    }
+                )
+        return sorted(entries, key=lambda entry: entry["last_used"], reverse=True)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits within ``max_size``.
+        """
+        total_size = 0
+        for entry in self.entries():
+            if total_size + entry["size"] <= self.max_size:
+                total_size += entry["size"]
+                continue
+            if entry["partial"]:
+                with self._downloading_lock:
+                    if entry["key"] in self._downloading:
+                        continue
+                    self._remove_partial(entry["key"])
+                logger.debug("Evicting partial logs for %s from cache", entry["key"])
+                continue
+            logger.debug("Evicting logs for %s from cache", entry["key"])
+            try:
+                os.remove(entry["path"])
+            except FileNotFoundError:
+                pass
+
+    def _writable(self) -> bool:
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        except OSError as exc:
+            logger.debug("Unable to create the log cache: %s", exc)
+            return False
+        return os.access(self.directory, os.W_OK)
+
+    def _download(
+        self, key: str, fetch: Callable[[int], Iterable[bytes]]
+    ) -> Generator[bytes, None, None]:
+        partial_path = self.partial_path(key)
+        progress = self._check_partial(key)
+        if progress is None:
+            self._remove_partial(key)
+            offset, digest = 0, hashlib.sha256()
+        else:
+            offset, digest = progress
+            logger.debug("Resuming download of logs for %s from byte %d", key, offset)
+            yield from self._read_chunks(partial_path)
+
+        completed = False
+        with open(partial_path, "ab") as partial_file:
+            chunks = fetch(offset)
+            gzip_file: Optional[gzip.GzipFile] = None
+            checkpoint = offset
+            try:
+                for chunk in chunks:
+                    if gzip_file is None:
+                        # Every checkpoint starts a new gzip member, which are read back as one.
+                        gzip_file = gzip.GzipFile(fileobj=partial_file, mode="wb", compresslevel=6)
+                    gzip_file.write(chunk)
+                    digest.update(chunk)
+                    offset += len(chunk)
+                    yield chunk
+                    if offset - checkpoint >= self.CHECKPOINT_SIZE:
+                        gzip_file.close()
+                        gzip_file = None
+                        self._save_progress(key, offset, partial_file, digest)
+                        checkpoint = offset
+                completed = True
+            finally:
+                close = getattr(chunks, "close", None)
+                if close is not None:
+                    close()
+                if gzip_file is not None:
+                    gzip_file.close()
+                if offset > checkpoint:
+                    self._save_progress(key, offset, partial_file, digest)
+
+        if completed:
+            os.replace(partial_path, self.path(key))
+            remove(self._progress_name(key))
+        self.evict()
+
+    def _progress_name(self, key: str) -> str:
+        return f"{self.DIRECTORY}/{quote(key, safe='')}.progress.json"
+
+    def _save_progress(self, key: str, offset: int, partial_file: IO[bytes], digest: Any):
+        partial_file.flush()
+        os.fsync(partial_file.fileno())
+        write_json(
+            self._progress_name(key),
+            {
+                "offset": offset,
+                "compressed_size": partial_file.tell(),
+                "sha256": digest.hexdigest(),
+            },
+        )
+
+    def _check_partial(self, key: str) -> Optional[Tuple[int, Any]]:
+        """
+        Check that the part of an interrupted download that was saved is intact. If so,
+        returns how many bytes were downloaded and their running checksum.
+        """
+        progress = read_json(self._progress_name(key))
+        if not isinstance(progress, dict):
+            return None
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(self.partial_path(key), "r+b") as partial_file:
+                # Drop anything written after the last checkpoint, which may be incomplete.
+                partial_file.truncate(progress["compressed_size"])
+            for chunk in self._read_chunks(self.partial_path(key)):
+                digest.update(chunk)
+                size += len(chunk)
+        except (OSError, EOFError, zlib.error, KeyError, TypeError):
+            return None
+        if size != progress["offset"] or digest.hexdigest() != progress["sha256"]:
+            logger.warning("Discarding corrupted partial logs for %s", key)
+            return None
+        return size, digest
+
+    def _remove_partial(self, key: str):
+        try:
+            os.remove(self.partial_path(key))
+        except FileNotFoundError:
+            pass
+        remove(self._progress_name(key))
+
+    def _read_chunks(self, path: Path) -> Generator[bytes, None, None]:
+        with gzip.open(path, "rb") as cache_file:
+            while True:
+                chunk = cache_file.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
@@ -0,0 +1,516 @@
+"""
+A Beaker client tailored to naacl-utils.
+
+This module imports ``beaker`` at the top-level, so it should only be imported lazily
+from within the commands that need it.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import closing, contextmanager
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Union,
+)
+from urllib.parse import quote
+
+import docker
+import requests
+import urllib3
+from beaker import (
+    Beaker,
+    Config,
+    DatasetConflict,
+    HTTPError,
+    ImageNotFound,
+    JobNotFound,
+    WorkspaceNotFound,
+)
+from tqdm import tqdm
+
+from . import cache
+from .exceptions import NaaclUtilsError
+from .session import BACKOFF_FACTOR, MAX_RETRIES, get_session
+
+PERMISSIONS_CACHE = "permissions.json"
+IMAGE_INDEX_CACHE = "images.json"
+RUN_STATUS_CACHE = "run-status.json"
+PERMISSIONS_TTL_ENV_VAR = "NAACL_UTILS_PERMISSIONS_TTL"
+DEFAULT_PERMISSIONS_TTL = 24 * 60 * 60  # seconds
+LOG_CHUNK_SIZE = 64 * 1024
+# Seconds to wait for a connection, and for more of the logs, before resuming a log download.
+LOG_DOWNLOAD_TIMEOUT = (10.0, 60.0)
+EXPERIMENT_PAGE_SIZE = 100
+# Streamed files are buffered in memory up to this size before spilling to disk.
+MAX_IN_MEMORY_UPLOAD_SIZE = 16 * 1024 * 1024
+
+
+logger = logging.getLogger("naacl_utils")
+
+# Guard read-modify-write updates of the image index and run status cache between threads.
+_image_index_lock = threading.Lock()
+_run_status_lock = threading.Lock()
+
+
+def get_permissions_ttl() -> float:
+    """
+    How long a successful permissions check is trusted for, in seconds. This can be set with the
+    ``NAACL_UTILS_PERMISSIONS_TTL`` environment variable, and setting it to 0 disables the cache.
+    """
+    try:
+        return float(os.environ.get(PERMISSIONS_TTL_ENV_VAR, DEFAULT_PERMISSIONS_TTL))
+    except ValueError:
+        logger.warning("Ignoring invalid value for %s", PERMISSIONS_TTL_ENV_VAR)
+        return DEFAULT_PERMISSIONS_TTL
+
+
+class NaaclBeaker(Beaker):
+    """
+    A :class:`~beaker.Beaker` client that caches who the user is and whether they have access
+    to their workspace on disk, so that most commands can skip those round-trips.
+
+    Cache entries are keyed by a hash of the user token and Beaker address, and are dropped as soon
+    as a request fails with a 401 or 403, since that means the cached answers may be stale.
+
+    All requests go through one pooled session, see :func:`~naacl_utils.session.get_session()`.
+    """
+
+    def __init__(self, config: Config, session: Optional[requests.Session] = None):
+        super().__init__(config)
+        self.session = session if session is not None else get_session()
+        self._user: Optional[str] = None
+        # Workspaces that are known to exist, so they don't need to be checked again.
+        self._existing_workspaces: Set[str] = set()
+        self._workspace_lock = threading.Lock()
+
+    @property
+    def user(self) -> str:
+        if self._user is None:
+            entry = self._read_cache_entry()
+            if entry.get("user") is not None and self._is_fresh(entry.get("user_checked_at")):
+                logger.debug("Using cached beaker user")
+                self._user = entry["user"]
+            else:
+                self._user = self.whoami()["name"]
+                self._update_cache_entry(user=self._user, user_checked_at=time.time())
+        assert self._user is not None
+        return self._user
+
+    @contextmanager
+    def _session_with_backoff(self) -> Iterator[requests.Session]:
+        # The base client creates a new session for every request, which means a new connection
+        # (and TLS handshake) every time. We reuse one session instead.
+        yield self.session
+
+    def request(self, *args, **kwargs):
+        try:
+            return super().request(*args, **kwargs)
+        except HTTPError as exc:
+            self._handle_http_error(exc)
+            raise
+
+    def get_logs_for_experiment(
+        self, exp_id: str, job_id: Optional[str] = None, offset: int = 0
+    ) -> Generator[bytes, None, None]:
+        """
+        Like :meth:`Beaker.get_logs_for_experiment()`, but the logs can start from
+        the byte ``offset``, see :meth:`get_logs()`.
+        """
+        if job_id is None:
+            jobs = self.get_experiment(exp_id)["jobs"]
+            if len(jobs) > 1:
+                raise ValueError(
+                    f"Experiment {exp_id} has more than 1 job. You need to specify the 'job_id'."
+                )
+            job_id = jobs[0]["id"]
+        return self.get_logs(job_id, offset=offset)
+
+    def get_logs(self, job_id: str, offset: int = 0) -> Generator[bytes, None, None]:
+        """
+        Like :meth:`Beaker.get_logs()`, but the logs are streamed instead of being read
+        into memory all at once before the first chunk is returned, and they start from
+        the byte ``offset``.
+
+        When the connection drops or stalls partway through, the download picks up where it
+        stopped with a range request, so nothing is downloaded twice. It only gives up after
+        several attempts in a row fail without making progress.
+        """
+        failures = 0
+        with tqdm(
+            unit="iB",
+            unit_scale=True,
+            unit_divisor=1024,
+            initial=offset,
+            desc="downloading logs",
+        ) as progress:
+            while True:
+                start = offset
+                try:
+                    with closing(self._get_logs_from(job_id, offset, progress)) as chunks:
+                        for chunk in chunks:
+                            offset += len(chunk)
+                            yield chunk
+                    return
+                except (
+                    requests.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.Timeout,
+                ) as exc:
+                    error: Exception = exc
+                if offset > start:
+                    failures = 0
+                else:
+                    failures += 1
+                    if failures > MAX_RETRIES:
+                        raise NaaclUtilsError(
+                            f"Downloading the logs of job {job_id} failed after {offset} bytes: "
+                            f"{error}\nRun the command again to resume the download."
+                        )
+                    time.sleep(BACKOFF_FACTOR * 2 ** (failures - 1))
+                logger.debug("Log download interrupted at byte %d, resuming (%s)", offset, error)
+
+    def _get_logs_from(
+        self, job_id: str, offset: int, progress: tqdm
+    ) -> Generator[bytes, None, None]:
+        """
+        Make one attempt at downloading the logs of a job from the byte ``offset``.
+        Raises :class:`requests.ConnectionError` if the logs end short, or a timeout error
+        if they stop arriving.
+        """
+        headers = {"Authorization": f"Bearer {self.config.user_token}"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        with self._session_with_backoff() as session:
+            response = session.get(
+                f"{self.base_url}/jobs/{job_id}/logs",
+                headers=headers,
+                stream=True,
+                timeout=LOG_DOWNLOAD_TIMEOUT,
+            )
+        with response:
+            if response.status_code == 404:
+                raise JobNotFound(job_id)
+            if offset and response.status_code == 416:
+                # There's nothing past the offset.
+                return
+            try:
+                response.raise_for_status()
+            except HTTPError as exc:
+                self._handle_http_error(exc)
+                raise
+            # If range requests aren't supported, we get all of the logs and skip the start.
+            skip = offset if response.status_code != 206 else 0
+            content_length = response.headers.get("Content-Length")
+            if content_length is not None:
+                progress.total = offset - skip + int(content_length)
+                progress.refresh()
+            received = 0
+            for chunk in _iter_content(response):
+                received += len(chunk)
+                if skip:
+                    skipped = min(skip, len(chunk))
+                    chunk, skip = chunk[skipped:], skip - skipped
+                if chunk:
+                    progress.update(len(chunk))
+                    yield chunk
+            if content_length is not None and received < int(content_length):
+                raise requests.ConnectionError(
+                    f"Expected {content_length} bytes of logs but received {received}"
+                )
+
+    def has_cached_permissions(self, workspace: str) -> bool:
+        """
+        Check if the user had access to the ``workspace`` recently enough.
+        """
+        if self._is_fresh(self._read_cache_entry().get("workspaces", {}).get(workspace)):
+            # Having had access means the workspace exists.
+            self._existing_workspaces.add(workspace)
+            return True
+        return False
+
+    def ensure_workspace(self, workspace: str):
+        """
+        Like :meth:`Beaker.ensure_workspace()`, but only checks each workspace once.
+        The base client checks every time it creates an image, experiment, or dataset,
+        which is an extra round-trip before each one.
+
+        Concurrent calls wait for each other, so a missing workspace is only created once.
+        """
+        with self._workspace_lock:
+            if workspace in self._existing_workspaces:
+                return
+            super().ensure_workspace(workspace)
+            self._existing_workspaces.add(workspace)
+
+    def cache_permissions(self, workspace: str):
+        """
+        Record that the user currently has access to the ``workspace``.
+        """
+        workspaces = self._read_cache_entry().get("workspaces", {})
+        workspaces[workspace] = time.time()
+        self._update_cache_entry(workspaces=workspaces)
+
+    def invalidate_permissions(self):
+        """
+        Forget everything cached for this user token.
+        """
+        self._existing_workspaces.clear()
+        entries = cache.read_json(PERMISSIONS_CACHE)
+        if isinstance(entries, dict) and entries.pop(self._cache_key, None) is not None:
+            logger.debug("Invalidating cached beaker permissions")
+            cache.write_json(PERMISSIONS_CACHE, entries)
+
+    def iter_experiment_pages(
+        self, workspace: Optional[str] = None, page_size: Optional[int] = None
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Page through all of the experiments in a workspace, yielding each page as soon as
+        it arrives. The base client's :meth:`Beaker.list_experiments()` only gets the first page.
+        """
+        workspace_name = workspace or self.config.default_workspace
+        if workspace_name is None:
+            raise ValueError("'workspace' argument required")
+        cursor: Optional[str] = None
+        while True:
+            query = {"limit": str(page_size or EXPERIMENT_PAGE_SIZE)}
+            if cursor:
+                query["cursor"] = cursor
+            data = self.request(
+                f"workspaces/{quote(workspace_name, safe='')}/experiments",
+                query=query,
+                exceptions_for_status={404: WorkspaceNotFound(workspace_name)},
+            ).json()
+            yield data.get("data") or []
+            cursor = data.get("nextCursor")
+            if not cursor:
+                return
+
+    def list_experiments(self, workspace: Optional[str] = None) -> List[Dict[str, Any]]:
+        return [experiment for page in self.iter_experiment_pages(workspace) for experiment in page]
+
+    def get_cached_run_statuses(self, workspace: str) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the statuses of the runs in a workspace that were cached with
+        :meth:`cache_run_statuses()`, by experiment ID.
+        """
+        entries = cache.read_json(RUN_STATUS_CACHE)
+        if not isinstance(entries, dict) or not isinstance(
+            entries.get(self._run_status_key(workspace)), dict
+        ):
+            return {}
+        return entries[self._run_status_key(workspace)]
+
+    def cache_run_statuses(self, workspace: str, statuses: Dict[str, Dict[str, Any]]):
+        """
+        Record the statuses of runs in a workspace, by experiment ID. Only statuses that
+        can't change anymore should be cached, since they're never refreshed.
+        """
+        with _run_status_lock:
+            entries = cache.read_json(RUN_STATUS_CACHE)
+            if not isinstance(entries, dict):
+                entries = {}
+            entry = entries.get(self._run_status_key(workspace))
+            if not isinstance(entry, dict):
+                entry = {}
+            entry.update(statuses)
+            entries[self._run_status_key(workspace)] = entry
+            cache.write_json(RUN_STATUS_CACHE, entries)
+
+    def get_image_digest(self, image_tag: str) -> str:
+        """
+        Get the ID of a local Docker image, which is a digest of its contents.
+        """
+        try:
+            return self.docker.images.get(image_tag).id
+        except docker.errors.ImageNotFound:
+            raise NaaclUtilsError(f"Docker image '{image_tag}' not found locally")
+
+    def upload_dataset(
+        self,
+        name: str,
+        files: Dict[str, Union[bytes, Iterable[bytes]]],
+        workspace: Optional[str] = None,
+        force: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Like :meth:`Beaker.create_dataset()`, but each file is given as either its contents or an
+        iterable of chunks of its contents, instead of a path. This way nothing has to be written
+        to disk first, and a dataset can have more than one file.
+
+        Chunks are buffered so that the size of every file is known up front. Small files
+        are buffered in memory, and only big ones spill over to a temporary file that's removed
+        as soon as it has been uploaded.
+        """
+        workspace_name = workspace or self.config.default_workspace
+        if workspace_name is None:
+            raise ValueError("'workspace' argument required")
+        self.ensure_workspace(workspace_name)
+
+        def make_dataset() -> Dict[str, Any]:
+            return self.request(
+                "datasets",
+                method="POST",
+                query={"name": name},
+                data={"workspace": workspace_name, "fileheap": True},
+                exceptions_for_status={409: DatasetConflict(name)},
+            ).json()
+
+        try:
+            dataset_info = make_dataset()
+        except DatasetConflict:
+            if not force:
+                raise
+            self.delete_dataset(f"{self.user}/{name}")
+            dataset_info = make_dataset()
+
+        for target, contents in files.items():
+            with _buffer(contents) as data:
+                self.request(
+                    f"datasets/{dataset_info['storage']['id']}/files/{target}",
+                    method="PUT",
+                    data=data,
+                    token=dataset_info["storage"]["token"],
+                    base_url=dataset_info["storage"]["address"],
+                )
+
+        return self.request(
+            f"datasets/{dataset_info['id']}",
+            method="PATCH",
+            data={"commit": True},
+        ).json()
+
+    def get_image_size(self, image_tag: str) -> Optional[int]:
+        """
+        Get the size of a local Docker image in bytes, if Docker reports it.
+        """
+        return self.docker.images.get(image_tag).attrs.get("Size")
+
+    def find_uploaded_image(self, digest: str) -> Optional[Dict[str, Any]]:
+        """
+        Find a Beaker image that was previously uploaded from the local Docker image with
+        the given digest. The local index is checked against Beaker, so images that have since
+        been deleted aren't returned.
+        """
+        index = cache.read_json(IMAGE_INDEX_CACHE)
+        if not isinstance(index, dict) or self._image_index_key(digest) not in index:
+            return None
+        image_id = index[self._image_index_key(digest)]
+        try:
+            image_data = self.get_image(image_id)
+        except ImageNotFound:
+            logger.debug("Previously uploaded image %s no longer exists", image_id)
+            self._update_image_index(digest, None)
+            return None
+        if image_data.get("committed") is False:
+            return None
+        return image_data
+
+    def record_uploaded_image(self, digest: str, image_id: str):
+        """
+        Record that the local Docker image with the given digest has been uploaded to Beaker.
+        """
+        self._update_image_index(digest, image_id)
+
+    def _run_status_key(self, workspace: str) -> str:
+        return f"{self.base_url} {workspace}"
+
+    def _image_index_key(self, digest: str) -> str:
+        return f"{self.base_url} {self.user} {digest}"
+
+    def _update_image_index(self, digest: str, image_id: Optional[str]):
+        with _image_index_lock:
+            index = cache.read_json(IMAGE_INDEX_CACHE)
+            if not isinstance(index, dict):
+                index = {}
+            if image_id is None:
+                index.pop(self._image_index_key(digest), None)
+            else:
+                index[self._image_index_key(digest)] = image_id
+            cache.write_json(IMAGE_INDEX_CACHE, index)
+
+    def _handle_http_error(self, exc: HTTPError):
+        if exc.response is not None and exc.response.status_code in (401, 403):
+            self.invalidate_permissions()
+
+    @property
+    def _cache_key(self) -> str:
+        return hashlib.sha256(f"{self.base_url}\n{self.config.user_token}".encode()).hexdigest()
+
+    def _is_fresh(self, checked_at: Optional[float]) -> bool:
+        return checked_at is not None and time.time() - checked_at < get_permissions_ttl()
+
+    def _read_cache_entry(self) -> Dict[str, Any]:
+        entries = cache.read_json(PERMISSIONS_CACHE)
+        if not isinstance(entries, dict) or not isinstance(entries.get(self._cache_key), dict):
+            return {}
+        return entries[self._cache_key]
+
+    def _update_cache_entry(self, **updates):
+        if get_permissions_ttl() <= 0:
+            return
+        entries = cache.read_json(PERMISSIONS_CACHE)
+        if not isinstance(entries, dict):
+            entries = {}
+        entry = entries.get(self._cache_key)
+        if not isinstance(entry, dict):
+            entry = {}
+        entry.update(updates)
+        entries[self._cache_key] = entry
+        cache.write_json(PERMISSIONS_CACHE, entries)
+
+
+@contextmanager
+def _buffer(contents: Union[bytes, Iterable[bytes]]) -> Iterator[Union[bytes, IO[bytes]]]:
+    if isinstance(contents, bytes):
+        yield contents
+        return
+    chunks = []
+    size = 0
+    iterator = iter(contents)
+    for chunk in iterator:
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > MAX_IN_MEMORY_UPLOAD_SIZE:
+            break
+    else:
+        yield b"".join(chunks)
+        return
+    with tempfile.TemporaryFile() as buffer:
+        buffer.writelines(chunks)
+        for chunk in iterator:
+            buffer.write(chunk)
+        buffer.seek(0)
+        yield buffer
+
+
+def _iter_content(response: requests.Response) -> Iterator[bytes]:
+    """
+    Iterate over the body of a streamed response as it arrives. Unlike
+    :meth:`requests.Response.iter_content()`, this never drops data that was received right
+    before the connection broke, so a download can be resumed from exactly where it stopped.
+    """
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is None:
+        # Older versions of urllib3 return what they received when the connection breaks.
+        yield from response.iter_content(chunk_size=LOG_CHUNK_SIZE)
+        return
+    try:
+        while True:
+            chunk = read1(LOG_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    except urllib3.exceptions.HTTPError as exc:
+        raise requests.exceptions.ChunkedEncodingError(exc)
@@ -0,0 +1,4 @@
+class NaaclUtilsError(Exception):
+    """
+    Custom error we raise when we don't want to print a stacktrace.
+    """
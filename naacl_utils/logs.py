@@ -0,0 +1,669 @@
+"""
+Utilities for processing the logs of a run.
+"""
+
+import bisect
+import gzip
+import itertools
+import os
+import sys
+import tempfile
+import zlib
+from collections import Counter, deque
+from typing import IO, Deque, Dict, Generator, Iterable, Iterator, List, Optional, Tuple
+
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+"""
+The default memory budget for processing the logs of a run, in bytes.
+"""
+
+MIN_MAX_MEMORY = 1024 * 1024
+
+TRUNCATION_MARKER = b" [... %d bytes truncated ...] "
+
+
+def max_line_size(max_memory: int) -> int:
+    """
+    The size in bytes of the longest log line that's kept whole when processing logs with
+    a memory budget of ``max_memory`` bytes, see :func:`iter_log_buffers()`.
+    """
+    return max_memory // 8
+
+
+def iter_log_buffers(
+    chunks: Iterable[bytes], min_size: int = 64 * 1024, max_line_size: Optional[int] = None
+) -> Iterator[bytes]:
+    """
+    Regroup raw log chunks into buffers of whole lines, each at least ``min_size`` bytes
+    unless it's the last one. Lines within a buffer are separated by newlines, and the newline
+    that ends the last line of a buffer is dropped. Lines that span chunks are joined back
+    together, and the final buffer holds whatever follows the last newline, which is usually
+    nothing.
+
+    Since newlines can't be part of a multibyte character in UTF-8, every buffer can be
+    decoded on its own.
+
+    If ``max_line_size`` is given, lines longer than that are truncated to their first and last
+    ``max_line_size // 2`` bytes, with a marker in between that says how much was left out.
+    Otherwise a job that logs gigabytes without a newline, e.g. with a progress bar, would
+    need as much memory.
+    """
+    if max_line_size is not None:
+        chunks = _truncate_long_lines(chunks, max_line_size)
+    pending: List[bytes] = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size < min_size:
+            continue
+        end = chunk.rfind(b"\n")
+        if end < 0:
+            continue
+        pending[-1] = chunk[:end]
+        yield b"".join(pending)
+        rest = chunk[end + 1 :]
+        pending = [rest]
+        size = len(rest)
+    yield b"".join(pending)
+
+
+def _truncate_long_lines(chunks: Iterable[bytes], max_line_size: int) -> Iterator[bytes]:
+    """
+    Pass through raw log chunks with the lines that are longer than ``max_line_size`` bytes
+    truncated. The unfinished line at the end of a chunk is held back until it's known whether
+    it's too long, so at most ``max_line_size`` bytes of it are kept in memory, and only the
+    last ``max_line_size // 2`` bytes while a long line is being skipped.
+    """
+    keep = max_line_size // 2
+    # The start of the current line, which hasn't been passed through yet.
+    line: List[bytes] = []
+    line_size = 0
+    # The end of the current line once it's too long, and how many bytes were left out so far.
+    tail: Deque[bytes] = deque()
+    tail_size = 0
+    skipped = 0
+    truncating = False
+
+    def truncated_line() -> bytes:
+        nonlocal skipped
+        end = b"".join(tail)
+        skipped += len(end) - keep
+        return b"".join(line)[:keep] + TRUNCATION_MARKER % skipped + end[len(end) - keep :]
+
+    for chunk in chunks:
+        pos = 0
+        while pos < len(chunk):
+            if truncating:
+                end = chunk.find(b"\n", pos)
+                piece = chunk[pos:] if end < 0 else chunk[pos:end]
+                tail.append(piece)
+                tail_size += len(piece)
+                while tail_size - len(tail[0]) >= keep:
+                    skipped += len(tail[0])
+                    tail_size -= len(tail.popleft())
+                if end < 0:
+                    break
+                yield truncated_line()
+                line, line_size = [], 0
+                tail.clear()
+                tail_size = skipped = 0
+                truncating = False
+                pos = end
+                continue
+
+            room = max_line_size - line_size
+            if len(chunk) - pos <= room:
+                end = chunk.rfind(b"\n", pos)
+                if end < 0:
+                    line.append(chunk[pos:])
+                    line_size += len(chunk) - pos
+                else:
+                    yield b"".join(line) + chunk[pos : end + 1]
+                    line, line_size = [chunk[end + 1 :]], len(chunk) - end - 1
+                break
+            # Any line that ends after the last newline within reach is too long.
+            end = chunk.rfind(b"\n", pos, pos + room + 1)
+            if end >= 0:
+                yield b"".join(line) + chunk[pos : end + 1]
+                line, line_size = [], 0
+                pos = end + 1
+                continue
+            line.append(chunk[pos : pos + room])
+            start = b"".join(line)
+            line = [start[:keep]]
+            tail.append(start[keep:])
+            tail_size = len(start) - keep
+            truncating = True
+            pos += room
+
+    if truncating:
+        yield truncated_line()
+    else:
+        yield b"".join(line)
+
+
+def normalize_lines(buffer: bytes) -> List[str]:
+    """
+    Decode a buffer from :func:`iter_log_buffers()` and split it into lines with the timestamps
+    removed, since Beaker adds the date and time to every line. Bytes that can't be decoded
+    are ignored.
+    """
+    return [
+        line[line.find(" ") + 1 :].rstrip()
+        for line in buffer.decode("utf-8", errors="ignore").split("\n")
+    ]
+
+
+def iter_log_lines(chunks: Iterable[bytes], max_line_size: Optional[int] = None) -> Iterator[str]:
+    """
+    Incrementally split raw log chunks into lines with the timestamps removed.
+
+    Lines are yielded a buffer at a time, so only the current buffer is kept in memory.
+    Bytes that can't be decoded are ignored. Lines longer than ``max_line_size`` bytes are
+    truncated, see :func:`iter_log_buffers()`.
+    """
+    for buffer in iter_log_buffers(chunks, max_line_size=max_line_size):
+        yield from normalize_lines(buffer)
+
+
+def compress_lines(lines: Iterable[str]) -> Generator[bytes, None, None]:
+    """
+    Incrementally gzip the lines joined by newlines, yielding compressed chunks
+    as they become available.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    separator = b""
+    for line in lines:
+        chunk = compressor.compress(separator + line.encode())
+        separator = b"\n"
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+class FragmentMatcher:
+    """
+    Finds several fragments of expected output in one pass over a stream of log lines,
+    one line at a time.
+
+    A fragment is found when ``"\\n".join(fragment)`` is a substring of the log lines joined by
+    newlines. So the first line of a fragment has to match the end of a log line, the last line
+    has to match the start of the following log line, and all of the lines in between have to
+    match exactly. The lines in between are matched for all fragments at once with
+    an Aho-Corasick automaton over whole lines, so each log line is looked up once no matter how
+    many fragments there are, and memory is bounded by the size of the fragments regardless of
+    how long the logs are.
+
+    If ``ordered`` is ``True``, the fragments have to be found in the given order, each one
+    starting on a later line than the one before it ends.
+
+    Logs can also be fed a buffer of raw lines at a time with :meth:`feed_buffer()`, which skips
+    decoding and normalizing most lines of buffers that can't contain any of the fragments.
+    """
+
+    def __init__(self, fragments: List[List[str]], ordered: bool = False):
+        if not fragments or not all(fragments):
+            raise ValueError("'fragments' can't be empty")
+        self.fragments = fragments
+        self.ordered = ordered
+        self.found: List[Optional[int]] = [None] * len(fragments)
+        """
+        The index of the log line where each fragment starts, or ``None`` if it hasn't been found.
+        """
+        self.num_lines = 0
+        self._num_found = 0
+        self._next = 0
+        self._last_end = -1
+        self._single = [k for k, fragment in enumerate(fragments) if len(fragment) == 1]
+        self._multi = [k for k, fragment in enumerate(fragments) if len(fragment) > 1]
+        self._two_lines = sum(1 << k for k in self._multi if len(fragments[k]) == 2)
+        # For each state of the automaton, the transitions on the next line, the state to fall
+        # back to, and the fragments whose inner lines end there.
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+        self._build_automaton()
+        self._state = 0
+        self._span = max(len(fragment) for fragment in fragments)
+        # For each of the most recent lines, a bit mask of the fragments whose first line
+        # it ends with.
+        self._ends_with_first: Deque[int] = deque(maxlen=self._span - 1)
+        # A bit mask of the fragments that the next line completes if it starts with their
+        # last line.
+        self._pending = 0
+        # Every match of a fragment contains its longest line, so buffers without any of those
+        # can be skipped.
+        self._needles = [max(fragment, key=len) for fragment in fragments]
+        self._needles_bytes = [needle.encode() for needle in self._needles]
+
+    @property
+    def matched(self) -> bool:
+        """
+        Whether all of the fragments have been found.
+        """
+        return self._num_found == len(self.fragments)
+
+    @property
+    def missing(self) -> List[int]:
+        """
+        The indices of the fragments that haven't been found.
+        """
+        return [k for k, start in enumerate(self.found) if start is None]
+
+    def feed(self, line: str) -> bool:
+        """
+        Process the next log line. Returns ``True`` once all of the fragments have been found.
+        """
+        if self.matched:
+            return True
+
+        index = self.num_lines
+        self.num_lines += 1
+        fragments = self.fragments
+
+        if self._pending:
+            for k in self._multi:
+                if self._pending >> k & 1 and line.startswith(fragments[k][-1]):
+                    self._found(k, index - len(fragments[k]) + 1, index)
+        for k in self._single:
+            if fragments[k][0] in line:
+                self._found(k, index, index)
+
+        ends_with_first = 0
+        for k in self._multi:
+            if line.endswith(fragments[k][0]):
+                ends_with_first |= 1 << k
+        self._ends_with_first.append(ends_with_first)
+        pending = ends_with_first & self._two_lines
+
+        if len(self._goto) > 1:
+            state = self._state
+            while state and line not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(line, 0)
+            for k in self._output[state]:
+                # The line right before the inner lines needs to end with the first line.
+                before = len(fragments[k]) - 1
+                if len(self._ends_with_first) >= before and self._ends_with_first[-before] >> k & 1:
+                    pending |= 1 << k
+            self._state = state
+
+        self._pending = pending
+        return self.matched
+
+    def feed_buffer(self, buffer: bytes) -> bool:
+        """
+        Process the next buffer of raw log lines from :func:`iter_log_buffers()`.
+        Returns ``True`` once all of the fragments have been found.
+
+        If the longest line of every missing fragment doesn't occur anywhere in the buffer,
+        a match can only overlap with the first and last few lines of the buffer, so the lines
+        in between are never decoded or normalized. Usually that's most of them.
+        """
+        if self.matched:
+            return True
+
+        span = self._span
+        # The first and last lines are the ones before 'head_end' and after 'tail_start'.
+        head_end = _find_newline(buffer, span - 1) if span > 1 else -1
+        tail_start = _rfind_newline(buffer, span)
+        if (
+            head_end is None
+            or tail_start is None
+            or tail_start <= head_end
+            or self._may_contain_needle(buffer)
+        ):
+            return self._feed_lines(normalize_lines(buffer))
+
+        # The first lines might complete a match that started in earlier buffers.
+        if span > 1 and self._feed_lines(normalize_lines(buffer[:head_end])):
+            return True
+        # No match can start before the last lines, and the state of the matcher only depends
+        # on the last lines, so we can pick up from there.
+        self.num_lines += buffer.count(b"\n", head_end + 1, tail_start) + 1
+        self._reset()
+        return self._feed_lines(normalize_lines(buffer[tail_start + 1 :]))
+
+    def _found(self, k: int, start: int, end: int):
+        if self.found[k] is not None:
+            return
+        if self.ordered:
+            if k != self._next or start <= self._last_end:
+                return
+            self._next += 1
+            self._last_end = end
+        self.found[k] = start
+        self._num_found += 1
+
+    def _build_automaton(self):
+        for k in self._multi:
+            inner = self.fragments[k][1:-1]
+            if not inner:
+                continue
+            state = 0
+            for line in inner:
+                if line not in self._goto[state]:
+                    self._goto[state][line] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = self._goto[state][line]
+            self._output[state].append(k)
+
+        # Go breadth-first, so the states to fall back to are always done first.
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for line, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and line not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(line, 0)
+                self._output[next_state].extend(self._output[self._fail[next_state]])
+
+    def _feed_lines(self, lines: List[str]) -> bool:
+        for line in lines:
+            if self.feed(line):
+                return True
+        return False
+
+    def _may_contain_needle(self, buffer: bytes) -> bool:
+        missing = self.missing
+        if any(self._needles_bytes[k] in buffer for k in missing):
+            return True
+        if buffer.isascii():
+            return False
+        # Ignoring bytes that can't be decoded could bring a needle together.
+        text = buffer.decode("utf-8", errors="ignore")
+        return any(self._needles[k] in text for k in missing)
+
+    def _reset(self):
+        self._state = 0
+        self._ends_with_first.clear()
+        self._pending = 0
+
+
+def _find_newline(buffer: bytes, n: int) -> Optional[int]:
+    """
+    Find the index of the ``n``-th newline.
+    """
+    index = -1
+    for _ in range(n):
+        index = buffer.find(b"\n", index + 1)
+        if index < 0:
+            return None
+    return index
+
+
+def _rfind_newline(buffer: bytes, n: int) -> Optional[int]:
+    """
+    Find the index of the ``n``-th newline from the end.
+    """
+    index = len(buffer)
+    for _ in range(n):
+        index = buffer.rfind(b"\n", 0, index)
+        if index < 0:
+            return None
+    return index
+
+
+class MismatchLocator:
+    """
+    Finds where in the logs the expected output most likely should have been, so that a focused
+    diff can be shown when verification fails.
+
+    Expected lines that are non-blank and only occur once in the expected output are used
+    as anchors. Every log line that equals an anchor votes for the alignment of the expected
+    output that would put the anchor there, and the alignment with the most votes wins.
+    An alignment can only get votes from the ``len(expected_lines)`` log lines after it, so
+    alignments are settled as soon as the stream moves past them. This takes one pass over
+    the logs, and memory is bounded by the size of the expected output.
+    """
+
+    def __init__(self, expected_lines: List[str]):
+        counts = Counter(expected_lines)
+        self._anchors = {
+            line: i for i, line in enumerate(expected_lines) if line.strip() and counts[line] == 1
+        }
+        self.span = len(expected_lines)
+        self._votes: Dict[int, int] = {}
+        self.num_lines = 0
+        self.best_offset: Optional[int] = None
+        self.best_votes = 0
+
+    def feed(self, line: str):
+        i = self._anchors.get(line)
+        if i is not None:
+            offset = self.num_lines - i
+            self._votes[offset] = self._votes.get(offset, 0) + 1
+        self.num_lines += 1
+        if self.num_lines % self.span == 0:
+            self._settle(self.num_lines - self.span)
+
+    def finish(self):
+        """
+        Settle all remaining alignments. Call this once the whole log has been fed.
+        """
+        self._settle(None)
+
+    def _settle(self, up_to: Optional[int]):
+        for offset in sorted(self._votes):
+            if up_to is not None and offset > up_to:
+                break
+            votes = self._votes.pop(offset)
+            if votes > self.best_votes:
+                self.best_offset, self.best_votes = offset, votes
+
+
+class LogStore:
+    """
+    An append-only store of log lines that keeps them in memory until there are
+    ``max_lines_in_memory`` of them or they take up more than ``max_memory`` bytes, after which
+    everything is written out to a gzipped temporary file instead.
+
+    The file is written in segments of about ``SEGMENT_SIZE`` bytes of lines, each one
+    a separate gzip member, and the index of the first line of every segment is kept. So reading
+    lines from anywhere in the file only decompresses it from the segment they're in.
+    Concatenated gzip members are a valid gzipped file, so the file can be viewed with any tool
+    that can open those.
+    """
+
+    SEGMENT_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, max_lines_in_memory: int = 500, max_memory: int = DEFAULT_MAX_MEMORY):
+        self.max_lines_in_memory = max_lines_in_memory
+        self.max_memory = max_memory
+        self.lines: List[str] = []
+        self.path: Optional[str] = None
+        self.num_lines = 0
+        self._memory = 0
+        self._file: Optional[IO[bytes]] = None
+        self._segment: Optional[gzip.GzipFile] = None
+        self._segment_size = 0
+        self._num_written = 0
+        # The index of the first line of each segment and its offset in the file.
+        self._segment_lines: List[int] = []
+        self._segment_offsets: List[int] = []
+
+    @property
+    def in_memory(self) -> bool:
+        return self.path is None
+
+    def append(self, line: str):
+        self.num_lines += 1
+        if self.path is not None:
+            self._write(line)
+            return
+        self.lines.append(line)
+        self._memory += sys.getsizeof(line)
+        if len(self.lines) >= self.max_lines_in_memory or self._memory > self.max_memory:
+            self.spill()
+
+    def iter_lines(self, start: int = 0, stop: Optional[int] = None) -> Iterator[str]:
+        """
+        Scan the lines from index ``start`` up to ``stop``, or the end.
+        """
+        if self.path is None:
+            yield from self.lines[start:stop]
+            return
+        self._close_segment()
+        if self._file is not None:
+            self._file.flush()
+        segment = max(bisect.bisect_right(self._segment_lines, start) - 1, 0)
+        first_line = self._segment_lines[segment] if self._segment_lines else 0
+        with open(self.path, "rb") as raw_file:
+            if self._segment_offsets:
+                raw_file.seek(self._segment_offsets[segment])
+            with gzip.GzipFile(fileobj=raw_file, mode="rb") as log_file:
+                lines = itertools.islice(
+                    log_file, start - first_line, None if stop is None else stop - first_line
+                )
+                for line in lines:
+                    yield line[:-1].decode()
+
+    def read_lines(self, start: int, stop: int) -> List[str]:
+        """
+        Get the lines from index ``start`` up to ``stop``.
+        """
+        return list(self.iter_lines(start, stop))
+
+    def spill(self):
+        """
+        Write out all of the lines to the gzipped temporary file, if they aren't already.
+        """
+        if self.path is not None:
+            return
+        fd, self.path = tempfile.mkstemp(suffix=".log.gz")
+        self._file = os.fdopen(fd, "wb")
+        lines, self.lines, self._memory = self.lines, [], 0
+        for line in lines:
+            self._write(line)
+
+    def keep(self) -> str:
+        """
+        Write out all of the lines to the gzipped temporary file, if they aren't already,
+        and return its path.
+        """
+        self.spill()
+        self._close()
+        assert self.path is not None
+        return self.path
+
+    def discard(self):
+        """
+        Remove the temporary file, if there is one.
+        """
+        self._close()
+        if self.path is not None:
+            os.remove(self.path)
+            self.path = None
+        self.lines = []
+        self._memory = 0
+
+    def _write(self, line: str):
+        if self._segment is None:
+            if self._file is None:
+                # The file was closed by 'keep()', so pick up where it left off.
+                assert self.path is not None
+                self._file = open(self.path, "ab")
+            self._segment_lines.append(self._num_written)
+            self._segment_offsets.append(self._file.tell())
+            self._segment = gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=6)
+            self._segment_size = 0
+        data = line.encode() + b"\n"
+        self._segment.write(data)
+        self._segment_size += len(data)
+        self._num_written += 1
+        if self._segment_size >= self.SEGMENT_SIZE:
+            self._close_segment()
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _close(self):
+        self._close_segment()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class LogRecorder:
+    """
+    Keeps the log lines around so they can be reported when verification fails.
+
+    Lines are kept in a :class:`LogStore`, which holds them in memory until there are
+    ``max_lines_in_memory`` of them or they take up more than ``max_memory`` bytes, and in
+    a gzipped temporary file after that. The lines are also fed to a :class:`MismatchLocator`
+    for each of the ``fragments`` of expected output, so that :meth:`mismatch_window()` can find
+    the part of the logs that's worth diffing against it.
+    """
+
+    def __init__(
+        self,
+        *fragments: List[str],
+        max_lines_in_memory: int = 500,
+        max_memory: int = DEFAULT_MAX_MEMORY,
+    ):
+        self.store = LogStore(max_lines_in_memory=max_lines_in_memory, max_memory=max_memory)
+        self.locators = [MismatchLocator(fragment) for fragment in fragments]
+
+    @property
+    def in_memory(self) -> bool:
+        return self.store.in_memory
+
+    @property
+    def lines(self) -> List[str]:
+        """
+        The recorded lines, as long as they're all in memory.
+        """
+        return self.store.lines
+
+    @property
+    def num_lines(self) -> int:
+        return self.store.num_lines
+
+    def add(self, line: str):
+        for locator in self.locators:
+            locator.feed(line)
+        self.store.append(line)
+
+    def read_lines(self, start: int, stop: int) -> List[str]:
+        """
+        Get the recorded lines from index ``start`` up to ``stop``.
+        """
+        return self.store.read_lines(start, stop)
+
+    def mismatch_window(self, context: int = 3, fragment: int = 0) -> Tuple[int, List[str]]:
+        """
+        Get the start index and lines of the part of the logs that most resembles the given
+        ``fragment`` of expected output, with ``context`` extra lines on either side. If nothing
+        resembles it, the end of the logs is used since that's usually where the results
+        are printed.
+        """
+        locator = self.locators[fragment]
+        locator.finish()
+        span = locator.span
+        if locator.best_offset is not None:
+            start = locator.best_offset - context
+        else:
+            start = self.num_lines - span - context
+        start = max(start, 0)
+        stop = min(start + span + 2 * context, self.num_lines)
+        return start, self.read_lines(start, stop)
+
+    def keep(self) -> str:
+        """
+        Write out all of the lines to the gzipped temporary file, if they aren't already,
+        and return its path.
+        """
+        return self.store.keep()
+
+    def discard(self):
+        """
+        Remove the temporary file, if there is one.
+        """
+        self.store.discard()
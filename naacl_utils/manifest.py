@@ -0,0 +1,98 @@
+"""
+Loading manifests that describe many runs for the batch commands.
+"""
+
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Union
+
+from .exceptions import NaaclUtilsError
+
+PathOrStr = Union[str, Path]
+
+
+def load_manifest(
+    path: PathOrStr,
+    required_fields: Sequence[str],
+    optional_fields: Sequence[str] = (),
+    list_fields: Sequence[str] = (),
+    flag_fields: Sequence[str] = (),
+) -> List[Dict[str, Any]]:
+    """
+    Load the rows of a manifest file. The manifest can either be a YAML file (``.yml``/``.yaml``)
+    containing a list of mappings, or a JSON Lines file with one JSON object per line.
+
+    Every row must have all of the ``required_fields``, may have any of the ``optional_fields``
+    and ``flag_fields``, and all values must be strings. Missing optional fields are set
+    to ``None``.
+
+    Fields that are also in ``list_fields`` can be lists of strings too, and they're always
+    turned into lists. The ``flag_fields`` have to be booleans, and they're ``False``
+    when missing.
+    """
+    path = Path(path)
+    rows: List[Any]
+    if path.suffix in (".yml", ".yaml"):
+        import yaml
+
+        with path.open() as manifest_file:
+            try:
+                rows = yaml.safe_load(manifest_file) or []
+            except yaml.YAMLError as exc:
+                raise NaaclUtilsError(f"Failed to parse manifest '{path}': {exc}")
+        if not isinstance(rows, list):
+            raise NaaclUtilsError(f"Manifest '{path}' must contain a list of runs")
+    else:
+        rows = []
+        with path.open() as manifest_file:
+            for line_number, line in enumerate(manifest_file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except ValueError as exc:
+                    raise NaaclUtilsError(
+                        f"Failed to parse line {line_number} of manifest '{path}': {exc}"
+                    )
+
+    if not rows:
+        raise NaaclUtilsError(f"Manifest '{path}' doesn't contain any runs")
+
+    allowed_fields = set(required_fields) | set(optional_fields) | set(flag_fields)
+    for i, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            raise NaaclUtilsError(f"Run {i} in manifest '{path}' must be a mapping")
+        missing = [field for field in required_fields if field not in row]
+        if missing:
+            raise NaaclUtilsError(
+                f"Run {i} in manifest '{path}' is missing required field(s): {', '.join(missing)}"
+            )
+        unknown = sorted(set(row) - allowed_fields)
+        if unknown:
+            raise NaaclUtilsError(
+                f"Run {i} in manifest '{path}' has unknown field(s): {', '.join(unknown)}"
+            )
+        for field in optional_fields:
+            row.setdefault(field, None)
+        for field in flag_fields:
+            row.setdefault(field, False)
+        for field, value in row.items():
+            if field in flag_fields:
+                if not isinstance(value, bool):
+                    raise NaaclUtilsError(
+                        f"Field '{field}' of run {i} in manifest '{path}' must be true or false"
+                    )
+            elif field in list_fields and isinstance(value, list):
+                if not value or not all(isinstance(item, str) for item in value):
+                    raise NaaclUtilsError(
+                        f"Field '{field}' of run {i} in manifest '{path}' "
+                        "must be a string or a non-empty list of strings"
+                    )
+            elif value is not None and not isinstance(value, str):
+                raise NaaclUtilsError(
+                    f"Field '{field}' of run {i} in manifest '{path}' must be a string"
+                )
+        for field in list_fields:
+            if isinstance(row.get(field), str):
+                row[field] = [row[field]]
+    return rows
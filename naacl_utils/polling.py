@@ -0,0 +1,129 @@
+"""
+Waiting for experiments to finish.
+"""
+
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .exceptions import NaaclUtilsError
+
+logger = logging.getLogger("naacl_utils")
+
+
+def job_finished(job: Dict[str, Any]) -> bool:
+    """
+    Check if a Beaker job has exited, one way or another.
+    """
+    status = job.get("status", {})
+    return (
+        status.get("exitCode") is not None
+        or status.get("canceled") is not None
+        or status.get("finalized") is not None
+    )
+
+
+def experiment_finished(experiment: Dict[str, Any]) -> bool:
+    """
+    Check if every job of a Beaker experiment has exited. When a job is retried, the new job
+    hasn't, so the experiment isn't finished until the retry is.
+    """
+    jobs = experiment.get("jobs") or []
+    return bool(jobs) and all(job_finished(job) for job in jobs)
+
+
+class Backoff:
+    """
+    Exponentially growing polling intervals with random jitter, so that many clients polling
+    at once don't end up in lockstep.
+    """
+
+    def __init__(
+        self,
+        initial: float = 2.0,
+        maximum: float = 60.0,
+        factor: float = 1.5,
+        jitter: float = 0.2,
+    ):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self._interval = initial
+
+    def reset(self):
+        self._interval = self.initial
+
+    def next(self) -> float:
+        """
+        Get the next interval to sleep for.
+        """
+        interval = self._interval
+        self._interval = min(self._interval * self.factor, self.maximum)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+def wait_for_experiments(
+    fetch: Callable[[str], Dict[str, Any]],
+    run_names: Sequence[str],
+    timeout: Optional[float] = None,
+    backoff: Optional[Backoff] = None,
+    workers: int = 8,
+    return_exceptions: bool = False,
+) -> Iterator[Tuple[str, Any]]:
+    """
+    Poll experiments until they finish, yielding each run name and its experiment data as soon as
+    it does. All of the runs share one polling loop, and every round fetches the pending
+    experiments concurrently with up to ``workers`` threads.
+
+    The polling interval grows exponentially while nothing changes, and is reset whenever the
+    status of any job changes since other changes usually follow shortly after.
+
+    If fetching an experiment fails, the error is raised, unless ``return_exceptions`` is ``True``
+    in which case the error is yielded in place of the experiment data and the run is dropped.
+
+    Raises :exc:`NaaclUtilsError` if the runs haven't finished within ``timeout`` seconds.
+    """
+    backoff = backoff or Backoff()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    pending: List[str] = list(run_names)
+    last_status: Dict[str, Any] = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as executor:
+        while True:
+            changed = False
+            still_pending = []
+            futures = [executor.submit(fetch, run_name) for run_name in pending]
+            for run_name, future in zip(pending, futures):
+                exc = future.exception()
+                if exc is not None:
+                    if not return_exceptions:
+                        raise exc
+                    yield run_name, exc
+                    continue
+                experiment = future.result()
+                status = [job.get("status") for job in experiment.get("jobs") or []]
+                if status != last_status.get(run_name):
+                    changed = True
+                    last_status[run_name] = status
+                if experiment_finished(experiment):
+                    yield run_name, experiment
+                else:
+                    still_pending.append(run_name)
+            pending = still_pending
+            if not pending:
+                return
+
+            if changed:
+                backoff.reset()
+            interval = backoff.next()
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NaaclUtilsError(
+                        f"Timed out waiting for {len(pending)} run(s) to finish: {', '.join(pending)}"
+                    )
+                interval = min(interval, remaining)
+            logger.debug("Waiting %.1fs for %d run(s)", interval, len(pending))
+            time.sleep(interval)
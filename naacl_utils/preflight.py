@@ -0,0 +1,192 @@
+"""
+Running a Docker image locally before submitting it, to see what it prints without waiting
+for Beaker.
+"""
+
+import hashlib
+import json
+import logging
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import IO, TYPE_CHECKING, Iterable, Iterator, List, Optional
+
+from . import cache
+from .exceptions import NaaclUtilsError
+from .logs import DEFAULT_MAX_MEMORY, LogStore, iter_log_lines, max_line_size
+from .profiling import profiler
+from .spec import TaskSpec
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+logger = logging.getLogger("naacl_utils")
+
+# The number of lines of output that are shown at most.
+TAIL_LINES = 20
+
+
+class ContainerRunner(ABC):
+    """
+    Runs Docker images locally for :func:`preflight()`. :class:`DockerRunner` is used
+    by default, but anything that can run an image, like another container engine, can be
+    plugged in by implementing these methods.
+    """
+
+    @abstractmethod
+    def get_image_digest(self, image: str) -> str:
+        """
+        Get the ID of a local image, which is a digest of its contents. Raises
+        a :class:`~naacl_utils.exceptions.NaaclUtilsError` if there's no such image.
+        """
+
+    @abstractmethod
+    def run(
+        self, image: str, entrypoint: Optional[List[str]] = None, cmd: Optional[List[str]] = None
+    ) -> Iterator[bytes]:
+        """
+        Run an image to completion, overriding its ``ENTRYPOINT`` and ``CMD`` if they're given,
+        and stream its output in the same format as Beaker's logs: both stdout and stderr,
+        with a timestamp and a space at the start of every line.
+
+        Once the output ends, raises a :class:`~naacl_utils.exceptions.NaaclUtilsError` if
+        the image exited with an error.
+        """
+
+
+class DockerRunner(ContainerRunner):
+    """
+    Runs images with the local Docker daemon.
+    """
+
+    def __init__(self, client: Optional["DockerClient"] = None):
+        self._docker = client
+
+    @property
+    def docker(self) -> "DockerClient":
+        if self._docker is None:
+            import docker
+
+            self._docker = docker.from_env()
+        return self._docker
+
+    def get_image_digest(self, image: str) -> str:
+        import docker
+
+        try:
+            return self.docker.images.get(image).id
+        except docker.errors.ImageNotFound:
+            raise NaaclUtilsError(f"Docker image '{image}' not found locally")
+
+    def run(
+        self, image: str, entrypoint: Optional[List[str]] = None, cmd: Optional[List[str]] = None
+    ) -> Iterator[bytes]:
+        container = self.docker.containers.run(
+            image, command=cmd, entrypoint=entrypoint, detach=True
+        )
+        try:
+            yield from container.logs(stream=True, follow=True, timestamps=True)
+            exit_code = container.wait()["StatusCode"]
+        finally:
+            container.remove(force=True)
+        if exit_code != 0:
+            raise NaaclUtilsError(f"Docker image '{image}' exited with code {exit_code}")
+
+
+@dataclass
+class PreflightResult:
+    """
+    The outcome of running an image locally with :func:`preflight()`.
+    """
+
+    image: str
+    digest: str
+    output: LogStore
+    """
+    The lines of output, normalized like the logs of a run are for verifying it. Call
+    ``output.discard()`` once done with them.
+    """
+    cached: bool
+    """
+    Whether the output came from the cache instead of running the image.
+    """
+
+    def write_expected_output(self, expected_output_file: IO[str]):
+        """
+        Write the output as an expected output file for ``naacl-utils verify``, without
+        the blank lines at the end.
+        """
+        blank_lines = 0
+        wrote_content = False
+        for line in self.output.iter_lines():
+            if not line:
+                blank_lines += 1
+                continue
+            expected_output_file.write("\n" * blank_lines + line + "\n")
+            blank_lines = 0
+            wrote_content = True
+        if not wrote_content:
+            raise NaaclUtilsError(f"Docker image '{self.image}' didn't print anything")
+
+
+def preflight(
+    image: str,
+    task: TaskSpec = TaskSpec(),
+    runner: Optional[ContainerRunner] = None,
+    use_cache: bool = True,
+    max_memory: int = DEFAULT_MAX_MEMORY,
+) -> PreflightResult:
+    """
+    Run an image locally the way ``task`` would run it on Beaker, i.e. with the same
+    ``entrypoint`` and ``cmd``, and capture its output. The resources of the task aren't
+    applied locally.
+
+    The raw output is kept in the log cache, keyed by the digest of the image along with
+    the entrypoint and cmd, so running the same image again costs nothing unless
+    ``use_cache`` is ``False``. Like when verifying, the output takes up at most about
+    ``max_memory`` bytes no matter how much the image prints.
+    """
+    runner = runner or DockerRunner()
+    task.validate()
+    entrypoint, cmd = task.entrypoint_args(), task.cmd_args()
+    with profiler.span("get image digest"):
+        digest = runner.get_image_digest(image)
+
+    log_cache = cache.LogCache()
+    key = _cache_key(digest, entrypoint, cmd)
+    chunks: Optional[Iterable[bytes]] = log_cache.read(key) if use_cache else None
+    cached = chunks is not None
+    if chunks is None:
+        logger.debug("Running image %s locally", image)
+        chunks = log_cache.write_through(
+            key, profiler.iter_chunks("run image", runner.run(image, entrypoint, cmd))
+        )
+
+    # A failed run raises its error once the output ends, which is held back until all of
+    # the output has been processed so that it can be reported along with it.
+    error: Optional[NaaclUtilsError] = None
+
+    def until_error(chunks: Iterable[bytes]) -> Iterator[bytes]:
+        nonlocal error
+        try:
+            yield from chunks
+        except NaaclUtilsError as exc:
+            error = exc
+
+    output = LogStore(max_memory=max_memory // 4)
+    try:
+        for line in iter_log_lines(until_error(chunks), max_line_size=max_line_size(max_memory)):
+            output.append(line)
+        if error is not None:
+            tail = output.read_lines(max(output.num_lines - TAIL_LINES, 0), output.num_lines)
+            raise NaaclUtilsError(
+                f"{error}. The last lines of its output were:\n" + "\n".join(tail)
+            )
+    except BaseException:
+        output.discard()
+        raise
+    return PreflightResult(image, digest, output, cached)
+
+
+def _cache_key(digest: str, entrypoint: Optional[List[str]], cmd: Optional[List[str]]) -> str:
+    run = json.dumps([digest, entrypoint, cmd]).encode()
+    return f"preflight-{hashlib.sha256(run).hexdigest()}"
@@ -0,0 +1,170 @@
+"""
+Lightweight timing of the phases of a command, enabled with the global ``--profile`` option.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Generator, Iterable, Iterator, List, Optional, Tuple
+
+
+@dataclass
+class Span:
+    """
+    The timing of one phase of a command.
+    """
+
+    name: str
+    depth: int
+    """
+    How many spans this one is nested in.
+    """
+    start: float
+    """
+    Seconds since profiling started.
+    """
+    duration: float = 0.0
+    bytes: Optional[int] = None
+    """
+    The number of bytes transferred during this phase, if any.
+    """
+    thread: str = ""
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """
+        The number of bytes transferred per second, if any.
+        """
+        if self.bytes is None or self.duration <= 0:
+            return None
+        return self.bytes / self.duration
+
+    def add_bytes(self, num_bytes: int):
+        self.bytes = (self.bytes or 0) + num_bytes
+
+    def to_json(self) -> Dict[str, Any]:
+        return {**asdict(self), "throughput": self.throughput}
+
+
+class Profiler:
+    """
+    Records :class:`Span` objects for the phases of a command. Spans can be recorded from
+    any thread, and they're nested per thread.
+
+    When the profiler is disabled, spans are still handed out so that the calling code
+    doesn't need to check, but they aren't recorded.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans: List[Span] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def reset(self, enabled: bool = False):
+        """
+        Forget all spans and start profiling over.
+        """
+        self.enabled = enabled
+        self.spans = []
+        self._origin = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        """
+        Seconds since profiling started.
+        """
+        return time.perf_counter() - self._origin
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        """
+        Time the code within this context as a phase called ``name``.
+        """
+        span = self._new_span(name)
+        if not self.enabled:
+            yield span
+            return
+
+        depth = span.depth
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - start
+            self._local.depth = depth
+
+    def iter_chunks(self, name: str, chunks: Iterable[bytes]) -> Generator[bytes, None, None]:
+        """
+        Pass through ``chunks`` while recording the time spent waiting for them and their total
+        size as a span called ``name``. This is meant for streams that are consumed piece by piece
+        in between other work, like log downloads.
+        """
+        if not self.enabled:
+            yield from chunks
+            return
+
+        span = self._new_span(name)
+        iterator = iter(chunks)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    span.duration += time.perf_counter() - start
+                span.add_bytes(len(chunk))
+                yield chunk
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+    def summary(self) -> List[Tuple[Span, int]]:
+        """
+        Combine spans with the same name and depth, in the order that they first started.
+        Returns each combined span along with the number of spans that went into it.
+        """
+        combined: Dict[Tuple[int, str], Tuple[Span, int]] = {}
+        for span in self.spans:
+            key = (span.depth, span.name)
+            if key not in combined:
+                combined[key] = (Span(span.name, span.depth, span.start, bytes=span.bytes), 0)
+            elif span.bytes is not None:
+                combined[key][0].add_bytes(span.bytes)
+            total, count = combined[key]
+            total.duration += span.duration
+            combined[key] = (total, count + 1)
+        return list(combined.values())
+
+    def write_jsonl(self, path: str):
+        """
+        Write every span to a JSON Lines file.
+        """
+        with open(path, "w") as output_file:
+            for span in self.spans:
+                output_file.write(json.dumps(span.to_json()) + "\n")
+
+    def _new_span(self, name: str) -> Span:
+        span = Span(
+            name,
+            getattr(self._local, "depth", 0),
+            self.elapsed,
+            thread=threading.current_thread().name,
+        )
+        if self.enabled:
+            with self._lock:
+                self.spans.append(span)
+        return span
+
+
+profiler = Profiler()
+"""
+The profiler used by the CLI.
+"""
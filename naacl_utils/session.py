@@ -0,0 +1,56 @@
+"""
+The HTTP session shared by everything that naacl-utils talks to.
+
+This module imports ``requests`` at the top-level, so it should only be imported lazily
+from within the code that needs it.
+"""
+
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+POOL_SIZE = 32
+
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def make_session() -> requests.Session:
+    """
+    Create a session that keeps connections alive and retries failed requests with
+    exponential backoff.
+
+    Connection errors are retried for every request since nothing has been sent yet,
+    but read errors and recoverable status codes are only retried for idempotent methods,
+    so that we never, e.g., create the same experiment twice.
+    """
+    retries = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Get the shared session, creating it the first time. The session is safe to use from
+    the worker threads of the batch commands, and its pool is big enough for all of them.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
@@ -0,0 +1,256 @@
+"""
+Describing the tasks of the Beaker experiment that's submitted for a run, and checking them
+locally so that mistakes are caught before anything is uploaded.
+"""
+
+import json
+import re
+from dataclasses import dataclass, fields, replace
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from click.parser import split_arg_string
+
+from .exceptions import NaaclUtilsError
+
+PathOrStr = Union[str, Path]
+
+DEFAULT_TASK_NAME = "main"
+DEFAULT_GPU_COUNT = 1
+DEFAULT_SHARED_MEMORY = "1GiB"
+
+_SIZE_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(?:([kmgt])(i)?)?b?", re.IGNORECASE)
+_UNIT_EXPONENTS = {"k": 1, "m": 2, "g": 3, "t": 4}
+_TASK_NAME_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a memory size like ``512m``, ``1.5G``, or ``8GiB`` into a number of bytes.
+    Like Beaker, units are powers of 1000 unless they have an ``i``.
+    """
+    match = _SIZE_RE.fullmatch(size.strip())
+    if match is None:
+        raise NaaclUtilsError(
+            f"Invalid size '{size}', expected a number of bytes with an optional unit, "
+            "like '512m' or '8GiB'"
+        )
+    number, unit, binary = match.groups()
+    base = 1024 if binary else 1000
+    return int(float(number) * base ** _UNIT_EXPONENTS.get((unit or "").lower(), 0))
+
+
+@dataclass(frozen=True)
+class Resources:
+    """
+    The resources requested for a task. Anything that's ``None`` is left up to Beaker.
+    """
+
+    gpu_count: Optional[int] = None
+    cpu_count: Optional[float] = None
+    memory: Optional[str] = None
+    shared_memory: Optional[str] = None
+    """
+    The size of ``/dev/shm``, which is what data loaders with several worker processes
+    use to pass batches around.
+    """
+
+    def override(self, **kwargs) -> "Resources":
+        """
+        Get a copy with the resources in ``kwargs`` that aren't ``None`` replaced.
+        """
+        return replace(self, **{key: value for key, value in kwargs.items() if value is not None})
+
+    def validate(self):
+        if self.gpu_count is not None and (
+            not isinstance(self.gpu_count, int)
+            or isinstance(self.gpu_count, bool)
+            or self.gpu_count < 0
+        ):
+            raise NaaclUtilsError(
+                f"Invalid GPU count {self.gpu_count!r}, expected a non-negative integer"
+            )
+        if self.cpu_count is not None and (
+            not isinstance(self.cpu_count, (int, float))
+            or isinstance(self.cpu_count, bool)
+            or self.cpu_count <= 0
+        ):
+            raise NaaclUtilsError(
+                f"Invalid CPU count {self.cpu_count!r}, expected a positive number"
+            )
+        sizes: Dict[str, int] = {}
+        for name in ("memory", "shared_memory"):
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if not isinstance(value, str):
+                raise NaaclUtilsError(f"Invalid size {value!r}, expected a string like '8GiB'")
+            sizes[name] = parse_size(value)
+            if sizes[name] <= 0:
+                raise NaaclUtilsError(f"Invalid size '{value}', expected more than 0 bytes")
+        if "memory" in sizes and sizes.get("shared_memory", 0) > sizes["memory"]:
+            raise NaaclUtilsError(
+                f"Shared memory ({self.shared_memory}) can't be more than memory ({self.memory})"
+            )
+
+    def to_beaker(self) -> Dict[str, Any]:
+        beaker_resources = {
+            "gpuCount": self.gpu_count,
+            "cpuCount": self.cpu_count,
+            "memory": self.memory,
+            "sharedMemory": self.shared_memory,
+        }
+        return {key: value for key, value in beaker_resources.items() if value is not None}
+
+
+DEFAULT_RESOURCES = Resources(gpu_count=DEFAULT_GPU_COUNT, shared_memory=DEFAULT_SHARED_MEMORY)
+
+RESOURCE_FIELDS = tuple(field.name for field in fields(Resources))
+
+
+@dataclass(frozen=True)
+class TaskSpec:
+    """
+    One task of an experiment. All tasks of an experiment run the same image at the same time.
+    """
+
+    name: str = DEFAULT_TASK_NAME
+    entrypoint: Optional[str] = None
+    """
+    Overrides the ``ENTRYPOINT`` of the image.
+    """
+    cmd: Optional[str] = None
+    """
+    Overrides the ``CMD`` of the image.
+    """
+    resources: Resources = DEFAULT_RESOURCES
+
+    def validate(self):
+        if not isinstance(self.name, str) or _TASK_NAME_RE.fullmatch(self.name) is None:
+            raise NaaclUtilsError(
+                f"Invalid task name {self.name!r}. Names can only contain letters, digits, "
+                "dashes, underscores, and dots."
+            )
+        for name in ("entrypoint", "cmd"):
+            value = getattr(self, name)
+            if value is not None and not isinstance(value, str):
+                raise NaaclUtilsError(f"Invalid {name} {value!r}, expected a string")
+        self.resources.validate()
+
+    def entrypoint_args(self) -> Optional[List[str]]:
+        """
+        The ``entrypoint`` split into arguments the way a shell would, if it's given.
+        """
+        return None if self.entrypoint is None else split_arg_string(self.entrypoint)
+
+    def cmd_args(self) -> Optional[List[str]]:
+        """
+        The ``cmd`` split into arguments the way a shell would, if it's given.
+        """
+        return None if self.cmd is None else split_arg_string(self.cmd)
+
+    def to_beaker(self, image_id: str, cluster: str) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "image": {"beaker": image_id},
+            "context": {"cluster": cluster},
+            "result": {"path": "/unused"},  # required even if the task produces no output.
+            "command": self.entrypoint_args(),
+            "arguments": self.cmd_args(),
+            "resources": self.resources.to_beaker(),
+        }
+
+
+def validate_tasks(tasks: Sequence[TaskSpec]):
+    """
+    Check the tasks of an experiment, raising a :class:`~naacl_utils.exceptions.NaaclUtilsError`
+    that points at the first invalid one.
+    """
+    if not tasks:
+        raise NaaclUtilsError("An experiment needs at least one task")
+    seen_names = set()
+    for i, task in enumerate(tasks, start=1):
+        try:
+            task.validate()
+        except NaaclUtilsError as exc:
+            raise NaaclUtilsError(f"Task {i} ('{task.name}'): {exc}")
+        if task.name in seen_names:
+            raise NaaclUtilsError(f"Task name '{task.name}' appears more than once")
+        seen_names.add(task.name)
+
+
+def make_experiment_spec(image_id: str, tasks: Sequence[TaskSpec], cluster: str) -> Dict[str, Any]:
+    """
+    Build the Beaker experiment spec for running ``tasks`` with the image ``image_id``.
+    """
+    return {"version": "v2-alpha", "tasks": [task.to_beaker(image_id, cluster) for task in tasks]}
+
+
+def load_task_specs(path: PathOrStr, defaults: TaskSpec = TaskSpec()) -> List[TaskSpec]:
+    """
+    Load and validate the tasks from a spec file. The spec file can either be YAML
+    (``.yml``/``.yaml``) or JSON, with a list of ``tasks``, e.g.
+
+    .. code-block:: yaml
+
+        tasks:
+          - name: dev
+            cmd: python evaluate.py --split dev
+            shared_memory: 8GiB
+          - name: test
+            cmd: python evaluate.py --split test
+            shared_memory: 8GiB
+            cpu_count: 4
+
+    Each task can have a ``name``, ``entrypoint``, ``cmd``, and any of the resources of
+    :class:`Resources`. Anything that a task leaves out is taken from ``defaults``,
+    except for its name, which is required when there's more than one task.
+    """
+    path = Path(path)
+    spec: Any
+    with path.open() as spec_file:
+        if path.suffix in (".yml", ".yaml"):
+            import yaml
+
+            try:
+                spec = yaml.safe_load(spec_file)
+            except yaml.YAMLError as exc:
+                raise NaaclUtilsError(f"Failed to parse spec '{path}': {exc}")
+        else:
+            try:
+                spec = json.load(spec_file)
+            except ValueError as exc:
+                raise NaaclUtilsError(f"Failed to parse spec '{path}': {exc}")
+
+    if not isinstance(spec, dict) or not isinstance(spec.get("tasks"), list):
+        raise NaaclUtilsError(f"Spec '{path}' must be a mapping with a list of 'tasks'")
+    unknown = sorted(set(spec) - {"tasks"})
+    if unknown:
+        raise NaaclUtilsError(f"Spec '{path}' has unknown field(s): {', '.join(unknown)}")
+
+    allowed_fields = {"name", "entrypoint", "cmd", *RESOURCE_FIELDS}
+    tasks = []
+    for i, task in enumerate(spec["tasks"], start=1):
+        if not isinstance(task, dict):
+            raise NaaclUtilsError(f"Task {i} in spec '{path}' must be a mapping")
+        unknown = sorted(set(task) - allowed_fields)
+        if unknown:
+            raise NaaclUtilsError(
+                f"Task {i} in spec '{path}' has unknown field(s): {', '.join(unknown)}"
+            )
+        if "name" not in task and len(spec["tasks"]) > 1:
+            raise NaaclUtilsError(
+                f"Task {i} in spec '{path}' needs a 'name' since there's more than one task"
+            )
+        resources = {field: task.pop(field) for field in RESOURCE_FIELDS if field in task}
+        # Plain numbers of bytes are fine for sizes too.
+        for field in ("memory", "shared_memory"):
+            if isinstance(resources.get(field), int) and not isinstance(resources[field], bool):
+                resources[field] = str(resources[field])
+        tasks.append(replace(defaults, resources=replace(defaults.resources, **resources), **task))
+
+    try:
+        validate_tasks(tasks)
+    except NaaclUtilsError as exc:
+        raise NaaclUtilsError(f"Invalid spec '{path}': {exc}")
+    return tasks
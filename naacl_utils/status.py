@@ -0,0 +1,158 @@
+"""
+Summarizing the state of runs.
+"""
+
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from .aio import AsyncBeaker
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELED = "canceled"
+TERMINAL_STATES = (SUCCEEDED, FAILED, CANCELED)
+# A run that failed can still be retried, which adds a new job, so only these never change.
+FINAL_STATES = (SUCCEEDED, CANCELED)
+
+
+logger = logging.getLogger("naacl_utils")
+
+
+def sorted_jobs(experiment: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Get the jobs of a Beaker experiment, oldest first.
+    """
+    # Beaker gives the creation times as ISO 8601 timestamps, which sort chronologically.
+    return sorted(
+        experiment.get("jobs") or [], key=lambda job: job.get("status", {}).get("created") or ""
+    )
+
+
+def job_task(job: Dict[str, Any]) -> Optional[str]:
+    """
+    Get the ID of the task that a Beaker job runs. Every task of an experiment gets a job,
+    and retrying a task that failed adds another job for the same task.
+    """
+    # A job without a task can't be told apart from other tasks, so it's treated as its own.
+    return (job.get("execution") or {}).get("task") or job.get("id")
+
+
+def job_task_name(job: Dict[str, Any]) -> Optional[str]:
+    """
+    Get the name of the task that a Beaker job runs, as given in the spec of the experiment.
+    """
+    execution = job.get("execution") or {}
+    return (execution.get("spec") or {}).get("name") or job.get("name")
+
+
+def latest_jobs(experiment: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Get the most recently created job of each task of a Beaker experiment, in the order that
+    the tasks were first run.
+    """
+    latest: Dict[Optional[str], Dict[str, Any]] = {}
+    for job in sorted_jobs(experiment):
+        latest[job_task(job)] = job
+    return list(latest.values())
+
+
+def job_state(job: Dict[str, Any]) -> str:
+    """
+    Get the state of a Beaker job.
+    """
+    status = job.get("status", {})
+    if status.get("canceled") is not None:
+        return CANCELED
+    if status.get("exitCode") is not None:
+        return SUCCEEDED if status["exitCode"] == 0 else FAILED
+    if status.get("finalized") is not None:
+        return FAILED
+    if status.get("started") is not None:
+        return RUNNING
+    return PENDING
+
+
+def experiment_state(experiment: Dict[str, Any]) -> str:
+    """
+    Get the state of a Beaker experiment from the latest job of each of its tasks. It's still
+    running while any of them is, and once they've all finished, it only succeeded if every one
+    of them did.
+    """
+    states = {job_state(job) for job in latest_jobs(experiment)}
+    for state in (RUNNING, PENDING, FAILED, CANCELED):
+        if state in states:
+            return state
+    return SUCCEEDED if states else PENDING
+
+
+def run_status(experiment: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Summarize the status of the run of a Beaker experiment. The exit code is that of the first
+    task that failed, if any did.
+    """
+    exit_codes = [job.get("status", {}).get("exitCode") for job in latest_jobs(experiment)]
+    failed = [exit_code for exit_code in exit_codes if exit_code not in (None, 0)]
+    return {
+        "run_name": experiment["name"],
+        "state": experiment_state(experiment),
+        "exit_code": failed[0] if failed else next(iter(exit_codes), None),
+    }
+
+
+async def get_run_statuses(
+    aio: "AsyncBeaker", workspace: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """
+    Get the status of every run in a workspace, in the order that Beaker lists them.
+
+    Experiments are listed a page at a time. Runs that succeeded or were canceled are cached
+    locally and never looked up again, but runs that failed are since they can be retried.
+    The status of the other runs comes from the listing if it includes their jobs. Otherwise,
+    each experiment is fetched concurrently, while the next pages are being listed.
+    """
+    # This module is imported when the CLI starts up, so 'asyncio' is only imported when needed.
+    import asyncio
+
+    beaker = aio.beaker
+    workspace = workspace or beaker.config.default_workspace
+    assert workspace is not None
+    cached = await aio.get_cached_run_statuses(workspace)
+    statuses: Dict[str, Dict[str, Any]] = {}
+    fetches: Dict[str, asyncio.Future] = {}
+    pages = beaker.iter_experiment_pages(workspace)
+
+    def next_page() -> Optional[List[Dict[str, Any]]]:
+        return next(pages, None)
+
+    try:
+        while True:
+            page = await aio.call(next_page)
+            if page is None:
+                break
+            for experiment in page:
+                exp_id = experiment["id"]
+                if exp_id in cached and cached[exp_id].get("state") in FINAL_STATES:
+                    statuses[exp_id] = cached[exp_id]
+                elif "jobs" in experiment:
+                    statuses[exp_id] = run_status(experiment)
+                else:
+                    statuses[exp_id] = {}
+                    fetches[exp_id] = asyncio.ensure_future(aio.get_experiment(exp_id))
+        for exp_id, fetch in fetches.items():
+            statuses[exp_id] = run_status(await fetch)
+    finally:
+        for fetch in fetches.values():
+            fetch.cancel()
+
+    finished = {
+        exp_id: status
+        for exp_id, status in statuses.items()
+        if status["state"] in FINAL_STATES and cached.get(exp_id) != status
+    }
+    if finished:
+        logger.debug("Caching the status of %d finished run(s)", len(finished))
+        await aio.cache_run_statuses(workspace, finished)
+    return list(statuses.values())
@@ -0,0 +1,48 @@
+import asyncio
+import threading
+
+import pytest
+
+from naacl_utils import aio
+
+
+class FakeClient:
+    name = "fake"
+
+    def __init__(self, timeout: float = 5.0):
+        self.barrier = threading.Barrier(2, timeout=timeout)
+
+    def rendezvous(self, value: int) -> int:
+        # Only returns if another call is waiting at the same time.
+        self.barrier.wait()
+        return value
+
+
+async def rendezvous_twice(async_beaker: aio.AsyncBeaker):
+    return await asyncio.gather(
+        async_beaker.rendezvous(1), async_beaker.call(async_beaker.beaker.rendezvous, 2)
+    )
+
+
+def test_calls_run_concurrently():
+    assert aio.run(FakeClient(), rendezvous_twice) == [1, 2]  # type: ignore[arg-type]
+
+
+def test_run_within_event_loop():
+    async def main():
+        return aio.run(FakeClient(), rendezvous_twice)  # type: ignore[arg-type]
+
+    assert asyncio.run(main()) == [1, 2]
+
+
+def test_calls_are_limited_to_workers():
+    with pytest.raises(threading.BrokenBarrierError):
+        aio.run(FakeClient(timeout=0.1), rendezvous_twice, workers=1)  # type: ignore[arg-type]
+
+
+def test_only_methods_are_wrapped():
+    with aio.AsyncBeaker(FakeClient()) as async_beaker:  # type: ignore[arg-type]
+        with pytest.raises(AttributeError):
+            async_beaker.name
+        with pytest.raises(AttributeError):
+            async_beaker.missing
@@ -0,0 +1,179 @@
+import asyncio
+import gc
+import gzip
+import logging
+import threading
+
+import pytest
+
+from naacl_utils import api
+from naacl_utils.api import ALL_JOBS, JOB_POLICIES, Session
+from naacl_utils.client import PERMISSIONS_TTL_ENV_VAR
+from naacl_utils.exceptions import NaaclUtilsError
+from naacl_utils.logs import MIN_MAX_MEMORY
+from naacl_utils.spec import TaskSpec
+from naacl_utils.status import FAILED, run_status
+
+from .conftest import FAKE_DOCKER_IMAGE
+
+
+def test_session_drives_many_runs(fake_env, fake_beaker, fake_docker, monkeypatch):
+    # Without the on-disk cache, every new client would look up the user and check permissions.
+    monkeypatch.setenv(PERMISSIONS_TTL_ENV_VAR, "0")
+    run_names = [f"run-{i}" for i in range(3)]
+    session = Session()
+    for run_name in run_names:
+        session.submit(FAKE_DOCKER_IMAGE, run_name)
+    assert {run_name for run_name, _ in session.wait(run_names)} == set(run_names)
+
+    results = [session.verify(run_name, [["Hello from Docker!"]]) for run_name in run_names]
+    assert all(result.verified for result in results)
+    assert len(fake_beaker.datasets) == 3
+    assert len(fake_docker.pushed) == 1
+
+    assert fake_beaker.requests.count(("GET", "/api/v3/user")) == 1
+    workspace = f"/api/v3/workspaces/NAACL/{fake_beaker.user}"
+    assert fake_beaker.requests.count(("GET", workspace)) == 1
+
+
+def test_session_within_event_loop(fake_env, fake_beaker):
+    experiment = fake_beaker.add_experiment("run-1")
+
+    async def find():
+        return Session().find("run-1")
+
+    assert asyncio.run(find())["id"] == experiment.id
+
+
+def test_verify_mismatch(fake_env, fake_beaker):
+    fake_beaker.add_experiment("run-1", output="Hello from Beaker!\n")
+    result = Session().verify("run-1", [["Hello from Docker!"], ["Hello from Beaker!"]])
+    assert not result.verified
+    assert result.jobs[0].matcher.missing == [0]
+    assert not fake_beaker.datasets
+
+
+def test_verify_jobs(fake_env, fake_beaker):
+    # A failed job that was retried.
+    experiment = fake_beaker.add_experiment(
+        "run-1",
+        jobs=[
+            {"task": "tk-1", "output": "Hello from Docker!\n", "created": "2022-05-10T12:00:00Z"},
+            {"task": "tk-1", "output": "Hello from Beaker!\n", "created": "2022-05-10T14:00:00Z"},
+            {"task": "tk-1", "output": "Oops\n", "exit_code": 1, "created": "2022-05-10T13:00:00Z"},
+        ],
+    )
+    first_job, last_job, failed_job = experiment.jobs
+    session = Session()
+    result = session.verify("run-1", [["Hello from Beaker!"]])
+    assert result.verified
+    assert [job.job_id for job in result.jobs] == [last_job.id]
+    # The failed attempt doesn't count, since it was retried.
+    result = session.verify("run-1", [["Hello from Beaker!"]], jobs=ALL_JOBS)
+    assert [job.job_id for job in result.jobs] == [first_job.id, last_job.id]
+    assert [job.job_id for job in result.failed_jobs] == [first_job.id]
+
+    failed_job.exit_code = 0
+    result = session.verify("run-1", [["Hello from Docker!"]], jobs=ALL_JOBS)
+    assert not result.verified
+    assert [job.job_id for job in result.jobs] == [first_job.id, failed_job.id, last_job.id]
+    assert [job.job_id for job in result.failed_jobs] == [failed_job.id, last_job.id]
+
+    # Until the latest attempt succeeds, the task failed.
+    last_job.exit_code = 1
+    with pytest.raises(NaaclUtilsError, match="completed successfully"):
+        session.verify("run-1", [["Hello from Docker!"]], jobs=ALL_JOBS)
+
+
+def test_failed_task_of_run(fake_env, fake_beaker, fake_docker):
+    session = Session()
+    session.submit(FAKE_DOCKER_IMAGE, "run-1", [TaskSpec(name="dev"), TaskSpec(name="test")])
+    (experiment,) = fake_beaker.experiments.values()
+    dev_job, test_job = experiment.jobs
+    assert dev_job.task != test_job.task
+    # The job of the other task was created later, but that doesn't hide the failure.
+    dev_job.exit_code = 3
+    test_job.created = "2022-05-10T13:00:00Z"
+
+    ((_, finished),) = session.wait(["run-1"])
+    assert run_status(finished) == {"run_name": "run-1", "state": FAILED, "exit_code": 3}
+    assert [status["state"] for status in session.status()] == [FAILED]
+    for jobs in JOB_POLICIES:
+        with pytest.raises(NaaclUtilsError, match="1 of the 2 tasks"):
+            session.verify("run-1", [["Hello from Docker!"]], jobs=jobs)
+
+    dev_job.exit_code = 0
+    result = session.verify("run-1", [["Hello from Docker!"]])
+    assert [job.job_id for job in result.jobs] == [dev_job.id, test_job.id]
+    assert result.verified
+
+
+def test_verify_all_jobs_concurrently(fake_env, fake_beaker, monkeypatch):
+    experiment = fake_beaker.add_experiment(
+        "run-1", jobs=[{"output": f"Task {i}\nacc 0.91\n", "log_size": 10_000} for i in range(3)]
+    )
+    # Every job has to wait for the others, which only works if they're matched concurrently.
+    barrier = threading.Barrier(3, timeout=5)
+    match_logs = api.match_logs
+
+    def match_logs_together(*args, **kwargs):
+        barrier.wait()
+        return match_logs(*args, **kwargs)
+
+    monkeypatch.setattr(api, "match_logs", match_logs_together)
+    max_memory = 3 * MIN_MAX_MEMORY
+    result = Session().verify(
+        "run-1", [["acc 0.91"]], upload_logs=True, jobs=ALL_JOBS, max_memory=max_memory
+    )
+    assert result.verified
+    assert [job.verified for job in result.jobs] == [True] * 3
+    # The logs are read back with the same share of the budget that they were matched with.
+    assert result.max_memory == MIN_MAX_MEMORY
+
+    (dataset,) = fake_beaker.datasets.values()
+    for i, job in enumerate(experiment.jobs):
+        logs = gzip.decompress(dataset["files"][f"actual-{job.id}.log.gz"]).decode()
+        assert logs.endswith(f"Task {i}\nacc 0.91\n")
+
+
+def test_submit_many(fake_env, fake_beaker, fake_docker):
+    session = Session()
+    with pytest.raises(NaaclUtilsError, match="at least one task"):
+        session.submit_many([(FAKE_DOCKER_IMAGE, "run-1", [])])
+    assert not fake_beaker.requests
+
+    task = TaskSpec()
+    results = session.submit_many(
+        [(FAKE_DOCKER_IMAGE, "run-1", [task]), ("missing-image", "run-2", [task])]
+    )
+    assert isinstance(results[0], dict)
+    assert "not found locally" in str(results[1])
+    (experiment,) = fake_beaker.experiments.values()
+    assert experiment.name == "run-1"
+
+
+def test_submit_many_skips_uploads_for_existing_runs(fake_env, fake_beaker, fake_docker):
+    fake_beaker.add_experiment("run-1")
+    session = Session()
+    (result,) = session.submit_many([(FAKE_DOCKER_IMAGE, "run-1", [TaskSpec()])])
+    assert "A run with the name 'run-1' already exists" in str(result)
+    assert not fake_docker.pushed
+
+    results = session.submit_many(
+        [(FAKE_DOCKER_IMAGE, "run-1", [TaskSpec()]), (FAKE_DOCKER_IMAGE, "run-2", [TaskSpec()])]
+    )
+    assert "A run with the name 'run-1' already exists" in str(results[0])
+    assert isinstance(results[1], dict)
+    assert len(fake_docker.pushed) == 1
+
+
+def test_submit_many_retrieves_every_upload_error(fake_env, fake_beaker, fake_docker, caplog):
+    fake_beaker.add_experiment("run-1")
+    with caplog.at_level(logging.ERROR, logger="asyncio"):
+        (result,) = Session().submit_many([(FAKE_DOCKER_IMAGE, "run-1", [TaskSpec()])])
+        assert "A run with the name 'run-1' already exists" in str(result)
+        # Unretrieved task exceptions are only logged once the task is garbage collected,
+        # and the traceback of the result could keep it alive.
+        del result
+        gc.collect()
+    assert "exception was never retrieved" not in caplog.text
@@ -0,0 +1,100 @@
+"""
+End-to-end benchmarks of the CLI commands against a local fake Beaker server.
+
+The latency of the fake server and the size of the logs can be set with
+the ``NAACL_UTILS_BENCHMARK_LATENCY`` (seconds per request) and ``NAACL_UTILS_BENCHMARK_LOG_SIZE``
+(bytes) environment variables. Besides the timings, the peak memory use of every command
+is recorded as ``peak_memory_bytes`` in the extra info of each benchmark.
+"""
+
+import itertools
+import os
+import tracemalloc
+from typing import Callable, List
+
+import pytest
+from click.testing import CliRunner, Result
+
+from naacl_utils.__main__ import main
+from naacl_utils.cache import LOG_CACHE_SIZE_ENV_VAR
+
+from .conftest import FAKE_DOCKER_IMAGE
+
+LATENCY = float(os.environ.get("NAACL_UTILS_BENCHMARK_LATENCY", 0.01))
+LOG_SIZE = int(os.environ.get("NAACL_UTILS_BENCHMARK_LOG_SIZE", 32 * 1024**2))
+
+
+def invoke(args: List[str], expect_success: bool = True) -> Result:
+    result = CliRunner().invoke(main, args)
+    if expect_success:
+        assert result.exception is None, result.output
+    else:
+        assert result.exception is not None
+    return result
+
+
+def peak_memory(func: Callable[[], object]) -> int:
+    """
+    Get the peak memory allocated by Python while running ``func``, in bytes.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(benchmark, func: Callable[[], object], rounds: int = 3):
+    benchmark.extra_info["peak_memory_bytes"] = peak_memory(func)
+    benchmark.pedantic(func, rounds=rounds, warmup_rounds=0)
+
+
+@pytest.fixture
+def bench_env(fake_env, fake_beaker):
+    fake_beaker.latency = LATENCY
+    fake_beaker.log_size = LOG_SIZE
+    return fake_env
+
+
+def test_setup(benchmark, bench_env):
+    run_benchmark(benchmark, lambda: invoke(["setup"]))
+
+
+def test_submit(benchmark, bench_env):
+    run_names = (f"run-{i}" for i in itertools.count())
+    run_benchmark(benchmark, lambda: invoke(["submit", FAKE_DOCKER_IMAGE, next(run_names)]))
+
+
+@pytest.mark.parametrize("list_jobs", [True, False], ids=["listed", "fetched"])
+def test_status(benchmark, bench_env, fake_beaker, list_jobs: bool):
+    fake_beaker.list_jobs = list_jobs
+    for i in range(300):
+        fake_beaker.add_experiment(f"run-{i}", polls_until_finished=i % 2 * 1000)
+    run_benchmark(benchmark, lambda: invoke(["status"]))
+
+
+@pytest.mark.parametrize("cached", [False, True], ids=["download", "cached"])
+def test_verify(benchmark, bench_env, fake_beaker, monkeypatch, cached: bool):
+    if not cached:
+        monkeypatch.setenv(LOG_CACHE_SIZE_ENV_VAR, "0")
+    fake_beaker.add_experiment("run-1")
+    expected_output = bench_env / "out.log"
+    expected_output.write_text(fake_beaker.output)
+    args = ["verify", "run-1", str(expected_output)]
+    if cached:
+        invoke(args)
+
+    run_benchmark(benchmark, lambda: invoke(args))
+    # Logs are streamed, so memory use shouldn't grow with the size of the logs.
+    assert benchmark.extra_info["peak_memory_bytes"] < max(LOG_SIZE // 4, 8 * 1024**2)
+
+
+def test_verify_failure(benchmark, bench_env, fake_beaker):
+    fake_beaker.add_experiment("run-1", output="Hello from Beaker!\n")
+    expected_output = bench_env / "out.log"
+    expected_output.write_text("Hello from Docker!\n")
+    args = ["verify", "run-1", str(expected_output)]
+
+    run_benchmark(benchmark, lambda: invoke(args, expect_success=False))
+    assert benchmark.extra_info["peak_memory_bytes"] < max(LOG_SIZE // 4, 8 * 1024**2)
@@ -0,0 +1,156 @@
+import gzip
+import os
+from typing import Iterator, Optional
+
+import pytest
+
+from naacl_utils import cache
+from naacl_utils.cache import LogCache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(cache.CACHE_DIR_ENV_VAR, str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def test_json_entries(cache_dir):
+    assert cache.read_json("test.json") is None
+    cache.write_json("test.json", {"a": 1})
+    assert cache.read_json("test.json") == {"a": 1}
+    cache.remove("test.json")
+    assert cache.read_json("test.json") is None
+
+
+def test_log_cache_round_trip():
+    log_cache = LogCache()
+    assert log_cache.read("ex1") is None
+    chunks = [b"2022 line 1\n", b"2022 line 2\n"]
+    assert list(log_cache.write_through("ex1", iter(chunks))) == chunks
+    cached = log_cache.read("ex1")
+    assert cached is not None
+    assert b"".join(cached) == b"".join(chunks)
+
+
+def test_log_cache_keys_are_escaped():
+    log_cache = LogCache()
+    list(log_cache.write_through("user/run-1", [b"line 1\n"]))
+    assert log_cache.path("user/run-1").parent == log_cache.directory
+    assert [entry["key"] for entry in log_cache.entries()] == ["user/run-1"]
+
+
+def test_log_cache_ignores_partial_downloads(cache_dir):
+    log_cache = LogCache()
+    chunks = log_cache.write_through("ex1", iter([b"line 1\n", b"line 2\n"]))
+    next(chunks)
+    chunks.close()
+    assert log_cache.read("ex1") is None
+    assert not os.listdir(cache_dir / LogCache.DIRECTORY)
+
+
+def test_log_cache_evicts_least_recently_used():
+    log_cache = LogCache()
+    for key in ("ex1", "ex2"):
+        list(log_cache.write_through(key, [os.urandom(1000)]))
+    os.utime(log_cache.path("ex1"), (0, 0))
+    log_cache.max_size = log_cache.path("ex2").stat().st_size + 100
+    log_cache.evict()
+    assert [entry["key"] for entry in log_cache.entries()] == ["ex2"]
+
+
+def test_clear(cache_dir):
+    cache.write_json("test.json", {"a": 1})
+    list(LogCache().write_through("ex1", [b"line 1\n"]))
+    cache.clear(logs_only=True)
+    assert LogCache().entries() == []
+    assert cache.read_json("test.json") == {"a": 1}
+    leftover = cache_dir / ".test.json.abc.tmp"
+    leftover.write_text("{")
+    cache.clear()
+    assert cache.read_json("test.json") is None
+    assert not leftover.exists()
+
+
+def test_unusable_cache_dir(tmp_path, monkeypatch):
+    # The cache directory can't be created under a file.
+    (tmp_path / "file").write_text("")
+    monkeypatch.setenv(cache.CACHE_DIR_ENV_VAR, str(tmp_path / "file" / "cache"))
+    cache.write_json("test.json", {"a": 1})
+    assert cache.read_json("test.json") is None
+
+    log_cache = LogCache()
+    assert b"".join(log_cache.write_through("ex1", [b"line 1\n"])) == b"line 1\n"
+    assert b"".join(log_cache.download("ex2", fetcher(b"line 2\n"))) == b"line 2\n"
+    assert log_cache.read("ex1") is None
+    assert log_cache.read("ex2") is None
+
+
+class Interrupted(Exception):
+    pass
+
+
+def fetcher(data: bytes, fail_at: Optional[int] = None, chunk_size: int = 100):
+    """
+    Make a ``fetch`` function for :meth:`LogCache.download()` that serves ``data`` from an offset,
+    failing once it has served ``fail_at`` bytes in total. The offsets it's called with are
+    recorded in ``fetch.offsets``.
+    """
+
+    def fetch(offset: int) -> Iterator[bytes]:
+        fetch.offsets.append(offset)  # type: ignore
+        for start in range(offset, len(data), chunk_size):
+            if fail_at is not None and start >= fail_at:
+                raise Interrupted()
+            yield data[start : start + chunk_size]
+
+    fetch.offsets = []  # type: ignore
+    return fetch
+
+
+def interrupted_download(log_cache: LogCache, key: str, data: bytes, fail_at: int):
+    with pytest.raises(Interrupted):
+        list(log_cache.download(key, fetcher(data, fail_at)))
+    assert log_cache.read(key) is None
+    (entry,) = log_cache.entries()
+    assert entry["partial"]
+
+
+@pytest.mark.parametrize("checkpoint_size", [LogCache.CHECKPOINT_SIZE, 250])
+def test_log_cache_download_resumes(monkeypatch, checkpoint_size: int):
+    monkeypatch.setattr(LogCache, "CHECKPOINT_SIZE", checkpoint_size)
+    log_cache = LogCache()
+    data = os.urandom(1000)
+    interrupted_download(log_cache, "ex1", data, fail_at=600)
+
+    fetch = fetcher(data)
+    assert b"".join(log_cache.download("ex1", fetch)) == data
+    assert fetch.offsets == [600]  # type: ignore
+    cached = log_cache.read("ex1")
+    assert cached is not None and b"".join(cached) == data
+    assert [entry["partial"] for entry in log_cache.entries()] == [False]
+
+
+def test_log_cache_download_ignores_data_after_last_checkpoint(monkeypatch):
+    monkeypatch.setattr(LogCache, "CHECKPOINT_SIZE", 250)
+    log_cache = LogCache()
+    data = os.urandom(1000)
+    interrupted_download(log_cache, "ex1", data, fail_at=600)
+    # Simulate a crash halfway through writing the next checkpoint.
+    with open(log_cache.partial_path("ex1"), "ab") as partial_file:
+        partial_file.write(b"\x1f\x8b\x08garbage")
+
+    fetch = fetcher(data)
+    assert b"".join(log_cache.download("ex1", fetch)) == data
+    assert fetch.offsets == [600]  # type: ignore
+
+
+def test_log_cache_download_starts_over_if_corrupted():
+    log_cache = LogCache()
+    data = os.urandom(1000)
+    interrupted_download(log_cache, "ex1", data, fail_at=600)
+    with gzip.open(log_cache.partial_path("ex1"), "wb") as partial_file:
+        partial_file.write(os.urandom(600))
+
+    fetch = fetcher(data)
+    assert b"".join(log_cache.download("ex1", fetch)) == data
+    assert fetch.offsets == [0]  # type: ignore
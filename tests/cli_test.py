@@ -0,0 +1,500 @@
+"""
+End-to-end tests of the CLI against a local fake Beaker server.
+"""
+
+import gzip
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from naacl_utils import cache, client, polling
+from naacl_utils.__main__ import main
+
+from .conftest import FAKE_DOCKER_IMAGE
+from .fake_beaker import FakeJob
+
+
+def test_setup(fake_env, fake_beaker):
+    result = CliRunner().invoke(main, ["setup"])
+    assert result.exception is None
+    assert f"authenticated as '{fake_beaker.user}'" in result.output
+    assert f"NAACL/{fake_beaker.user}" in fake_beaker.workspaces
+
+
+def test_setup_without_access(fake_env, fake_beaker):
+    fake_beaker.authorized = False
+    result = CliRunner().invoke(main, ["setup"])
+    assert "Unable to access NAACL organization" in str(result.exception)
+
+
+def test_submit_and_verify(fake_env, fake_beaker, fake_docker):
+    runner = CliRunner()
+    result = runner.invoke(main, ["submit", FAKE_DOCKER_IMAGE, "run-1"])
+    assert result.exception is None
+    assert "See progress at" in result.output
+    assert len(fake_docker.pushed) == 1
+
+    (experiment,) = fake_beaker.experiments.values()
+    assert experiment.name == "run-1"
+    assert experiment.spec["tasks"][0]["context"]["cluster"] == "NAACL/server"
+
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("Hello from Docker!\n")
+    result = runner.invoke(main, ["verify", "--wait", "run-1", str(expected_output)])
+    assert result.exception is None
+    assert "Results successfully verified" in result.output
+    (dataset,) = fake_beaker.datasets.values()
+    assert dataset["committed"]
+    assert dataset["files"]["out.log"] == b"Hello from Docker!"
+
+
+def test_submit_round_trips(fake_env, fake_beaker, fake_docker):
+    runner = CliRunner()
+    result = runner.invoke(main, ["submit", FAKE_DOCKER_IMAGE, "run-1"])
+    assert result.exception is None
+    # The permission check and the upload both make sure the workspace exists,
+    # but it's only created once.
+    assert fake_beaker.requests.count(("POST", "/api/v3/workspaces")) == 1
+
+    # With the permissions cached and the image already uploaded, submitting only needs to find
+    # the image and create the experiment.
+    fake_beaker.requests.clear()
+    result = runner.invoke(main, ["submit", FAKE_DOCKER_IMAGE, "run-2"])
+    assert result.exception is None
+    assert [method for method, _ in fake_beaker.requests] == ["GET", "POST"]
+
+
+def test_submit_rejects_existing_run_before_upload(fake_env, fake_beaker, fake_docker):
+    fake_beaker.add_experiment("run-1")
+    runner = CliRunner()
+    result = runner.invoke(main, ["submit", FAKE_DOCKER_IMAGE, "run-1"])
+    assert "A run with the name 'run-1' already exists" in str(result.exception)
+    assert not fake_docker.pushed
+
+    result = runner.invoke(main, ["submit", FAKE_DOCKER_IMAGE, "run-2"])
+    assert result.exception is None
+    assert any(e.name == "run-2" for e in fake_beaker.experiments.values())
+
+    # The run name is checked with a single lookup before anything is pushed.
+    fake_beaker.requests.clear()
+    result = runner.invoke(main, ["submit", "--force-upload", FAKE_DOCKER_IMAGE, "run-2"])
+    assert "A run with the name 'run-2' already exists" in str(result.exception)
+    assert len(fake_beaker.requests) == 1
+    assert len(fake_docker.pushed) == 1
+
+    # The experiment doesn't need to be looked up again to download its logs.
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("Hello from Docker!\n")
+    fake_beaker.requests.clear()
+    result = runner.invoke(main, ["verify", "--wait", "run-2", str(expected_output)])
+    assert result.exception is None
+    lookups = [path for _, path in fake_beaker.requests if path.startswith("/api/v3/experiments/")]
+    assert len(lookups) == 1
+
+
+def test_submit_spec(fake_env, fake_beaker, fake_docker):
+    spec = fake_env / "spec.yml"
+    spec.write_text(
+        "tasks:\n"
+        "  - name: dev\n"
+        "    cmd: python evaluate.py --split dev\n"
+        "  - name: test\n"
+        "    cmd: python evaluate.py --split test\n"
+        "    cpu_count: 4\n"
+    )
+    runner = CliRunner()
+    args = ["submit", FAKE_DOCKER_IMAGE, "run-1", "--spec", str(spec), "--shared-memory", "8GiB"]
+    result = runner.invoke(main, args)
+    assert result.exception is None
+
+    (experiment,) = fake_beaker.experiments.values()
+    dev, test = experiment.spec["tasks"]
+    assert dev["arguments"] == ["python", "evaluate.py", "--split", "dev"]
+    assert dev["resources"] == {"gpuCount": 1, "sharedMemory": "8GiB"}
+    assert test["resources"] == {"gpuCount": 1, "cpuCount": 4, "sharedMemory": "8GiB"}
+
+    # Invalid specs are caught before anything is uploaded.
+    fake_beaker.requests.clear()
+    result = runner.invoke(main, args[:3] + ["--memory", "4GiB", "--shared-memory", "8GiB"])
+    assert "can't be more than memory" in str(result.exception)
+    assert not fake_beaker.requests
+    assert len(fake_docker.pushed) == 1
+
+
+def test_preflight_and_verify(fake_env, fake_beaker, fake_docker):
+    fake_docker.output = "Loading...\nacc 0.91\n"
+    expected_output = fake_env / "out.log"
+    args = ["preflight", FAKE_DOCKER_IMAGE, "--cmd", "python eval.py --split 'dev set'"]
+    result = CliRunner().invoke(main, [*args, "-o", str(expected_output)])
+    assert result.exception is None
+    assert "acc 0.91" in result.output
+    assert fake_docker.runs == [
+        {
+            "image": FAKE_DOCKER_IMAGE,
+            "command": ["python", "eval.py", "--split", "dev set"],
+            "entrypoint": None,
+        }
+    ]
+    assert fake_docker.started[0].removed
+    assert expected_output.read_text() == "Loading...\nacc 0.91\n"
+
+    # The output is cached.
+    result = CliRunner().invoke(main, args)
+    assert result.exception is None
+    assert "Using the cached output" in result.output
+    assert len(fake_docker.runs) == 1
+
+    # The same output from Beaker is verified.
+    fake_beaker.add_experiment("run-1", output=fake_docker.output, log_size=10_000)
+    result = CliRunner().invoke(main, ["verify", "run-1", str(expected_output)])
+    assert result.exception is None
+
+    fake_docker.exit_code = 2
+    result = CliRunner().invoke(main, ["preflight", FAKE_DOCKER_IMAGE, "--no-cache"])
+    assert "exited with code 2" in str(result.exception)
+
+
+def test_verify_without_access(fake_env, fake_beaker):
+    fake_beaker.authorized = False
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("Hello from Docker!\n")
+    # The run is looked up during the permission check, but the failed check is what's reported.
+    result = CliRunner().invoke(main, ["verify", "run-1", str(expected_output)])
+    assert "Unable to access NAACL organization" in str(result.exception)
+
+
+def test_unusable_cache_dir(fake_env, fake_beaker, monkeypatch):
+    (fake_env / "file").write_text("")
+    monkeypatch.setenv(cache.CACHE_DIR_ENV_VAR, str(fake_env / "file" / "cache"))
+    fake_beaker.add_experiment("run-1")
+    runner = CliRunner()
+    result = runner.invoke(main, ["status"])
+    assert result.exception is None
+    assert "1 succeeded" in result.output
+
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("Hello from Docker!\n")
+    result = runner.invoke(main, ["verify", "run-1", str(expected_output)])
+    assert result.exception is None
+
+
+def test_verify_failure(fake_env, fake_beaker):
+    fake_beaker.add_experiment("run-1", output="Hello from Beaker!\n", log_size=100_000)
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("Hello from Docker!\n")
+    result = CliRunner().invoke(main, ["verify", "run-1", str(expected_output)])
+    assert "Expected output not found in logs" in str(result.exception)
+    assert "+Hello from Docker!" in result.output
+    assert "-Hello from Beaker!" in result.output
+    assert not fake_beaker.datasets
+
+    # The full logs are kept for inspection, gzipped.
+    (log_file,) = fake_env.glob("*.log.gz")
+    with gzip.open(log_file, "rt") as logs:
+        assert logs.read().rstrip().endswith("Hello from Beaker!")
+
+
+@pytest.mark.parametrize("log_cache_size", ["0", "100"])
+def test_verify_without_room_in_log_cache(fake_env, fake_beaker, monkeypatch, log_cache_size):
+    monkeypatch.setenv(cache.LOG_CACHE_SIZE_ENV_VAR, log_cache_size)
+    fake_beaker.add_experiment("run-1", output="Hello from Beaker!\n", log_size=100_000)
+    expected_output = fake_env / "out.log"
+    runner = CliRunner()
+
+    # The logs are downloaded once, even though they're read again for the diff.
+    expected_output.write_text("Hello from Docker!\n")
+    result = runner.invoke(main, ["verify", "run-1", str(expected_output)])
+    assert "-Hello from Beaker!" in result.output
+    assert len([path for _, path in fake_beaker.requests if path.endswith("/logs")]) == 1
+
+    # Or to upload them.
+    fake_beaker.requests.clear()
+    expected_output.write_text("Hello from Beaker!\n")
+    result = runner.invoke(main, ["verify", "--upload-logs", "run-1", str(expected_output)])
+    assert result.exception is None
+    assert len([path for _, path in fake_beaker.requests if path.endswith("/logs")]) == 1
+    (dataset,) = fake_beaker.datasets.values()
+    logs = gzip.decompress(dataset["files"]["actual.log.gz"]).decode()
+    assert logs.endswith("\nHello from Beaker!\n")
+    assert logs.startswith("Training...")
+
+
+def test_verify_with_memory_budget(fake_env, fake_beaker):
+    fake_beaker.add_experiment(
+        "run-1", output=f"progress {'#' * 1_000_000}\nacc 0.91\n", log_size=2_000_000
+    )
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("acc 0.91\n")
+    result = CliRunner().invoke(
+        main, ["verify", "run-1", str(expected_output), "--max-memory", "1MiB"]
+    )
+    assert result.exception is None
+    assert "Results successfully verified" in result.output
+
+    expected_output.write_text("acc 0.95\n")
+    result = CliRunner().invoke(
+        main, ["verify", "run-1", str(expected_output), "--max-memory", "1MiB"]
+    )
+    assert "Expected output not found in logs" in str(result.exception)
+    assert "+acc 0.95" in result.output
+    (log_file,) = fake_env.glob("*.log.gz")
+    with gzip.open(log_file, "rt") as logs:
+        progress, acc = logs.read().splitlines()[-3:-1]
+    assert acc == "acc 0.91"
+    assert len(progress) < 1024 * 1024 // 8 + 100
+    assert "bytes truncated ...]" in progress
+
+    result = CliRunner().invoke(
+        main, ["verify", "run-1", str(expected_output), "--max-memory", "100k"]
+    )
+    assert "too small" in str(result.exception)
+
+
+def test_verify_fragments(fake_env, fake_beaker):
+    fake_beaker.add_experiment(
+        "run-1", output="== dev ==\nacc 0.91\n== test ==\nacc 0.89\n", log_size=100_000
+    )
+    (fake_env / "dev.log").write_text("== dev ==\nacc 0.91\n")
+    (fake_env / "test.log").write_text("== test ==\nacc 0.89\n")
+    runner = CliRunner()
+
+    # Out of order, the test results come before the dev results.
+    args = ["verify", "run-1", str(fake_env / "test.log"), str(fake_env / "dev.log")]
+    result = runner.invoke(main, args + ["--ordered"])
+    assert "1 of 2 expected output fragments not found" in str(result.exception)
+    assert "Found at line" in result.output
+    assert "Not found after" in result.output
+    assert not fake_beaker.datasets
+
+    result = runner.invoke(main, args)
+    assert result.exception is None
+    (dataset,) = fake_beaker.datasets.values()
+    assert dataset["files"]["out-1.log"] == b"== test ==\nacc 0.89"
+    assert dataset["files"]["out-2.log"] == b"== dev ==\nacc 0.91"
+    # Both fragments were found in one pass over the logs.
+    assert len([path for _, path in fake_beaker.requests if path.endswith("/logs")]) == 1
+
+
+def test_verify_upload_logs(fake_env, fake_beaker):
+    fake_beaker.add_experiment("run-1", output="Hello from Docker!\nBye\n", log_size=100_000)
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("Hello from Docker!\n")
+    result = CliRunner().invoke(main, ["verify", "--upload-logs", "run-1", str(expected_output)])
+    assert result.exception is None
+
+    (dataset,) = fake_beaker.datasets.values()
+    assert dataset["files"]["out.log"] == b"Hello from Docker!"
+    logs = gzip.decompress(dataset["files"]["actual.log.gz"]).decode()
+    assert logs.endswith(
+        "Training... loss=0.1234 accuracy=0.5678 " + "." * 40 + "\nHello from Docker!\nBye\n"
+    )
+    assert "2022-05-10" not in logs
+    # The logs were cached while verifying, so they're only downloaded once.
+    assert len([path for _, path in fake_beaker.requests if path.endswith("/logs")]) == 1
+
+
+def test_verify_all_jobs(fake_env, fake_beaker):
+    experiment = fake_beaker.add_experiment(
+        "run-1",
+        jobs=[
+            {"task": "tk-1", "output": "== dev ==\nacc 0.91\n"},
+            {"task": "tk-1", "output": "== dev ==\nacc 0.89\n", "created": "2022-05-10T13:00:00Z"},
+        ],
+    )
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("acc 0.89\n")
+    # By default, only the latest job of each task is verified.
+    result = CliRunner().invoke(main, ["verify", "run-1", str(expected_output)])
+    assert result.exception is None
+
+    result = CliRunner().invoke(main, ["verify", "run-1", str(expected_output), "--jobs", "all"])
+    assert "not found in the logs of 1 of 2 jobs" in str(result.exception)
+    first_job, retry = experiment.jobs
+    assert retry.id in result.output
+    assert f"Job {first_job.id}:" in result.output
+    assert "-acc 0.91" in result.output
+
+
+def test_verify_tasks_with_different_output(fake_env, fake_beaker):
+    fake_beaker.add_experiment(
+        "run-1",
+        jobs=[
+            {"task_name": "dev", "output": "== dev ==\nacc 0.91\n"},
+            {"task_name": "test", "output": "== test ==\nacc 0.89\n"},
+        ],
+    )
+    (fake_env / "dev.log").write_text("== dev ==\nacc 0.91\n")
+    (fake_env / "test.log").write_text("== test ==\nacc 0.89\n")
+    runner = CliRunner()
+    args = ["verify", "run-1", str(fake_env / "dev.log"), str(fake_env / "test.log")]
+    result = runner.invoke(main, args)
+    assert "not found in the logs of 2 of 2 jobs" in str(result.exception)
+
+    result = runner.invoke(main, args[:3] + ["--task", "dev"])
+    assert result.exception is None
+    result = runner.invoke(main, args[:3] + ["--task", "train"])
+    assert "Run 'run-1' has no task named 'train', its tasks are: 'dev', 'test'" in str(
+        result.exception
+    )
+
+    result = runner.invoke(main, args + ["--any-job"])
+    assert result.exception is None
+    dataset = next(iter(fake_beaker.datasets.values()))
+    assert dataset["files"]["out-1.log"] == b"== dev ==\nacc 0.91"
+    assert dataset["files"]["out-2.log"] == b"== test ==\nacc 0.89"
+
+    (fake_env / "train.log").write_text("== train ==\n")
+    result = runner.invoke(main, args + [str(fake_env / "train.log"), "--any-job"])
+    assert "not found in the logs of 2 of 2 jobs" in str(result.exception)
+    # Only the fragment that's in neither job is diffed.
+    assert "+== train ==" in result.output
+    assert "+acc 0.91" not in result.output
+    result = runner.invoke(main, args + ["--any-job", "--ordered"])
+    assert "can't be ordered" in str(result.exception)
+
+
+def test_wait_for_run_with_failed_task(fake_env, fake_beaker):
+    fake_beaker.add_experiment(
+        "run-1",
+        jobs=[{"exit_code": 3}, {"created": "2022-05-10T13:00:00Z"}],
+    )
+    result = CliRunner().invoke(main, ["wait", "run-1"])
+    assert "1 of 1 run(s) failed" in str(result.exception)
+    assert "Run 'run-1' failed (exit code 3)" in result.output
+
+
+def test_wait_for_canceled_run(fake_env, fake_beaker):
+    fake_beaker.add_experiment("run-1", canceled=True)
+    result = CliRunner().invoke(main, ["wait", "run-1"])
+    assert "1 of 1 run(s) failed" in str(result.exception)
+    assert "Run 'run-1' canceled\n" in result.output
+
+
+def test_verify_resumes_log_download(fake_env, fake_beaker, monkeypatch):
+    monkeypatch.setattr(client, "BACKOFF_FACTOR", 0)
+    fake_beaker.add_experiment("run-1", log_size=100_000)
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("Hello from Docker!\n")
+    args = ["verify", "run-1", str(expected_output)]
+
+    fake_beaker.log_interruptions = [30_000] + [0] * (client.MAX_RETRIES + 1)
+    result = CliRunner().invoke(main, args)
+    assert "Run the command again to resume the download" in str(result.exception)
+
+    result = CliRunner().invoke(main, args)
+    assert result.exception is None
+    assert fake_beaker.log_ranges[-1] == "bytes=30000-"
+
+
+def test_submit_batch_and_verify_batch(fake_env, fake_beaker, fake_docker):
+    runner = CliRunner()
+    runs = fake_env / "runs.jsonl"
+    runs.write_text(
+        "".join(
+            json.dumps({"image": FAKE_DOCKER_IMAGE, "run_name": f"run-{i}"}) + "\n"
+            for i in range(3)
+        )
+    )
+    result = runner.invoke(main, ["submit-batch", str(runs)])
+    assert result.exception is None
+    assert len(fake_beaker.experiments) == 3
+    assert len(fake_docker.pushed) == 1
+
+    (fake_env / "out.log").write_text("Hello from Docker!\n")
+    verify_runs = fake_env / "verify.jsonl"
+    verify_runs.write_text(
+        "".join(
+            json.dumps({"run_name": f"run-{i}", "expected_output": "out.log"}) + "\n"
+            for i in range(3)
+        )
+    )
+    result = runner.invoke(main, ["verify-batch", str(verify_runs)])
+    assert result.exception is None
+    assert len(fake_beaker.datasets) == 3
+
+    (fake_env / "missing.log").write_text("Hello from Beaker!\n")
+    verify_runs.write_text(
+        json.dumps({"run_name": "run-0", "expected_output": ["out.log", "missing.log"]}) + "\n"
+    )
+    result = runner.invoke(main, ["verify-batch", str(verify_runs)])
+    assert "1 of 1 run(s) failed verification" in str(result.exception)
+    assert "(missing.log)" in result.output
+
+
+def test_verify_batch_with_wait(fake_env, fake_beaker, monkeypatch):
+    monkeypatch.setattr(polling.Backoff, "next", lambda self: 0.01)
+    fake_beaker.add_experiment("run-0", polls_until_finished=3)
+    fake_beaker.add_experiment("run-1", polls_until_finished=1_000_000)
+    (fake_env / "out.log").write_text("Hello from Docker!\n")
+    verify_runs = fake_env / "verify.jsonl"
+    verify_runs.write_text(
+        "".join(
+            json.dumps({"run_name": f"run-{i}", "expected_output": "out.log"}) + "\n"
+            for i in range(3)
+        )
+        + json.dumps({"run_name": "run-3", "expected_output": "missing.log"})
+        + "\n"
+    )
+    result = CliRunner().invoke(
+        main, ["verify-batch", "--wait", "--timeout", "1", "-j", "2", str(verify_runs)]
+    )
+    assert "3 of 4 run(s) failed verification" in str(result.exception)
+    assert "Timed out" in result.output
+    assert "Could not find" in result.output
+    assert "No such file" in result.output
+    assert len(fake_beaker.datasets) == 1
+
+
+@pytest.mark.parametrize("list_jobs", [True, False])
+def test_status(fake_env, fake_beaker, monkeypatch, list_jobs: bool):
+    monkeypatch.setattr(client, "EXPERIMENT_PAGE_SIZE", 2)
+    fake_beaker.list_jobs = list_jobs
+    fake_beaker.add_experiment("run-1")
+    failed = fake_beaker.add_experiment("run-2", exit_code=1)
+    pending = fake_beaker.add_experiment("run-3", polls_until_finished=1000)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["status"])
+    assert result.exception is None
+    assert "1 pending, 1 succeeded, 1 failed" in result.output
+    assert "exit code 1" in result.output
+    listings = [path for _, path in fake_beaker.requests if path.endswith("/experiments")]
+    assert len(listings) == 2
+
+    # Runs that succeeded are never looked up again, but failed runs can be retried.
+    (failed_job,) = failed.jobs
+    failed.jobs.append(
+        FakeJob(id="job-retry", task=failed_job.task, created="2022-05-10T13:00:00Z")
+    )
+    fake_beaker.requests.clear()
+    result = runner.invoke(main, ["status"])
+    assert result.exception is None
+    assert "1 pending, 2 succeeded" in result.output
+    lookups = {path for _, path in fake_beaker.requests if path.startswith("/api/v3/experiments/")}
+    expected_lookups = {f"/api/v3/experiments/{pending.id}", f"/api/v3/experiments/{failed.id}"}
+    assert lookups == (set() if list_jobs else expected_lookups)
+
+    fake_beaker.requests.clear()
+    result = runner.invoke(main, ["status"])
+    assert "1 pending, 2 succeeded" in result.output
+    lookups = {path for _, path in fake_beaker.requests if path.startswith("/api/v3/experiments/")}
+    assert lookups == (set() if list_jobs else {f"/api/v3/experiments/{pending.id}"})
+
+
+def test_profile(fake_env, fake_beaker):
+    fake_beaker.add_experiment("run-1", log_size=100_000)
+    expected_output = fake_env / "out.log"
+    expected_output.write_text("Hello from Docker!\n")
+    profile_output = fake_env / "profile.jsonl"
+    result = CliRunner().invoke(
+        main, ["--profile-output", str(profile_output), "verify", "run-1", str(expected_output)]
+    )
+    assert result.exception is None
+    assert "Profile" in result.output
+
+    spans = {span["name"]: span for span in map(json.loads, profile_output.open())}
+    assert {"client init", "find experiment", "match logs", "upload results"} <= set(spans)
+    assert spans["download logs"]["depth"] == spans["match logs"]["depth"] + 1
+    assert spans["download logs"]["bytes"] > 90_000
+    assert spans["upload results"]["bytes"] == len("Hello from Docker!")
@@ -0,0 +1,161 @@
+import time
+from unittest import mock
+
+import pytest
+import requests
+from beaker import Beaker, Config, HTTPError, ImageNotFound
+
+from naacl_utils import cache, client
+from naacl_utils.client import PERMISSIONS_TTL_ENV_VAR, NaaclBeaker
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(cache.CACHE_DIR_ENV_VAR, str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def http_error(status_code: int) -> HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return HTTPError(response=response)
+
+
+def test_user_is_cached_per_token():
+    beaker = NaaclBeaker(Config(user_token="token-1"))
+    with mock.patch.object(Beaker, "whoami", return_value={"name": "alice"}) as whoami:
+        assert beaker.user == "alice"
+        assert beaker.user == "alice"
+        assert NaaclBeaker(Config(user_token="token-1")).user == "alice"
+    assert whoami.call_count == 1
+
+    with mock.patch.object(Beaker, "whoami", return_value={"name": "bob"}):
+        assert NaaclBeaker(Config(user_token="token-2")).user == "bob"
+
+
+def test_permissions_cache_expires(monkeypatch):
+    beaker = NaaclBeaker(Config(user_token="token-1"))
+    assert not beaker.has_cached_permissions("NAACL/alice")
+    beaker.cache_permissions("NAACL/alice")
+    assert beaker.has_cached_permissions("NAACL/alice")
+    assert not beaker.has_cached_permissions("NAACL/bob")
+    assert not NaaclBeaker(Config(user_token="token-2")).has_cached_permissions("NAACL/alice")
+
+    monkeypatch.setenv(PERMISSIONS_TTL_ENV_VAR, "0")
+    assert not beaker.has_cached_permissions("NAACL/alice")
+
+
+def test_workspace_is_only_checked_once():
+    beaker = NaaclBeaker(Config(user_token="token-1"))
+    with mock.patch.object(Beaker, "ensure_workspace") as ensure_workspace:
+        beaker.ensure_workspace("NAACL/alice")
+        beaker.ensure_workspace("NAACL/alice")
+        assert ensure_workspace.call_count == 1
+
+        beaker.invalidate_permissions()
+        beaker.ensure_workspace("NAACL/alice")
+        assert ensure_workspace.call_count == 2
+
+        # Cached permissions mean the workspace exists.
+        beaker.cache_permissions("NAACL/bob")
+        assert beaker.has_cached_permissions("NAACL/bob")
+        beaker.ensure_workspace("NAACL/bob")
+        assert ensure_workspace.call_count == 2
+
+
+def test_permissions_cache_invalidated_on_403():
+    beaker = NaaclBeaker(Config(user_token="token-1"))
+    beaker.cache_permissions("NAACL/alice")
+    with mock.patch.object(Beaker, "request", side_effect=http_error(403)):
+        with pytest.raises(HTTPError):
+            beaker.get_experiment("alice/run-1")
+    assert not beaker.has_cached_permissions("NAACL/alice")
+
+
+def test_permissions_cache_kept_on_other_errors():
+    beaker = NaaclBeaker(Config(user_token="token-1"))
+    beaker.cache_permissions("NAACL/alice")
+    with mock.patch.object(Beaker, "request", side_effect=http_error(500)):
+        with pytest.raises(HTTPError):
+            beaker.get_experiment("alice/run-1")
+    assert beaker.has_cached_permissions("NAACL/alice")
+
+
+def test_image_index():
+    beaker = NaaclBeaker(Config(user_token="token-1"))
+    beaker._user = "alice"
+    assert beaker.find_uploaded_image("sha256:abc") is None
+
+    beaker.record_uploaded_image("sha256:abc", "im-1")
+    with mock.patch.object(Beaker, "get_image", return_value={"id": "im-1"}) as get_image:
+        assert beaker.find_uploaded_image("sha256:abc") == {"id": "im-1"}
+    get_image.assert_called_once_with("im-1")
+    assert beaker.find_uploaded_image("sha256:def") is None
+
+    # Images that have been deleted from Beaker are dropped from the index.
+    with mock.patch.object(Beaker, "get_image", side_effect=ImageNotFound("im-1")):
+        assert beaker.find_uploaded_image("sha256:abc") is None
+    with mock.patch.object(Beaker, "get_image") as get_image:
+        assert beaker.find_uploaded_image("sha256:abc") is None
+    get_image.assert_not_called()
+
+
+@pytest.mark.parametrize("max_in_memory", [1024, 1024 * 1024])
+def test_upload_dataset_from_memory_and_generators(
+    fake_env, fake_beaker, monkeypatch, max_in_memory: int
+):
+    monkeypatch.setattr(client, "MAX_IN_MEMORY_UPLOAD_SIZE", max_in_memory)
+    beaker = NaaclBeaker(
+        Config(
+            user_token=fake_beaker.token,
+            agent_address=fake_beaker.url,
+            default_workspace=f"NAACL/{fake_beaker.user}",
+        )
+    )
+    chunks = (b"%d\n" % i for i in range(10_000))
+    beaker.upload_dataset("run-1", {"out.log": b"Hello", "big.log": chunks})
+
+    (dataset,) = fake_beaker.datasets.values()
+    assert dataset["committed"]
+    assert dataset["files"]["out.log"] == b"Hello"
+    assert dataset["files"]["big.log"] == b"".join(b"%d\n" % i for i in range(10_000))
+
+
+@pytest.mark.parametrize("supports_ranges", [True, False])
+def test_get_logs_resumes_after_dropped_connection(fake_env, fake_beaker, supports_ranges: bool):
+    experiment = fake_beaker.add_experiment("run-1", log_size=100_000)
+    size, lines = experiment.jobs[0].log_lines()
+    fake_beaker.supports_ranges = supports_ranges
+    fake_beaker.log_interruptions = [30_000, 40_000]
+    beaker = NaaclBeaker(Config(user_token=fake_beaker.token, agent_address=fake_beaker.url))
+
+    assert b"".join(beaker.get_logs(experiment.jobs[0].id)) == b"".join(lines)
+    # Without range requests, the logs are downloaded from the start and the first part skipped.
+    resumed_at = 70_000 if supports_ranges else 40_000
+    assert fake_beaker.log_ranges == [None, "bytes=30000-", f"bytes={resumed_at}-"]
+
+
+def test_get_logs_resumes_after_stalled_connection(fake_env, fake_beaker, monkeypatch):
+    monkeypatch.setattr(client, "LOG_DOWNLOAD_TIMEOUT", (1.0, 0.2))
+    experiment = fake_beaker.add_experiment("run-1", log_size=100_000)
+    size, lines = experiment.jobs[0].log_lines()
+    fake_beaker.log_stalls = [30_000]
+    beaker = NaaclBeaker(Config(user_token=fake_beaker.token, agent_address=fake_beaker.url))
+
+    start = time.monotonic()
+    assert b"".join(beaker.get_logs(experiment.jobs[0].id)) == b"".join(lines)
+    assert time.monotonic() - start < fake_beaker.stall_seconds
+    assert fake_beaker.log_ranges == [None, "bytes=30000-"]
+
+
+def test_get_logs_gives_up_without_progress(fake_env, fake_beaker, monkeypatch):
+    monkeypatch.setattr(client, "BACKOFF_FACTOR", 0)
+    experiment = fake_beaker.add_experiment("run-1", log_size=100_000)
+    fake_beaker.log_interruptions = [30_000] + [0] * (client.MAX_RETRIES + 1)
+    beaker = NaaclBeaker(Config(user_token=fake_beaker.token, agent_address=fake_beaker.url))
+
+    received = bytearray()
+    with pytest.raises(client.NaaclUtilsError, match="failed after 30000 bytes"):
+        for chunk in beaker.get_logs(experiment.jobs[0].id):
+            received += chunk
+    assert len(received) == 30_000
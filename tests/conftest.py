@@ -0,0 +1,43 @@
+import tempfile
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from beaker import Config
+
+from naacl_utils import cache
+from naacl_utils.__main__ import NO_UPDATE_CHECK_ENV_VAR
+from naacl_utils.client import NaaclBeaker
+from naacl_utils.preflight import DockerRunner
+
+from .fake_beaker import FakeBeaker, FakeDocker
+
+FAKE_DOCKER_IMAGE = "hello-world"
+
+
+@pytest.fixture
+def fake_beaker() -> Iterator[FakeBeaker]:
+    with FakeBeaker() as beaker:
+        yield beaker
+
+
+@pytest.fixture
+def fake_docker(monkeypatch) -> FakeDocker:
+    docker_client = FakeDocker(FAKE_DOCKER_IMAGE)
+    monkeypatch.setattr(NaaclBeaker, "docker", property(lambda self: docker_client))
+    monkeypatch.setattr(DockerRunner, "docker", property(lambda self: docker_client))
+    return docker_client
+
+
+@pytest.fixture
+def fake_env(tmp_path: Path, monkeypatch, fake_beaker: FakeBeaker, fake_docker) -> Path:
+    """
+    Point the CLI at the fake Beaker server, with a fresh config, cache, and temporary directory.
+    """
+    monkeypatch.setenv(Config.ADDRESS_KEY, fake_beaker.url)
+    monkeypatch.setenv(Config.CONFIG_PATH_KEY, str(tmp_path / "config.yml"))
+    monkeypatch.setenv(Config.TOKEN_KEY, fake_beaker.token)
+    monkeypatch.setenv(cache.CACHE_DIR_ENV_VAR, str(tmp_path / "cache"))
+    monkeypatch.setenv(NO_UPDATE_CHECK_ENV_VAR, "1")
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    return tmp_path
@@ -0,0 +1,644 @@
+"""
+A local stand-in for the Beaker API, so that the CLI can be tested and benchmarked offline.
+
+Only the endpoints used by naacl-utils are implemented, and everything is kept in memory.
+Logs are generated on the fly, so huge logs can be served without holding them in memory.
+"""
+
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+import docker
+
+TIMESTAMP = "2022-05-10T12:00:00.000000000Z"
+
+
+@dataclass
+class FakeJob:
+    id: str
+    task: str
+    """
+    The ID of the task that the job runs. A retried task has several jobs.
+    """
+    output: str = "Hello from Docker!\n"
+    log_size: int = 0
+    """
+    The number of bytes of filler lines that are logged before the output.
+    """
+    exit_code: int = 0
+    polls_until_finished: int = 0
+    """
+    How many times the experiment can be fetched before this job reports its exit code.
+    """
+    created: str = TIMESTAMP
+    canceled: bool = False
+    task_name: Optional[str] = None
+    """
+    The name of the task in the spec of the experiment.
+    """
+
+    def status(self) -> Dict[str, Any]:
+        if self.canceled:
+            return {"created": self.created, "canceled": TIMESTAMP, "finalized": TIMESTAMP}
+        if self.polls_until_finished > 0:
+            self.polls_until_finished -= 1
+            return {"created": self.created}
+        return {"created": self.created, "exited": TIMESTAMP, "exitCode": self.exit_code}
+
+    def log_lines(self) -> Tuple[int, Iterator[bytes]]:
+        """
+        Get the total size and the lines of the logs, with timestamps like Beaker adds them.
+        """
+        filler = f"{TIMESTAMP} Training... loss=0.1234 accuracy=0.5678 {'.' * 40}\n".encode()
+        num_filler_lines = self.log_size // len(filler)
+        output = b"".join(
+            f"{TIMESTAMP} {line}\n".encode() for line in self.output.rstrip("\n").split("\n")
+        )
+        size = num_filler_lines * len(filler) + len(output)
+        return size, itertools.chain(itertools.repeat(filler, num_filler_lines), [output])
+
+
+@dataclass
+class FakeExperiment:
+    id: str
+    name: str
+    workspace: str
+    spec: Dict[str, Any]
+    jobs: List[FakeJob] = field(default_factory=list)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "fullName": f"{self.workspace.split('/')[1]}/{self.name}",
+            "workspace": {"fullName": self.workspace},
+            "jobs": [
+                {
+                    "id": job.id,
+                    "execution": {"task": job.task, "spec": {"name": job.task_name}},
+                    "status": job.status(),
+                }
+                for job in self.jobs
+            ],
+        }
+
+
+class FakeBeaker:
+    """
+    An in-memory fake Beaker server. Use it as a context manager to run it in a background thread.
+
+    :param latency: Seconds to wait before handling each request, to simulate a remote server.
+    :param authorized: If ``False``, the user doesn't have access to the NAACL organization.
+    """
+
+    def __init__(
+        self,
+        token: str = "fake-token",
+        user: str = "test-user",
+        latency: float = 0.0,
+        authorized: bool = True,
+    ):
+        self.token = token
+        self.user = user
+        self.latency = latency
+        self.authorized = authorized
+        self.log_size = 0
+        """
+        The default ``log_size`` of jobs for new experiments.
+        """
+        self.output = "Hello from Docker!\n"
+        """
+        The default ``output`` of jobs for new experiments.
+        """
+        self.workspaces: Dict[str, Dict[str, Any]] = {}
+        self.images: Dict[str, Dict[str, Any]] = {}
+        self.experiments: Dict[str, FakeExperiment] = {}
+        self.datasets: Dict[str, Dict[str, Any]] = {}
+        self.requests: List[Tuple[str, str]] = []
+        self.connections = 0
+        self.errors: List[int] = []
+        """
+        Status codes to fail the next requests with, one per request.
+        """
+        self.log_interruptions: List[int] = []
+        """
+        Byte counts after which to drop the connection of the next log downloads, one per download.
+        """
+        self.log_stalls: List[int] = []
+        """
+        Byte counts after which to stop sending the next log downloads, one per download, without
+        closing the connection until ``stall_seconds`` have passed.
+        """
+        self.stall_seconds = 2.0
+        self.log_ranges: List[Optional[str]] = []
+        """
+        The ``Range`` header of every log download.
+        """
+        self.supports_ranges = True
+        self.list_jobs = True
+        """
+        Whether experiment listings include the jobs of each experiment.
+        """
+        self.lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        assert self._server is not None
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeBeaker":
+        fake = self
+
+        class Handler(FakeBeakerHandler):
+            beaker = fake
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        assert self._server is not None and self._thread is not None
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def add_experiment(
+        self,
+        name: str,
+        workspace: Optional[str] = None,
+        spec: Optional[Dict[str, Any]] = None,
+        jobs: Optional[List[Dict[str, Any]]] = None,
+        **job_kwargs,
+    ) -> FakeExperiment:
+        """
+        Add an experiment with a single job. ``job_kwargs`` are passed to :class:`FakeJob`.
+        For an experiment with several jobs, pass the keyword arguments of each one in ``jobs``
+        instead. Each job runs a task of its own unless its ``task`` is given, so retries
+        of a task have to share the same ``task``.
+        """
+        fake_jobs = []
+        for kwargs in jobs or [job_kwargs]:
+            kwargs.setdefault("output", self.output)
+            kwargs.setdefault("log_size", self.log_size)
+            kwargs.setdefault("task", _new_id("tk"))
+            fake_jobs.append(FakeJob(id=_new_id("job"), **kwargs))
+        experiment = FakeExperiment(
+            id=_new_id("ex"),
+            name=name,
+            workspace=workspace or f"NAACL/{self.user}",
+            spec=spec or {},
+            jobs=fake_jobs,
+        )
+        with self.lock:
+            self.experiments[experiment.id] = experiment
+        return experiment
+
+    def find_experiment(self, experiment: str) -> Optional[FakeExperiment]:
+        with self.lock:
+            if experiment in self.experiments:
+                return self.experiments[experiment]
+            for candidate in self.experiments.values():
+                if f"{candidate.workspace.split('/')[1]}/{candidate.name}" == experiment:
+                    return candidate
+        return None
+
+    def find_job(self, job_id: str) -> Optional[FakeJob]:
+        with self.lock:
+            for experiment in self.experiments.values():
+                for job in experiment.jobs:
+                    if job.id == job_id:
+                        return job
+        return None
+
+    def find_image(self, image: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            if image in self.images:
+                return self.images[image]
+            for candidate in self.images.values():
+                if candidate["fullName"] == image:
+                    return candidate
+        return None
+
+
+class FakeBeakerHandler(BaseHTTPRequestHandler):
+    beaker: FakeBeaker
+    protocol_version = "HTTP/1.1"
+    # Headers and bodies are written separately, which would otherwise add a delayed ACK
+    # to every response on a kept-alive connection.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.beaker.lock:
+            self.beaker.connections += 1
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, method: str):
+        beaker = self.beaker
+        if beaker.latency:
+            time.sleep(beaker.latency)
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self._read_body()
+        with beaker.lock:
+            beaker.requests.append((method, path))
+            error = beaker.errors.pop(0) if beaker.errors else None
+        if error is not None:
+            return self._send_json({"message": "injected error"}, status=error)
+
+        if path.startswith("/storage/"):
+            return self._handle_storage(method, path[len("/storage/") :], body)
+
+        if self.headers.get("Authorization") != f"Bearer {beaker.token}":
+            return self._send_json({"message": "unauthorized"}, status=401)
+
+        for pattern, route_method, handler in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match is not None and route_method == method:
+                return handler(self, query, body, *match.groups())
+        self._send_json({"message": f"{method} {path} not found"}, status=404)
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    # Skip trailers.
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, data: Any, status: int = 200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_stream(
+        self,
+        size: int,
+        chunks: Iterator[bytes],
+        chunk_size: int = 64 * 1024,
+        start: int = 0,
+        limit: Optional[int] = None,
+        stall_seconds: float = 0.0,
+    ):
+        """
+        Send ``chunks`` from the byte offset ``start``, as a partial response if that's not 0.
+        If ``limit`` is given, the connection is dropped after sending that many bytes, and
+        ``stall_seconds`` later than that.
+        """
+        if start:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        buffer: List[bytes] = []
+        buffered = 0
+        try:
+            for chunk in _skip_bytes(chunks, start):
+                buffer.append(chunk)
+                buffered += len(chunk)
+                if limit is not None and buffered >= limit:
+                    self.wfile.write(b"".join(buffer)[:limit])
+                    self.wfile.flush()
+                    time.sleep(stall_seconds)
+                    self.close_connection = True
+                    return
+                if buffered >= chunk_size:
+                    self.wfile.write(b"".join(buffer))
+                    if limit is not None:
+                        limit -= buffered
+                    buffer, buffered = [], 0
+            self.wfile.write(b"".join(buffer))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early, which is fine.
+            self.close_connection = True
+
+    # Users and workspaces.
+
+    def user(self, query, body):
+        self._send_json({"name": self.beaker.user})
+
+    def get_workspace(self, query, body, workspace: str):
+        if not self.beaker.authorized:
+            return self._send_json({"message": "forbidden"}, status=403)
+        with self.beaker.lock:
+            data = self.beaker.workspaces.get(workspace)
+        if data is None:
+            return self._send_json({"message": "workspace not found"}, status=404)
+        self._send_json(data)
+
+    def create_workspace(self, query, body):
+        if not self.beaker.authorized:
+            return self._send_json({"message": "forbidden"}, status=403)
+        data = json.loads(body)
+        workspace = f"{data['org']}/{data['name']}"
+        with self.beaker.lock:
+            self.beaker.workspaces[workspace] = {"id": _new_id("ws"), "fullName": workspace}
+            self._send_json(self.beaker.workspaces[workspace])
+
+    def list_experiments(self, query, body, workspace: str):
+        with self.beaker.lock:
+            experiments = [
+                experiment
+                for experiment in self.beaker.experiments.values()
+                if experiment.workspace == workspace
+            ]
+        page_size = int(query.get("limit", 50))
+        start = int(query.get("cursor") or 0)
+        page = experiments[start : start + page_size]
+        data: Dict[str, Any] = {"data": [experiment.to_json() for experiment in page]}
+        if not self.beaker.list_jobs:
+            for experiment_data in data["data"]:
+                del experiment_data["jobs"]
+        if start + page_size < len(experiments):
+            data["nextCursor"] = str(start + page_size)
+        self._send_json(data)
+
+    # Experiments and jobs.
+
+    def get_experiment(self, query, body, experiment_id: str):
+        experiment = self.beaker.find_experiment(experiment_id)
+        if experiment is None:
+            return self._send_json({"message": "experiment not found"}, status=404)
+        self._send_json(experiment.to_json())
+
+    def create_experiment(self, query, body, workspace: str):
+        name = query["name"]
+        if self.beaker.find_experiment(f"{workspace.split('/')[1]}/{name}") is not None:
+            return self._send_json({"message": "experiment already exists"}, status=409)
+        spec = json.loads(body)
+        # Beaker runs a job for each task of the experiment.
+        experiment = self.beaker.add_experiment(
+            name,
+            workspace=workspace,
+            spec=spec,
+            jobs=[{"task_name": task.get("name")} for task in spec.get("tasks") or [{}]],
+        )
+        self._send_json({"id": experiment.id})
+
+    def get_logs(self, query, body, job_id: str):
+        job = self.beaker.find_job(job_id)
+        if job is None:
+            return self._send_json({"message": "job not found"}, status=404)
+        size, lines = job.log_lines()
+        range_header = self.headers.get("Range")
+        with self.beaker.lock:
+            self.beaker.log_ranges.append(range_header)
+            limit = self.beaker.log_interruptions.pop(0) if self.beaker.log_interruptions else None
+            stall = self.beaker.log_stalls.pop(0) if self.beaker.log_stalls else None
+        start = 0
+        if range_header is not None and self.beaker.supports_ranges:
+            start = int(re.fullmatch(r"bytes=(\d+)-", range_header).group(1))  # type: ignore
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        if stall is not None:
+            limit = stall
+        self._send_stream(
+            size,
+            lines,
+            start=start,
+            limit=limit,
+            stall_seconds=self.beaker.stall_seconds if stall is not None else 0.0,
+        )
+
+    # Images.
+
+    def get_image(self, query, body, image: str):
+        data = self.beaker.find_image(image)
+        if data is None:
+            return self._send_json({"message": "image not found"}, status=404)
+        self._send_json(data)
+
+    def create_image(self, query, body):
+        data = json.loads(body)
+        image_id = _new_id("im")
+        with self.beaker.lock:
+            self.beaker.images[image_id] = {
+                "id": image_id,
+                "fullName": f"{self.beaker.user}/{query['name']}",
+                "originalTag": data["ImageTag"],
+                "committed": False,
+            }
+        self._send_json({"id": image_id})
+
+    def get_image_repository(self, query, body, image_id: str):
+        self._send_json(
+            {
+                "imageTag": f"fake.registry/{image_id}",
+                "auth": {"user": "user", "password": "password", "server_address": "fake"},
+            }
+        )
+
+    def patch_image(self, query, body, image_id: str):
+        with self.beaker.lock:
+            image = self.beaker.images[image_id]
+            image["committed"] = bool(json.loads(body).get("Commit"))
+            self._send_json(image)
+
+    def delete_image(self, query, body, image_id: str):
+        with self.beaker.lock:
+            if self.beaker.images.pop(image_id, None) is None:
+                return self._send_json({"message": "image not found"}, status=404)
+        self._send_json({})
+
+    # Datasets.
+
+    def create_dataset(self, query, body):
+        name = query["name"]
+        full_name = f"{self.beaker.user}/{name}"
+        with self.beaker.lock:
+            if any(dataset["fullName"] == full_name for dataset in self.beaker.datasets.values()):
+                return self._send_json({"message": "dataset already exists"}, status=409)
+            dataset_id = _new_id("ds")
+            self.beaker.datasets[dataset_id] = {
+                "id": dataset_id,
+                "fullName": full_name,
+                "storage": {
+                    "id": _new_id("st"),
+                    "token": "storage-token",
+                    "address": f"{self.beaker.url}/storage",
+                },
+                "files": {},
+                "committed": False,
+            }
+            self._send_json(self.beaker.datasets[dataset_id])
+
+    def patch_dataset(self, query, body, dataset_id: str):
+        with self.beaker.lock:
+            dataset = self.beaker.datasets[dataset_id]
+            dataset["committed"] = bool(json.loads(body).get("commit"))
+            self._send_json({key: value for key, value in dataset.items() if key != "files"})
+
+    def delete_dataset(self, query, body, dataset: str):
+        with self.beaker.lock:
+            for dataset_id, data in list(self.beaker.datasets.items()):
+                if dataset in (dataset_id, data["fullName"]):
+                    del self.beaker.datasets[dataset_id]
+                    return self._send_json({})
+        self._send_json({"message": "dataset not found"}, status=404)
+
+    def _handle_storage(self, method: str, path: str, body: bytes):
+        match = re.fullmatch(r"datasets/([^/]+)/files/(.+)", path)
+        if method != "PUT" or match is None:
+            return self._send_json({"message": "not found"}, status=404)
+        if self.headers.get("Authorization") != "Bearer storage-token":
+            return self._send_json({"message": "unauthorized"}, status=401)
+        storage_id, target = match.groups()
+        with self.beaker.lock:
+            for dataset in self.beaker.datasets.values():
+                if dataset["storage"]["id"] == storage_id:
+                    dataset["files"][target] = body
+                    return self._send_json({})
+        self._send_json({"message": "dataset not found"}, status=404)
+
+
+ROUTES: List[Tuple[str, str, Callable[..., None]]] = [
+    (r"/api/v3/user", "GET", FakeBeakerHandler.user),
+    (r"/api/v3/workspaces", "POST", FakeBeakerHandler.create_workspace),
+    (r"/api/v3/workspaces/([^/]+/[^/]+)", "GET", FakeBeakerHandler.get_workspace),
+    (r"/api/v3/workspaces/([^/]+/[^/]+)/experiments", "GET", FakeBeakerHandler.list_experiments),
+    (r"/api/v3/workspaces/([^/]+/[^/]+)/experiments", "POST", FakeBeakerHandler.create_experiment),
+    (r"/api/v3/experiments/(.+)", "GET", FakeBeakerHandler.get_experiment),
+    (r"/api/v3/jobs/([^/]+)/logs", "GET", FakeBeakerHandler.get_logs),
+    (r"/api/v3/images", "POST", FakeBeakerHandler.create_image),
+    (r"/api/v3/images/([^/]+)/repository", "GET", FakeBeakerHandler.get_image_repository),
+    (r"/api/v3/images/(.+)", "GET", FakeBeakerHandler.get_image),
+    (r"/api/v3/images/([^/]+)", "PATCH", FakeBeakerHandler.patch_image),
+    (r"/api/v3/images/([^/]+)", "DELETE", FakeBeakerHandler.delete_image),
+    (r"/api/v3/datasets", "POST", FakeBeakerHandler.create_dataset),
+    (r"/api/v3/datasets/([^/]+)", "PATCH", FakeBeakerHandler.patch_dataset),
+    (r"/api/v3/datasets/(.+)", "DELETE", FakeBeakerHandler.delete_dataset),
+]
+
+
+class FakeDockerImage:
+    def __init__(self, tag: str):
+        self.id = "sha256:" + hashlib.sha256(tag.encode()).hexdigest()
+        self.tags = [tag]
+        self.attrs = {"Size": 10_000_000}
+
+    def tag(self, repository: str, tag: Optional[str] = None) -> bool:
+        self.tags.append(repository if tag is None else f"{repository}:{tag}")
+        return True
+
+
+class FakeContainer:
+    def __init__(self, output: str, exit_code: int):
+        self.output = output
+        self.exit_code = exit_code
+        self.removed = False
+
+    def logs(self, stream: bool = False, timestamps: bool = False, **kwargs) -> Iterator[bytes]:
+        assert stream and timestamps
+        for line in self.output.splitlines(keepends=True):
+            yield f"{TIMESTAMP} {line}".encode()
+
+    def wait(self) -> Dict[str, Any]:
+        return {"StatusCode": self.exit_code}
+
+    def remove(self, force: bool = False):
+        self.removed = True
+
+
+class FakeDocker:
+    """
+    A stand-in for :class:`docker.DockerClient` with a set of local images,
+    where pushing an image is a no-op and running one prints ``output``.
+    """
+
+    def __init__(self, *tags: str):
+        self._images = {tag: FakeDockerImage(tag) for tag in tags}
+        self.pushed: List[str] = []
+        self.images = self
+        self.api = self
+        self.containers = self
+        self.output = "Hello from Docker!\n"
+        self.exit_code = 0
+        self.runs: List[Dict[str, Any]] = []
+        self.started: List[FakeContainer] = []
+
+    def get(self, tag: str) -> FakeDockerImage:
+        if tag not in self._images:
+            raise docker.errors.ImageNotFound(f"No such image: {tag}")
+        return self._images[tag]
+
+    def push(self, repository: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        self.pushed.append(repository)
+        yield {"status": "Pushing", "id": repository}
+        yield {"status": "Pushed", "id": repository}
+
+    def run(
+        self,
+        image: str,
+        command: Optional[List[str]] = None,
+        entrypoint: Optional[List[str]] = None,
+        detach: bool = False,
+    ) -> FakeContainer:
+        assert detach
+        self.get(image)
+        self.runs.append({"image": image, "command": command, "entrypoint": entrypoint})
+        container = FakeContainer(self.output, self.exit_code)
+        self.started.append(container)
+        return container
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}{uuid.uuid4().hex[:12]}"
+
+
+def _skip_bytes(chunks: Iterator[bytes], num_bytes: int) -> Iterator[bytes]:
+    for chunk in chunks:
+        if num_bytes >= len(chunk):
+            num_bytes -= len(chunk)
+            continue
+        yield chunk[num_bytes:]
+        num_bytes = 0
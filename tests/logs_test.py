@@ -0,0 +1,389 @@
+import codecs
+import gzip
+import itertools
+import os
+import random
+import tracemalloc
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import pytest
+
+from naacl_utils.logs import (
+    TRUNCATION_MARKER,
+    FragmentMatcher,
+    LogRecorder,
+    LogStore,
+    MismatchLocator,
+    compress_lines,
+    iter_log_buffers,
+    iter_log_lines,
+    max_line_size,
+)
+
+
+def find(expected_lines: List[str], log_lines: List[str]) -> bool:
+    matcher = FragmentMatcher([expected_lines])
+    for line in log_lines:
+        if matcher.feed(line):
+            return True
+    return False
+
+
+def strip_timestamp(line: str) -> str:
+    return line[line.find(" ") + 1 :].rstrip()
+
+
+def decode_log_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """
+    The way logs used to be normalized, which is the reference for the bytes-level version:
+    every chunk is decoded, and every line is stripped on its own.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    partial: List[str] = []
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if "\n" not in text:
+            partial.append(text)
+            continue
+        lines = text.split("\n")
+        partial.append(lines[0])
+        yield strip_timestamp("".join(partial))
+        for line in lines[1:-1]:
+            yield strip_timestamp(line)
+        partial = [lines[-1]]
+    partial.append(decoder.decode(b"", final=True))
+    yield strip_timestamp("".join(partial))
+
+
+def split_randomly(data: bytes, rng: random.Random, max_splits: int = 4) -> List[bytes]:
+    cuts = sorted(rng.sample(range(len(data) + 1), min(len(data) + 1, rng.randint(0, max_splits))))
+    return [data[i:j] for i, j in zip([0] + cuts, cuts + [len(data)])]
+
+
+def test_iter_log_lines_strips_timestamps_across_chunks():
+    logs = "2022-01-01T00:00:00Z Hello from Docker!\n2022-01-01T00:00:01Z Bye  \n".encode()
+    chunks = [logs[i : i + 7] for i in range(0, len(logs), 7)]
+    assert list(iter_log_lines(chunks)) == ["Hello from Docker!", "Bye", ""]
+
+
+def test_iter_log_lines_handles_multibyte_characters_split_across_chunks():
+    logs = "ts \N{check mark} done".encode()
+    split = logs.index("\N{check mark}".encode()) + 1
+    assert list(iter_log_lines([logs[:split], logs[split:]])) == ["\N{check mark} done"]
+
+
+@pytest.mark.parametrize(
+    "expected_lines, log_lines, found",
+    [
+        (["Hello"], ["Hello from Docker!"], True),
+        (["Docker!", "This"], ["Hello from Docker!", "This message"], True),
+        (["Docker!", "This"], ["Hello from Docker!", "", "This message"], False),
+        (["b", "c", "d"], ["a", "xb", "c", "dy"], True),
+        (["b", "c", "d"], ["a", "xb", "cc", "dy"], False),
+        (["a", "a", "a", "b"], ["a", "a", "a", "a", "b"], True),
+    ],
+)
+def test_expected_output_matcher(expected_lines, log_lines, found):
+    assert find(expected_lines, log_lines) is found
+
+
+def test_expected_output_matcher_agrees_with_substring_search():
+    rng = random.Random(0)
+    alphabet = ["a", "b", "ab", "ba", ""]
+    for _ in range(2000):
+        log_lines = [rng.choice(alphabet) for _ in range(rng.randint(1, 12))]
+        expected_lines = [rng.choice(alphabet) for _ in range(rng.randint(1, 4))]
+        expected = "\n".join(expected_lines) in "\n".join(log_lines)
+        assert find(expected_lines, log_lines) is expected, (expected_lines, log_lines)
+
+
+def test_iter_log_lines_agrees_with_decoding_every_chunk():
+    rng = random.Random(0)
+    alphabet = [b"a", b" ", b"\n", b"\t", b"\r", b"\xff", b"\x1c", "\xa0 \N{check mark}".encode()]
+    for _ in range(5000):
+        logs = b"".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        chunks = split_randomly(logs, rng)
+        assert list(iter_log_lines(chunks)) == list(decode_log_lines(chunks)), chunks
+
+
+def test_iter_log_buffers_keeps_lines_whole():
+    chunks = [b"ts a\nts ", b"b", b"\nts c\n", b"ts d"]
+    assert list(iter_log_buffers(chunks, min_size=1)) == [b"ts a", b"ts b\nts c", b"ts d"]
+    assert list(iter_log_buffers(chunks, min_size=9)) == [b"ts a\nts b\nts c", b"ts d"]
+    assert list(iter_log_buffers(chunks)) == [b"ts a\nts b\nts c\nts d"]
+    assert list(iter_log_buffers([b"ts a\n"], min_size=1)) == [b"ts a", b""]
+
+
+def truncate(line: bytes, max_line_size: int) -> bytes:
+    if len(line) <= max_line_size:
+        return line
+    keep = max_line_size // 2
+    return line[:keep] + TRUNCATION_MARKER % (len(line) - 2 * keep) + line[len(line) - keep :]
+
+
+def test_iter_log_buffers_truncates_long_lines():
+    rng = random.Random(0)
+    for _ in range(2000):
+        lines = [b"x" * rng.choice([0, 1, 5, 9, 10, 11, 30]) for _ in range(rng.randint(1, 6))]
+        logs = b"\n".join(lines)
+        expected = b"\n".join(truncate(line, 10) for line in lines)
+        chunks = split_randomly(logs, rng, 8)
+        buffers = iter_log_buffers(chunks, min_size=rng.randint(1, 40), max_line_size=10)
+        assert b"\n".join(buffers) == expected, chunks
+
+
+def synthetic_log(
+    size: int, chunk: bytes, end: bytes = b"", chunk_size: int = 1024 * 1024
+) -> Iterator[bytes]:
+    """
+    Generate ``size`` bytes of logs made up of ``chunk`` repeated, followed by ``end``. The same
+    chunk is yielded over and over, so the logs can be gigabytes without taking up any memory.
+    """
+    chunk = chunk * max(chunk_size // len(chunk), 1)
+    for _ in range(size // len(chunk)):
+        yield chunk
+    yield end
+
+
+def test_verify_multi_gigabyte_logs_within_memory_budget():
+    max_memory = 16 * 1024 * 1024
+    steps = b"".join(b"2022-03-01T12:00:00.000000000Z step %d loss 0.25\n" % i for i in range(10))
+    results = b"\n2022-03-01T12:00:01.000000000Z acc 0.91\n2022-03-01T12:00:01.000000000Z done\n"
+
+    def logs() -> Iterator[bytes]:
+        yield from synthetic_log(1024**3, steps)
+        # A progress bar that never prints a newline.
+        yield b"2022-03-01T12:00:00.000000000Z "
+        yield from synthetic_log(2 * 1024**3, b"\r 50%|#####     | 5/10", end=b"\r100%")
+        yield results
+
+    tracemalloc.start()
+    try:
+        matcher = FragmentMatcher([["acc 0.91", "done"], ["missing"]])
+        for buffer in iter_log_buffers(logs(), max_line_size=max_line_size(max_memory)):
+            matcher.feed_buffer(buffer)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < max_memory
+    assert matcher.missing == [1]
+    assert matcher.found[0] == matcher.num_lines - 3
+
+    # The progress bar is truncated, but keeps its start and end.
+    recorder = LogRecorder(["missing"], max_memory=max_memory // 4)
+    for line in iter_log_lines(
+        itertools.islice(logs(), 1024, None), max_line_size=max_line_size(max_memory)
+    ):
+        recorder.add(line)
+    assert recorder.in_memory
+    progress_bar = recorder.lines[-4]
+    assert len(progress_bar) < max_line_size(max_memory) + 100
+    assert progress_bar.startswith("\r 50%|#####")
+    assert "bytes truncated ...] " in progress_bar
+    assert progress_bar.endswith("5/10\r100%")
+    assert recorder.lines[-3:] == ["acc 0.91", "done", ""]
+
+
+def test_single_fragment_feed_buffer_agrees_with_substring_search():
+    rng = random.Random(0)
+    alphabet = ["a", "b", "ab", "ba", "", "\N{check mark}"]
+    for _ in range(5000):
+        log_lines = [rng.choice(alphabet) for _ in range(rng.randint(1, 40))]
+        expected_lines = [rng.choice(alphabet) for _ in range(rng.randint(1, 4))]
+        logs = "".join(f"ts {line}\n" for line in log_lines).encode()
+        # The logs end with a newline, so they end with an empty line.
+        expected = "\n".join(expected_lines) in "\n".join(log_lines + [""])
+        matcher = FragmentMatcher([expected_lines])
+        for buffer in iter_log_buffers(split_randomly(logs, rng, 8), min_size=rng.randint(1, 40)):
+            if matcher.feed_buffer(buffer):
+                break
+        assert matcher.matched is expected, (expected_lines, log_lines)
+
+
+def occurrences(fragment: List[str], log_lines: List[str]) -> Iterator[Tuple[int, int]]:
+    """
+    Find the start and end line of every occurrence of a fragment the slow way,
+    in the order that they end.
+    """
+    for end in range(len(fragment) - 1, len(log_lines)):
+        window = log_lines[end - len(fragment) + 1 : end + 1]
+        if len(fragment) == 1:
+            if fragment[0] in window[0]:
+                yield end, end
+        elif (
+            window[0].endswith(fragment[0])
+            and window[1:-1] == fragment[1:-1]
+            and window[-1].startswith(fragment[-1])
+        ):
+            yield end - len(fragment) + 1, end
+
+
+def find_fragments(
+    fragments: List[List[str]], log_lines: List[str], ordered: bool
+) -> List[Optional[int]]:
+    found: List[Optional[int]] = [None] * len(fragments)
+    last_end = -1
+    for k, fragment in enumerate(fragments):
+        for start, end in occurrences(fragment, log_lines):
+            if not ordered or start > last_end:
+                found[k] = start
+                last_end = end
+                break
+        else:
+            if ordered:
+                break
+    return found
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+def test_fragment_matcher_agrees_with_brute_force(ordered: bool):
+    rng = random.Random(0)
+    alphabet = ["a", "b", "ab", "ba", "", "\N{check mark}"]
+    for _ in range(3000):
+        log_lines = [rng.choice(alphabet) for _ in range(rng.randint(1, 40))]
+        fragments = [
+            [rng.choice(alphabet) for _ in range(rng.randint(1, 4))]
+            for _ in range(rng.randint(1, 4))
+        ]
+        # The logs end with a newline, so they end with an empty line.
+        expected = find_fragments(fragments, log_lines + [""], ordered)
+        if not ordered:
+            for fragment, start in zip(fragments, expected):
+                assert ("\n".join(fragment) in "\n".join(log_lines + [""])) is (start is not None)
+
+        matcher = FragmentMatcher(fragments, ordered=ordered)
+        for line in log_lines + [""]:
+            matcher.feed(line)
+        assert matcher.found == expected, (fragments, log_lines)
+
+        logs = "".join(f"ts {line}\n" for line in log_lines).encode()
+        matcher = FragmentMatcher(fragments, ordered=ordered)
+        for buffer in iter_log_buffers(split_randomly(logs, rng, 8), min_size=rng.randint(1, 40)):
+            if matcher.feed_buffer(buffer):
+                break
+        assert matcher.found == expected, (fragments, log_lines)
+        assert matcher.missing == [k for k, start in enumerate(expected) if start is None]
+
+
+def test_fragment_matcher_reports_where_fragments_are():
+    log_lines = [f"step {i}" for i in range(10_000)]
+    log_lines[2000:2002] = ["== dev ==", "acc 0.91"]
+    log_lines[5000:5002] = ["== test ==", "acc 0.89"]
+    logs = "".join(f"2022-05-10T12:00:00Z {line}\n" for line in log_lines).encode()
+    fragments = [["== test ==", "acc 0.89"], ["== dev ==", "acc 0.91"], ["== train =="]]
+    chunks = [logs[i : i + 1000] for i in range(0, len(logs), 1000)]
+
+    matcher = FragmentMatcher(fragments)
+    assert not any(matcher.feed_buffer(buffer) for buffer in iter_log_buffers(chunks, 4096))
+    assert matcher.found == [5000, 2000, None]
+    assert matcher.missing == [2]
+
+    # In order, the test results come after the dev results.
+    matcher = FragmentMatcher(fragments[:2], ordered=True)
+    assert not any(matcher.feed_buffer(buffer) for buffer in iter_log_buffers(chunks, 4096))
+    assert matcher.found == [5000, None]
+    matcher = FragmentMatcher(fragments[:2][::-1], ordered=True)
+    assert any(matcher.feed_buffer(buffer) for buffer in iter_log_buffers(chunks, 4096))
+    assert matcher.found == [2000, 5000]
+
+
+@pytest.mark.parametrize("method", ["decode-every-chunk", "bytes-level"])
+def test_log_normalization_speed(benchmark, method: str):
+    filler = b"2022-05-10T12:00:00.000000000Z Training... loss=0.1234 accuracy=0.5678\n"
+    output = b"2022-05-10T12:00:00.000000000Z acc 0.91\n2022-05-10T12:00:00.000000000Z f1 0.86\n"
+    logs = filler * 500_000 + output
+    chunks = [logs[i : i + 64 * 1024] for i in range(0, len(logs), 64 * 1024)]
+    expected_lines = ["acc 0.91", "f1 0.86"]
+
+    def verify() -> bool:
+        matcher = FragmentMatcher([expected_lines])
+        if method == "bytes-level":
+            return any(matcher.feed_buffer(buffer) for buffer in iter_log_buffers(chunks))
+        return any(matcher.feed(line) for line in decode_log_lines(chunks))
+
+    benchmark.extra_info["log_size_bytes"] = len(logs)
+    assert benchmark.pedantic(verify, rounds=3)
+
+
+def test_log_recorder_spills_to_file():
+    recorder = LogRecorder(["x"], max_lines_in_memory=3)
+    for line in ["a", "b"]:
+        recorder.add(line)
+    assert recorder.in_memory
+    for line in ["c", "d"]:
+        recorder.add(line)
+    assert not recorder.in_memory
+    path = recorder.keep()
+    with gzip.open(path, "rt") as log_file:
+        assert log_file.read() == "a\nb\nc\nd\n"
+    os.remove(path)
+
+
+def test_log_recorder_keeps_lines_in_memory_until_needed():
+    recorder = LogRecorder(["x"])
+    for line in ["a", "b"]:
+        recorder.add(line)
+    path = recorder.keep()
+    with gzip.open(path, "rt") as log_file:
+        assert log_file.read() == "a\nb\n"
+    recorder.discard()
+    assert not os.path.exists(path)
+
+
+def test_log_store_spills_to_segments(monkeypatch):
+    monkeypatch.setattr(LogStore, "SEGMENT_SIZE", 100)
+    lines = [f"line {i}" for i in range(1000)]
+    store = LogStore(max_memory=1000)
+    for line in lines[:10]:
+        store.append(line)
+    assert store.in_memory
+    for line in lines[10:500]:
+        store.append(line)
+    assert not store.in_memory
+    assert len(store._segment_lines) > 1
+    assert store.read_lines(123, 456) == lines[123:456]
+    assert list(store.iter_lines(490)) == lines[490:500]
+
+    path = store.keep()
+    with gzip.open(path, "rt") as log_file:
+        assert log_file.read().splitlines() == lines[:500]
+    # Lines can still be added after the file has been read or kept.
+    for line in lines[500:]:
+        store.append(line)
+    assert store.read_lines(0, 1000) == lines
+    assert store.read_lines(999, 2000) == lines[999:]
+    store.discard()
+    assert not os.path.exists(path)
+
+
+def test_compress_lines():
+    lines = [f"line {i}" for i in range(10_000)] + [""]
+    assert gzip.decompress(b"".join(compress_lines(lines))) == "\n".join(lines).encode()
+
+
+def test_mismatch_locator_finds_most_similar_window():
+    expected_lines = ["Results:", "acc 0.91", "f1 0.86", "done"]
+    log_lines = [f"step {i}" for i in range(10_000)]
+    log_lines[6000:6000] = ["Results:", "acc 0.91", "f1 0.85", "done"]
+    log_lines[100:100] = ["done"]
+    locator = MismatchLocator(expected_lines)
+    for line in log_lines:
+        locator.feed(line)
+    locator.finish()
+    assert locator.best_offset == 6001
+    assert locator.best_votes == 3
+
+
+def test_log_recorder_mismatch_window():
+    recorder = LogRecorder(["b", "c", "x"], max_lines_in_memory=3)
+    for line in ["a", "b", "c", "d", "e", "f", "g"]:
+        recorder.add(line)
+    assert recorder.mismatch_window(context=1) == (0, ["a", "b", "c", "d", "e"])
+    os.remove(recorder.keep())
+
+
+def test_log_recorder_mismatch_window_falls_back_to_end_of_logs():
+    recorder = LogRecorder(["x", "y"])
+    for line in ["a", "b", "c", "d", "e", "f", "g"]:
+        recorder.add(line)
+    assert recorder.mismatch_window(context=1) == (4, ["e", "f", "g"])
@@ -1,15 +1,24 @@
+import json
 import os
 import subprocess
 import time
 import uuid
 from pathlib import Path
+from unittest import mock
 
 import docker
 import pytest
 from beaker import Config
 from click.testing import CliRunner
 
-from naacl_utils.__main__ import NaaclUtilsError, main
+from naacl_utils import cache
+from naacl_utils.__main__ import (
+    LATEST_RELEASE_CACHE,
+    UPDATE_CHECK_TTL,
+    check_for_updates,
+    main,
+    refresh_latest_release,
+)
 from naacl_utils.version import VERSION
 
 DOCKER_IMAGE_NAME = "hello-world"
@@ -50,6 +59,56 @@ def test_version(run_dir):
     assert VERSION in result.stdout
 
 
+@pytest.fixture
+def cache_dir(tmp_path: Path, monkeypatch) -> Path:
+    monkeypatch.setenv(cache.CACHE_DIR_ENV_VAR, str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def test_update_check_uses_cached_release(cache_dir, caplog):
+    cache.write_json(
+        LATEST_RELEASE_CACHE, {"latest_version": "v1000.0.0", "checked_at": time.time()}
+    )
+    with mock.patch("threading.Thread") as thread:
+        check_for_updates()
+    thread.assert_not_called()
+    assert "newer version available (1000.0.0)" in caplog.text
+
+
+def test_update_check_refreshes_stale_cache_in_background(cache_dir):
+    cache.write_json(
+        LATEST_RELEASE_CACHE,
+        {"latest_version": "v0.0.1", "checked_at": time.time() - UPDATE_CHECK_TTL - 1},
+    )
+    leftover = cache_dir / f".{LATEST_RELEASE_CACHE}.abc.tmp"
+    leftover.write_text("{")
+    os.utime(leftover, (0, 0))
+    with mock.patch("threading.Thread") as thread:
+        check_for_updates()
+    thread.assert_called_once()
+    assert thread.call_args.kwargs["daemon"]
+    # The time of the check is saved before the thread starts, since it could be killed.
+    latest_release = cache.read_json(LATEST_RELEASE_CACHE)
+    assert latest_release["latest_version"] == "v0.0.1"
+    assert time.time() - latest_release["checked_at"] < UPDATE_CHECK_TTL
+    assert not leftover.exists()
+
+
+def test_update_check_with_unusable_cache_dir(tmp_path, monkeypatch):
+    (tmp_path / "file").write_text("")
+    monkeypatch.setenv(cache.CACHE_DIR_ENV_VAR, str(tmp_path / "file" / "cache"))
+    with mock.patch("threading.Thread") as thread:
+        check_for_updates()
+    thread.assert_called_once()
+
+    response = mock.Mock()
+    response.json.return_value = {"tag_name": "v1000.0.0"}
+    with mock.patch("naacl_utils.session.get_session") as get_session:
+        get_session.return_value.get.return_value = response
+        refresh_latest_release()
+    assert cache.read_json(LATEST_RELEASE_CACHE) is None
+
+
 def test_setup(run_dir, beaker_token):
     runner = CliRunner()
     result = runner.invoke(main, ["setup"], input=beaker_token)
@@ -74,21 +133,32 @@ def test_setup_and_submit(run_dir, beaker_token, docker_image, run_name):
     # verify
     with open(run_dir / "out.log", "wt") as output_file:
         output_file.write("Hello from Docker!")
-    for _ in range(10):
-        time.sleep(2)
-        result = runner.invoke(main, ["verify", run_name, str(run_dir / "out.log")])
-        if result.exception is None:
-            assert "Results successfully verified" in result.output
-            assert "Done!" in result.output
-            break
-        elif isinstance(result.exception, NaaclUtilsError) and (
-            "Can only verify submissions that have completed" in str(result.exception)
-        ):
-            continue
-        else:
-            raise result.exception
-    else:
-        assert False, f"verify not successful for {run_name}"
+    result = runner.invoke(
+        main, ["verify", "--wait", "--timeout", "300", run_name, str(run_dir / "out.log")]
+    )
+    assert result.exception is None
+    assert "Results successfully verified" in result.output
+    assert "Done!" in result.output
+
+
+@pytest.mark.skipif(not DOCKER_AVAILABLE, reason="Docker required")
+def test_setup_and_submit_batch(run_dir, beaker_token, docker_image, run_name):
+    runner = CliRunner()
+
+    # setup
+    result = runner.invoke(main, ["setup"], input=beaker_token)
+    assert result.exception is None
+
+    # submit-batch
+    manifest = run_dir / "runs.jsonl"
+    with open(manifest, "wt") as manifest_file:
+        for i in range(2):
+            manifest_file.write(
+                json.dumps({"image": docker_image, "run_name": f"{run_name}-{i}"}) + "\n"
+            )
+    result = runner.invoke(main, ["submit-batch", str(manifest)])
+    assert result.exception is None
+    assert result.output.count("https://beaker.org/ex/") == 2
 
 
 def test_submit_without_setup(run_dir, beaker_token):
@@ -0,0 +1,80 @@
+import re
+
+import pytest
+
+from naacl_utils.exceptions import NaaclUtilsError
+from naacl_utils.manifest import load_manifest
+
+
+def test_load_yaml_manifest(tmp_path):
+    manifest = tmp_path / "runs.yml"
+    manifest.write_text(
+        "- image: hello-world\n"
+        "  run_name: run-1\n"
+        "- image: hello-world\n"
+        "  run_name: run-2\n"
+        "  cmd: python run.py --seed 2\n"
+    )
+    assert load_manifest(manifest, ["image", "run_name"], ["entrypoint", "cmd"]) == [
+        {"image": "hello-world", "run_name": "run-1", "entrypoint": None, "cmd": None},
+        {
+            "image": "hello-world",
+            "run_name": "run-2",
+            "entrypoint": None,
+            "cmd": "python run.py --seed 2",
+        },
+    ]
+
+
+def test_load_jsonl_manifest(tmp_path):
+    manifest = tmp_path / "runs.jsonl"
+    manifest.write_text(
+        '{"image": "hello-world", "run_name": "run-1"}\n'
+        "\n"
+        '{"image": "hello-world", "run_name": "run-2", "entrypoint": "echo"}\n'
+    )
+    rows = load_manifest(manifest, ["image", "run_name"], ["entrypoint", "cmd"])
+    assert [row["run_name"] for row in rows] == ["run-1", "run-2"]
+    assert rows[1]["entrypoint"] == "echo"
+
+
+@pytest.mark.parametrize(
+    "contents, message",
+    [
+        ('{"image": "hello-world"}\n', "missing required field(s): run_name"),
+        ('{"image": "hello-world", "run_name": "run-1", "gpus": "2"}\n', "unknown field(s): gpus"),
+        ('{"image": "hello-world", "run_name": 1}\n', "must be a string"),
+        ('{"image": "hello-world", \n', "Failed to parse line 1"),
+        ("\n", "doesn't contain any runs"),
+    ],
+)
+def test_load_manifest_errors(tmp_path, contents, message):
+    manifest = tmp_path / "runs.jsonl"
+    manifest.write_text(contents)
+    with pytest.raises(NaaclUtilsError, match=re.escape(message)):
+        load_manifest(manifest, ["image", "run_name"], ["entrypoint", "cmd"])
+
+
+def test_load_manifest_list_and_flag_fields(tmp_path):
+    manifest = tmp_path / "runs.yml"
+    manifest.write_text(
+        "- run_name: run-1\n"
+        "  expected_output: out.log\n"
+        "- run_name: run-2\n"
+        "  expected_output: [dev.log, test.log]\n"
+        "  ordered: true\n"
+    )
+    rows = load_manifest(
+        manifest, ["run_name", "expected_output"], [], ["expected_output"], ["ordered"]
+    )
+    assert [(row["expected_output"], row["ordered"]) for row in rows] == [
+        (["out.log"], False),
+        (["dev.log", "test.log"], True),
+    ]
+
+    manifest.write_text("- run_name: run-1\n  expected_output: []\n")
+    with pytest.raises(NaaclUtilsError, match="non-empty list of strings"):
+        load_manifest(manifest, ["run_name", "expected_output"], [], ["expected_output"])
+    manifest.write_text("- run_name: run-1\n  expected_output: out.log\n  ordered: 'yes'\n")
+    with pytest.raises(NaaclUtilsError, match="must be true or false"):
+        load_manifest(manifest, ["run_name", "expected_output"], [], [], ["ordered"])
@@ -0,0 +1,67 @@
+from unittest import mock
+
+import pytest
+
+from naacl_utils.exceptions import NaaclUtilsError
+from naacl_utils.polling import Backoff, wait_for_experiments
+
+
+def experiment(exit_code=None):
+    status = {} if exit_code is None else {"exitCode": exit_code}
+    return {"id": "ex", "jobs": [{"status": status}]}
+
+
+class FakeExperiments:
+    def __init__(self, exit_codes_by_round):
+        self.exit_codes_by_round = exit_codes_by_round
+        self.calls = []
+
+    def __call__(self, run_name):
+        self.calls.append(run_name)
+        rounds = self.exit_codes_by_round[run_name]
+        exit_code = rounds.pop(0) if len(rounds) > 1 else rounds[0]
+        if isinstance(exit_code, Exception):
+            raise exit_code
+        return experiment(exit_code)
+
+
+def test_backoff_grows_and_resets():
+    backoff = Backoff(initial=1.0, maximum=4.0, factor=2.0, jitter=0.0)
+    assert [backoff.next() for _ in range(4)] == [1.0, 2.0, 4.0, 4.0]
+    backoff.reset()
+    assert backoff.next() == 1.0
+
+
+def test_backoff_jitter():
+    backoff = Backoff(initial=10.0, jitter=0.2)
+    assert 8.0 <= backoff.next() <= 12.0
+
+
+def test_wait_for_experiments_yields_runs_as_they_finish():
+    fetch = FakeExperiments({"run-1": [None, None, 0], "run-2": [None, 1]})
+    with mock.patch("time.sleep") as sleep:
+        finished = [
+            (run_name, exp["jobs"][0]["status"]["exitCode"])
+            for run_name, exp in wait_for_experiments(fetch, ["run-1", "run-2"])
+        ]
+    assert finished == [("run-2", 1), ("run-1", 0)]
+    assert sleep.call_count == 2
+    assert fetch.calls == ["run-1", "run-2", "run-1", "run-2", "run-1"]
+
+
+def test_wait_for_experiments_times_out():
+    fetch = FakeExperiments({"run-1": [None]})
+    with mock.patch("time.sleep"), mock.patch("time.monotonic", side_effect=[0.0, 5.0, 11.0]):
+        with pytest.raises(NaaclUtilsError, match="Timed out"):
+            list(wait_for_experiments(fetch, ["run-1"], timeout=10))
+
+
+def test_wait_for_experiments_return_exceptions():
+    error = NaaclUtilsError("not found")
+    fetch = FakeExperiments({"run-1": [error], "run-2": [0]})
+    assert list(wait_for_experiments(fetch, ["run-1", "run-2"], return_exceptions=True)) == [
+        ("run-1", error),
+        ("run-2", experiment(0)),
+    ]
+    with pytest.raises(NaaclUtilsError, match="not found"):
+        list(wait_for_experiments(fetch, ["run-1", "run-2"]))
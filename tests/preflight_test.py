@@ -0,0 +1,86 @@
+import io
+from typing import Iterator, List, Optional
+
+import pytest
+
+from naacl_utils import cache
+from naacl_utils.exceptions import NaaclUtilsError
+from naacl_utils.preflight import ContainerRunner, preflight
+from naacl_utils.spec import TaskSpec
+
+from .fake_beaker import TIMESTAMP
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(cache.CACHE_DIR_ENV_VAR, str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+class FakeRunner(ContainerRunner):
+    def __init__(self, output: str, exit_code: int = 0):
+        self.output = output
+        self.exit_code = exit_code
+        self.runs: List[tuple] = []
+
+    def get_image_digest(self, image: str) -> str:
+        if image != "hello-world":
+            raise NaaclUtilsError(f"Docker image '{image}' not found locally")
+        return "sha256:abc"
+
+    def run(
+        self, image: str, entrypoint: Optional[List[str]] = None, cmd: Optional[List[str]] = None
+    ) -> Iterator[bytes]:
+        self.runs.append((image, entrypoint, cmd))
+        for line in self.output.splitlines(keepends=True):
+            yield f"{TIMESTAMP} {line}".encode()
+        if self.exit_code != 0:
+            raise NaaclUtilsError(f"Docker image '{image}' exited with code {self.exit_code}")
+
+
+def test_preflight_normalizes_and_caches_output():
+    runner = FakeRunner("Results:  \nacc 0.91\n\n")
+    task = TaskSpec(cmd="python evaluate.py --split 'dev set'")
+    result = preflight("hello-world", task, runner=runner)
+    assert not result.cached
+    assert result.output.read_lines(0, 10) == ["Results:", "acc 0.91", "", ""]
+    assert runner.runs == [("hello-world", None, ["python", "evaluate.py", "--split", "dev set"])]
+    expected_output = io.StringIO()
+    result.write_expected_output(expected_output)
+    assert expected_output.getvalue() == "Results:\nacc 0.91\n"
+
+    # The output is cached for the same image and command, but not for others.
+    assert preflight("hello-world", task, runner=runner).cached
+    assert not preflight("hello-world", runner=runner).cached
+    assert not preflight("hello-world", task, runner=runner, use_cache=False).cached
+    assert len(runner.runs) == 3
+
+
+def test_preflight_failure():
+    runner = FakeRunner("".join(f"step {i}\n" for i in range(100)) + "Traceback\n", exit_code=1)
+    with pytest.raises(NaaclUtilsError, match="exited with code 1") as exc_info:
+        preflight("hello-world", runner=runner)
+    assert str(exc_info.value).endswith("step 99\nTraceback\n")
+    assert "step 80\n" not in str(exc_info.value)
+    # Failed runs aren't cached.
+    with pytest.raises(NaaclUtilsError):
+        preflight("hello-world", runner=runner)
+    assert len(runner.runs) == 2
+
+    with pytest.raises(NaaclUtilsError, match="not found locally"):
+        preflight("goodbye-world", runner=runner)
+
+
+def test_preflight_without_output():
+    result = preflight("hello-world", runner=FakeRunner("\n"))
+    with pytest.raises(NaaclUtilsError, match="didn't print anything"):
+        result.write_expected_output(io.StringIO())
+
+
+def test_incomplete_runner():
+    class NoRunner(ContainerRunner):
+        def get_image_digest(self, image: str) -> str:
+            return "sha256:abc"
+
+    with pytest.raises(TypeError):
+        NoRunner()  # type: ignore[abstract]
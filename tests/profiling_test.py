@@ -0,0 +1,59 @@
+import json
+import threading
+
+from naacl_utils.profiling import Profiler
+
+
+def test_spans_are_nested_per_thread():
+    profiler = Profiler()
+    profiler.reset(enabled=True)
+    with profiler.span("outer"):
+        with profiler.span("inner") as span:
+            span.add_bytes(100)
+        thread = threading.Thread(target=lambda: profiler.span("other").__enter__())
+        thread.start()
+        thread.join()
+
+    outer, inner, other = profiler.spans
+    assert (outer.name, outer.depth) == ("outer", 0)
+    assert (inner.name, inner.depth, inner.bytes) == ("inner", 1, 100)
+    assert (other.name, other.depth) == ("other", 0)
+    assert outer.duration >= inner.duration > 0
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = Profiler()
+    with profiler.span("phase") as span:
+        span.add_bytes(100)
+    assert list(profiler.iter_chunks("download", [b"abc"])) == [b"abc"]
+    assert not profiler.spans
+
+
+def test_iter_chunks_counts_bytes():
+    profiler = Profiler()
+    profiler.reset(enabled=True)
+    chunks = profiler.iter_chunks("download", (b"x" * size for size in (10, 20, 30)))
+    assert b"".join(chunks) == b"x" * 60
+    (span,) = profiler.spans
+    assert span.bytes == 60
+    assert span.throughput is not None and span.throughput > 0
+
+
+def test_summary_combines_spans(tmp_path):
+    profiler = Profiler()
+    profiler.reset(enabled=True)
+    for _ in range(3):
+        with profiler.span("upload") as span:
+            span.add_bytes(10)
+    with profiler.span("verify"):
+        pass
+
+    (upload, upload_count), (verify, verify_count) = profiler.summary()
+    assert (upload.name, upload_count, upload.bytes) == ("upload", 3, 30)
+    assert (verify.name, verify_count, verify.bytes) == ("verify", 1, None)
+
+    profiler.write_jsonl(str(tmp_path / "profile.jsonl"))
+    with open(tmp_path / "profile.jsonl") as profile_file:
+        spans = [json.loads(line) for line in profile_file]
+    assert [span["name"] for span in spans] == ["upload"] * 3 + ["verify"]
+    assert spans[0]["bytes"] == 10
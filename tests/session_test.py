@@ -0,0 +1,41 @@
+import pytest
+from beaker import Config, HTTPError
+
+from naacl_utils.client import NaaclBeaker
+from naacl_utils.session import make_session
+
+
+@pytest.fixture
+def beaker(fake_env, fake_beaker) -> NaaclBeaker:
+    return NaaclBeaker(
+        Config(user_token=fake_beaker.token, agent_address=fake_beaker.url),
+        session=make_session(),
+    )
+
+
+def test_connections_are_reused(beaker, fake_beaker):
+    experiment = fake_beaker.add_experiment("run-1")
+    for _ in range(3):
+        assert beaker.get_experiment(experiment.id)["name"] == "run-1"
+    assert b"".join(beaker.get_logs(experiment.jobs[0].id))
+    assert fake_beaker.connections == 1
+
+
+def test_idempotent_requests_are_retried(beaker, fake_beaker):
+    experiment = fake_beaker.add_experiment("run-1")
+    fake_beaker.errors = [503]
+    assert beaker.get_experiment(experiment.id)["name"] == "run-1"
+    assert fake_beaker.requests.count(("GET", f"/api/v3/experiments/{experiment.id}")) == 2
+
+
+def test_other_requests_are_not_retried(beaker, fake_beaker):
+    fake_beaker.errors = [503]
+    with pytest.raises(HTTPError):
+        beaker.request(
+            f"workspaces/NAACL%2F{fake_beaker.user}/experiments",
+            method="POST",
+            query={"name": "run-1"},
+            data={},
+        )
+    assert not fake_beaker.experiments
+    assert len(fake_beaker.requests) == 1
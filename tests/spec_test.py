@@ -0,0 +1,107 @@
+import pytest
+
+from naacl_utils.exceptions import NaaclUtilsError
+from naacl_utils.spec import (
+    DEFAULT_RESOURCES,
+    Resources,
+    TaskSpec,
+    load_task_specs,
+    make_experiment_spec,
+    parse_size,
+    validate_tasks,
+)
+
+
+@pytest.mark.parametrize(
+    "size, num_bytes",
+    [
+        ("512", 512),
+        ("512b", 512),
+        ("512m", 512 * 1000**2),
+        ("1.5G", 1_500_000_000),
+        ("8GiB", 8 * 1024**3),
+        ("2 ti", 2 * 1024**4),
+    ],
+)
+def test_parse_size(size: str, num_bytes: int):
+    assert parse_size(size) == num_bytes
+
+
+@pytest.mark.parametrize("size", ["", "GiB", "8 gigabytes", "-1G", "1Gx"])
+def test_parse_invalid_size(size: str):
+    with pytest.raises(NaaclUtilsError, match="Invalid size"):
+        parse_size(size)
+
+
+@pytest.mark.parametrize(
+    "resources, message",
+    [
+        (Resources(gpu_count=-1), "Invalid GPU count"),
+        (Resources(cpu_count=0), "Invalid CPU count"),
+        (Resources(memory="lots"), "Invalid size"),
+        (Resources(shared_memory="0GiB"), "more than 0 bytes"),
+        (Resources(memory="4GiB", shared_memory="8GiB"), "can't be more than memory"),
+    ],
+)
+def test_invalid_resources(resources: Resources, message: str):
+    with pytest.raises(NaaclUtilsError, match=message):
+        validate_tasks([TaskSpec(resources=resources)])
+
+
+def test_duplicate_task_names():
+    with pytest.raises(NaaclUtilsError, match="appears more than once"):
+        validate_tasks([TaskSpec(name="eval"), TaskSpec(name="eval")])
+
+
+def test_experiment_spec():
+    task = TaskSpec(
+        entrypoint="python",
+        cmd="evaluate.py --split 'dev set'",
+        resources=DEFAULT_RESOURCES.override(shared_memory="8GiB", cpu_count=4),
+    )
+    (beaker_task,) = make_experiment_spec("im-1", [task], "NAACL/server")["tasks"]
+    assert beaker_task["name"] == "main"
+    assert beaker_task["image"] == {"beaker": "im-1"}
+    assert beaker_task["command"] == ["python"]
+    assert beaker_task["arguments"] == ["evaluate.py", "--split", "dev set"]
+    assert beaker_task["resources"] == {"gpuCount": 1, "cpuCount": 4, "sharedMemory": "8GiB"}
+
+
+def test_load_task_specs(tmp_path):
+    spec = tmp_path / "spec.yml"
+    spec.write_text(
+        "tasks:\n"
+        "  - name: dev\n"
+        "    cmd: python evaluate.py --split dev\n"
+        "  - name: test\n"
+        "    cmd: python evaluate.py --split test\n"
+        "    gpu_count: 2\n"
+        "    memory: 64000000000\n"
+    )
+    defaults = TaskSpec(entrypoint="/bin/sh", resources=DEFAULT_RESOURCES.override(cpu_count=4))
+    dev, test = load_task_specs(spec, defaults)
+    assert dev == TaskSpec("dev", "/bin/sh", "python evaluate.py --split dev", defaults.resources)
+    assert test.resources == Resources(
+        gpu_count=2, cpu_count=4, memory="64000000000", shared_memory="1GiB"
+    )
+
+
+@pytest.mark.parametrize(
+    "contents, message",
+    [
+        ("[]", "must be a mapping with a list of 'tasks'"),
+        ('{"tasks": [], "image": "hello-world"}', "unknown field"),
+        ('{"tasks": []}', "at least one task"),
+        ('{"tasks": ["python run.py"]}', "Task 1 .* must be a mapping"),
+        ('{"tasks": [{"name": "a", "gpus": 1}]}', "Task 1 .* unknown field"),
+        ('{"tasks": [{"name": "a"}, {"cmd": "python run.py"}]}', "Task 2 .* needs a 'name'"),
+        ('{"tasks": [{"name": "a", "gpu_count": 1.5}]}', "Invalid GPU count"),
+        ('{"tasks": [{"name": "a/b"}]}', "Invalid task name"),
+        ("{", "Failed to parse"),
+    ],
+)
+def test_invalid_task_specs(tmp_path, contents: str, message: str):
+    spec = tmp_path / "spec.json"
+    spec.write_text(contents)
+    with pytest.raises(NaaclUtilsError, match=message):
+        load_task_specs(spec)
@@ -0,0 +1,48 @@
+import subprocess
+import sys
+from typing import Dict
+
+# Modules that the CLI should only import from within the commands that need them.
+HEAVY_MODULES = ["beaker", "docker", "requests", "rich", "difflib", "packaging"]
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """
+    Get the cumulative import time in microseconds of every module loaded
+    when importing the given module, as reported by ``python -X importtime``.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_does_not_load_heavy_modules():
+    times = import_times("naacl_utils.__main__")
+    assert "naacl_utils.__main__" in times
+    loaded = [name for name in times if name.split(".")[0] in HEAVY_MODULES]
+    assert not loaded
+
+
+def test_cli_startup_time(benchmark):
+    result = benchmark.pedantic(
+        subprocess.run,
+        args=([sys.executable, "-m", "naacl_utils", "--version"],),
+        kwargs={"capture_output": True, "check": True},
+        rounds=5,
+    )
+    assert result.returncode == 0
+
+
+def test_cli_import_time(benchmark):
+    times = benchmark.pedantic(import_times, args=("naacl_utils.__main__",), rounds=3)
+    benchmark.extra_info["cumulative_import_time_us"] = times["naacl_utils.__main__"]
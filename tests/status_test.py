@@ -0,0 +1,66 @@
+import pytest
+
+from naacl_utils.polling import experiment_finished
+from naacl_utils.status import (
+    CANCELED,
+    FAILED,
+    PENDING,
+    RUNNING,
+    SUCCEEDED,
+    experiment_state,
+    run_status,
+)
+
+
+@pytest.mark.parametrize(
+    "status, state",
+    [
+        ({"created": "t"}, PENDING),
+        ({"created": "t", "started": "t"}, RUNNING),
+        ({"started": "t", "exited": "t", "exitCode": 0}, SUCCEEDED),
+        ({"started": "t", "exited": "t", "exitCode": 1}, FAILED),
+        ({"started": "t", "finalized": "t"}, FAILED),
+        ({"canceled": "t", "exitCode": 0}, CANCELED),
+    ],
+)
+def test_experiment_state(status, state):
+    assert experiment_state({"jobs": [{"status": status}]}) == state
+
+
+def test_experiment_state_without_jobs():
+    assert experiment_state({"jobs": []}) == PENDING
+
+
+def test_retried_experiment():
+    retry = {
+        "execution": {"task": "tk-1"},
+        "status": {"created": "2022-05-10T13:00:00Z", "started": "t"},
+    }
+    failed = {
+        "execution": {"task": "tk-1"},
+        "status": {"created": "2022-05-10T12:00:00Z", "exitCode": 1},
+    }
+    experiment = {"name": "run-1", "jobs": [retry, failed]}
+    assert experiment_state(experiment) == RUNNING
+    assert not experiment_finished(experiment)
+
+    retry["status"]["exitCode"] = 0
+    assert run_status(experiment) == {"run_name": "run-1", "state": SUCCEEDED, "exit_code": 0}
+    assert experiment_finished(experiment)
+
+
+def test_experiment_with_several_tasks():
+    dev = {
+        "execution": {"task": "tk-1"},
+        "status": {"created": "2022-05-10T12:00:00Z", "started": "t"},
+    }
+    test = {
+        "execution": {"task": "tk-2"},
+        "status": {"created": "2022-05-10T13:00:00Z", "exitCode": 0},
+    }
+    experiment = {"name": "run-1", "jobs": [dev, test]}
+    assert experiment_state(experiment) == RUNNING
+
+    # The run failed if any task did, no matter which job is the latest.
+    dev["status"]["exitCode"] = 3
+    assert run_status(experiment) == {"run_name": "run-1", "state": FAILED, "exit_code": 3}